@@ -3,23 +3,39 @@
 
 # Imports
 
-# GUI and image handle python libraries
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from PIL import Image, ImageTk
+# Import for functions that require timing. BOOT_CLOCK is taken first so
+# the startup profile includes the time spent importing.
+import time
+BOOT_CLOCK = time.perf_counter()
+
+# Shutdown of the headless kiosk on SIGTERM/SIGINT
+import signal
+
+# GUI and image handle python libraries (tkinter, PIL). They are only
+# imported in GUI mode, by load_gui_libraries(), so a headless kiosk 
+# does not pay for them.
+tk = filedialog = messagebox = simpledialog = Image = ImageTk = None
 
 # File format management
 import json
 
+# Embedded database for the transaction journal
+import sqlite3
+
 # Functions for interacting with the operating system to be able to get 
 # environment variables
 import os
 
-# Python library for OTP gen and verification
-import pyotp
+# Random per-transaction OTPs, stored as keyed hashes
+import secrets
+import hmac
+import hashlib
 
-# Python library to be able to send message via Telegram bots
-import telegram
+# Python library to be able to send message via Telegram bots. It is
+# imported when the Telegram event loop starts, see TelegramLoop.
+
+# Event loop that runs the asynchronous Telegram bot calls
+import asyncio
 
 # Library that allows user to be able to log system states and events. 
 # Moreover, the RotatingFileHandler import ensures that the contents of
@@ -27,26 +43,32 @@ import telegram
 import logging
 from logging.handlers import RotatingFileHandler
 
-# Import for functions that require timing
-import time
+# Weight sensor amplifier (hx711), GPIO pin control (RPi.GPIO) and the 
+# keypad (board, digitalio, adafruit_matrixkeypad) are imported by the 
+# Raspberry Pi hardware backend when it is selected, so the rest of the
+# system also runs against the simulator on a normal Linux machine.
 
-# Weight sensor amplifier
-from hx711 import HX711
+# The threading python module enables project multitheading
+from threading import Thread, Lock, Event, Condition, local, current_thread
+from concurrent.futures import ThreadPoolExecutor, wait
 
-# GPIO pin control
-import RPi.GPIO as GPIO
+# Fixed-size event history and weight sample ring buffer
+from collections import deque, OrderedDict
+import functools
+from types import MappingProxyType
+from queue import Queue, Empty, Full
 
-# The threading python module enables project multitheading
-from threading import Thread, Lock, Event
+# Median filtering and stability statistics of load cell samples
+import statistics
 
-# Keypad control
-import board
-import digitalio
-from adafruit_matrixkeypad import Matrix_Keypad
+# Exponential settling of the simulated load cell
+import math
 
 # Web server creation via flask, render_template for HTML file, Jsonify
-# for JSON endpoint formatting, request for HTTP requests
-from flask import Flask, render_template, jsonify, request
+# for JSON endpoint formatting, request for HTTP requests. make_server
+# binds the web server socket ahead of serving.
+from flask import Flask, render_template, jsonify, request, Response
+from werkzeug.serving import make_server
 
 # Environment variable loading
 from dotenv import load_dotenv
@@ -55,13 +77,14 @@ from dotenv import load_dotenv
 import random
 import string  
 
-# Python blockchain integration (Ethereum Network) with Block Box.
-from web3 import Web3
-import web3
+# Python blockchain integration (Ethereum Network) with Block Box. web3
+# takes seconds to import on a Pi so it is imported by the blockchain 
+# client on first use instead of at boot.
 
 # HTTP requests to all general web servers and not necessarify flask 
 # web servers. Not context-specific like flask request
 import requests
+from requests.adapters import HTTPAdapter
 
 # Loading environment variables from .env file which is in the same 
 # directory as the project
@@ -71,17 +94,138 @@ load_dotenv()
 # This is the URL that is taken from NGROK, note that this would have 
 # to be changed every 8Hrs or so as NGROK's tunneling service expires, 
 # otherwise a static URL would have to be incorporated
-FLASK_API_URL = "https://e020-105-233-133-57.ngrok-free.app"
+FLASK_API_URL = os.getenv('FLASK_API_URL', "https://e020-105-233-133-57.ngrok-free.app")
+FLASK_PORT = int(os.getenv('BLOCKBOX_PORT', 5000)) # Port the Flask 
+# server listens on
+RUN_MODE = os.getenv('BLOCKBOX_MODE', 'gui') # 'gui' runs the Tkinter 
+# GUI, 'headless' the kiosk state machine driven by the API and keypad
 
 # CONSTANT DEFINITION
 LOCK_PIN = 2 # Solenoid lock is GPIO pin 2
 DOOR_SENSOR_PIN = 16 # Magnetic reed sensor is GPIO pin 16
 DATA_PIN = 5 # Data pin (DT) of HX711 is connected to GPIO pin 5
 SCK_PIN = 6 # Clock pin (SCL) of HX711 is connected to GPIO pin 6
+# Compartment registry. Every compartment has its own lock, reed switch
+# and HX711 channel. Add an entry per compartment of the locker bank.
+COMPARTMENTS = {
+    '1': {'lock_pin': LOCK_PIN, 'door_pin': DOOR_SENSOR_PIN, 
+    'data_pin': DATA_PIN, 'sck_pin': SCK_PIN},
+}
+DEFAULT_COMPARTMENT = '1' # Compartment used when none is specified
 KEYPAD_ROWS_PINS = [17, 27, 22, 10]
 KEYPAD_COLS_PINS = [9, 11, 13, 19]
+KEYPAD_KEYS = [
+    ["1", "2", "3", "A"],
+    ["4", "5", "6", "B"],
+    ["7", "8", "9", "C"],
+    ["*", "0", "#", "D"]
+]
+HARDWARE_BACKEND = os.getenv('BLOCKBOX_HARDWARE', 'pi') # 'pi' drives 
+# the real GPIO pins, 'sim' runs against the software simulator
+SIM_WEIGHT_NOISE = float(os.getenv('BLOCKBOX_SIM_NOISE', 0.003)) # kg 
+# standard deviation of simulated load cell noise
+SIM_SETTLE_TIME = float(os.getenv('BLOCKBOX_SIM_SETTLE_TIME', 0.4)) # 
+# Time constant in seconds of the simulated platform settling
+SIM_SAMPLE_TIME = float(os.getenv('BLOCKBOX_SIM_SAMPLE_TIME', 0.0)) # 
+# Seconds one simulated HX711 conversion takes (0.1 at 10 SPS)
+SIM_KEY_PRESS_TIME = 0.25 # Seconds a scripted key is held down
+SIM_KEY_GAP = 0.25 # Seconds between scripted key presses
 OTP_TIMEOUT = 600  # 10 minutes timeout(expiration time) for OTP
 WEIGHT_TOLERANCE = 0.1  # 100 gram tolerance for weight sensor
+REFERENCE_UNIT = -21263 # HX711 calibration factor found when calibrating
+# this system using a known weight
+CALIBRATION_FILE = "calibration.json" # Persisted tare offset and 
+# reference unit so a restart does not have to re-tare
+TARE_DRIFT_LIMIT = 0.05 # kg below zero a warm start may read before the
+# stored tare offset is considered implausible
+TARE_EMPTY_LIMIT = 0.02 # kg a settled reading may be off zero for the 
+# box to count as empty when the scale is re-tared after a collection
+MAX_PLAUSIBLE_WEIGHT = 50 # kg above which a warm start reading is 
+# considered implausible
+JOURNAL_FILE = "blockbox.db" # SQLite journal of transactions and state
+JOURNALED_STATE_KEYS = ('transaction_id', 'transaction_active', 
+'item_price', 'item_collected') # system_state keys written to the 
+# journal when they change
+EVENT_QUEUE_SIZE = 100 # State changes buffered per dashboard stream 
+# before a slow client is dropped (it reconnects and resyncs)
+EVENT_KEEPALIVE_INTERVAL = 15 # Seconds between keep-alive comments on
+# an idle event stream so proxies do not close it
+ERROR_LOG_SIZE = 200 # Error entries kept, older ones are dropped
+ERROR_PAGE_SIZE = 50 # Maximum error entries returned by one /errors call
+DOOR_DEBOUNCE = 0.05 # Seconds the reed switch must settle after an edge
+DOOR_POLL_INTERVAL = 0.05 # Seconds between door reads when edge 
+# detection is not available
+DOOR_EVENT_HISTORY = 50 # Number of door events kept in memory
+WEIGHT_SAMPLE_INTERVAL = 0.1 # Seconds between HX711 samples
+WEIGHT_BUFFER_SIZE = 100 # Number of raw weight samples kept in memory
+WEIGHT_FILTER = 'median' # 'median' of the last WEIGHT_FILTER_WINDOW 
+# samples or 'ema' (exponential moving average)
+WEIGHT_FILTER_WINDOW = 5 # Samples in the median filter
+WEIGHT_EMA_ALPHA = 0.3 # Weight of the newest sample in the EMA filter
+WEIGHT_PUBLISH_DEADBAND = 0.01 # kg a compartment's weight has to move
+# before the new value is pushed to the system state, so load cell noise
+# does not stream a change every second
+SETTLE_WINDOW = 10 # Samples (about 1 s) judged for a stable weight
+SETTLE_MAX_STDDEV = 0.02 # kg spread allowed in a settled window
+SETTLE_MAX_SLOPE = 0.02 # kg/s drift allowed in a settled window
+SETTLE_OUTLIER_LIMIT = 3.5 # Robust z-score above which a sample is 
+# rejected as an outlier
+SETTLE_TIMEOUT = 10 # Seconds the buyer verification waits for the 
+# scale to settle
+COLLECTION_TIMEOUT = 300 # Seconds the buyer has to take the item out
+OTP_LENGTH = 6 # Digits of the OTP typed on the keypad
+RECLAIM_CODE_LENGTH = 10 # Characters of the code a seller gives to take
+# back an uncollected item over the API, long enough not to be guessed
+KEYPAD_POLL_INTERVAL = 0.1 # Seconds between keypad scans
+KIOSK_PLACEMENT_TIMEOUT = 300 # Seconds the kiosk waits for the seller 
+# to put the item in before the listing is cancelled
+KIOSK_OTP_TIMEOUT = 120 # Seconds the kiosk waits for the buyer to type
+# the OTP on the keypad
+PRICE_CACHE_TTL = 60 # Seconds before a cached ETH/USD or USD/ZAR quote
+# is refreshed
+PRICE_MAX_STALE = 900 # Seconds after which a cached quote is too old to
+# be served even when the upstream price source is failing
+EXCHANGE_RATE_TIMEOUT = 5 # Seconds to wait on the exchange rate API
+RPC_TIMEOUT = 10 # Seconds to wait on a single Infura JSON-RPC request
+HTTP_POOL_SIZE = 10 # Maximum number of kept-alive connections per host
+PAYMENT_POLL_INTERVAL = 3 # Seconds between receipt checks of pending
+# payments
+PAYMENT_CONFIRM_TIMEOUT = 600 # Seconds before a pending payment that
+# has not been mined is reported as timed out
+CALLBACK_TIMEOUT = 5 # Seconds to wait on a payment status callback
+TELEGRAM_CHAT_INTERVAL = 1.0 # Minimum seconds between messages to one
+# chat, Telegram's limit for a single chat
+TELEGRAM_GLOBAL_RATE = 30 # Maximum messages per second across all 
+# chats, Telegram's limit for a single bot
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096 # Characters allowed in one message
+OUTBOX_COALESCE_WINDOW = 0.5 # Seconds a new message waits for others to
+# the same chat so a burst is sent as one message
+OUTBOX_MAX_ATTEMPTS = 6 # Attempts before a notification is dropped
+OUTBOX_BACKOFF_BASE = 1.0 # Seconds before the first retry, doubled 
+# after every further failure
+OUTBOX_BACKOFF_MAX = 60 # Upper bound on the retry delay in seconds
+TELEGRAM_POOL_SIZE = 8 # Kept-alive connections to api.telegram.org 
+# shared by both bots
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL', 
+'https://api.telegram.org/bot') # Bot API endpoint, the bot token is 
+# appended to it
+CHAIN_ID = 11155111 # Sepolia testnet ID
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+0.25, 0.5, 1, 2.5, 5, 10, 30) # Histogram bucket bounds in seconds for
+# hardware, RPC, HTTP and Telegram calls
+TRACE_HEADER = 'X-BlockBox-Trace' # HTTP header carrying the transaction
+# ID and parent span ID across the GUI to Flask API call
+TRACE_FILE = "traces.jsonl" # Timeline of every finished transaction,
+# one JSON object per line
+TRACE_MAX_TRACES = 200 # Transaction timelines kept in memory
+TRACE_MAX_SPANS = 500 # Spans kept per transaction
+SLOW_BUCKETS = (1, 5, 10, 15, 30, 60, 120, 300, 600) # Bucket bounds in 
+# seconds for waits on people and block confirmations
+# Chainlink ETH/USD price feed contract address on Sepolia testnet, 
+# hardcoded from the Chainlink docs
+ETH_USD_FEED_ADDRESS = '0x694AA1769357215DE4FAC081bf1f309aDC325306'
+# ABI for the AggregatorV3Interface from Chainlink docs, parsed once
+AGGREGATOR_V3_ABI = json.loads('[{"inputs":[],"name":"decimals","outputs":[{"internalType":"uint8","name":"","type":"uint8"}],"stateMutability":"view","type":"function"},{"inputs":[],"name":"description","outputs":[{"internalType":"string","name":"","type":"string"}],"stateMutability":"view","type":"function"},{"inputs":[{"internalType":"uint80","name":"_roundId","type":"uint80"}],"name":"getRoundData","outputs":[{"internalType":"uint80","name":"roundId","type":"uint80"},{"internalType":"int256","name":"answer","type":"int256"},{"internalType":"uint256","name":"startedAt","type":"uint256"},{"internalType":"uint256","name":"updatedAt","type":"uint256"},{"internalType":"uint80","name":"answeredInRound","type":"uint80"}],"stateMutability":"view","type":"function"},{"inputs":[],"name":"latestRoundData","outputs":[{"internalType":"uint80","name":"roundId","type":"uint80"},{"internalType":"int256","name":"answer","type":"int256"},{"internalType":"uint256","name":"startedAt","type":"uint256"},{"internalType":"uint256","name":"updatedAt","type":"uint256"},{"internalType":"uint80","name":"answeredInRound","type":"uint80"}],"stateMutability":"view","type":"function"},{"inputs":[],"name":"version","outputs":[{"internalType":"uint256","name":"","type":"uint256"}],"stateMutability":"view","type":"function"}]')
 
 logger = logging.getLogger("BlockBox") #Initialise BlockBox Log file
 logger.setLevel(logging.INFO) #Only messages with an INFO level and 
@@ -96,18 +240,419 @@ handler.setFormatter(formatter) #All log messages are set to have
 # the above-mentioned format
 logger.addHandler(handler) # Handler attached to BlockBox logs
 
+# Metrics Classes
+class Metric:
+    # A named metric with optional labels, kept in memory and rendered 
+    # in the Prometheus text format by the MetricsRegistry. Each label
+    # combination (in labelnames order) has its own value.
+    type_name = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {} # Tuple of label values -> value
+        self.lock = Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        text = ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\')
+        .replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs)
+        return '{' + text + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", 
+        f"# TYPE {self.name} {self.type_name}"]
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{self.format_labels(key)} {value}")
+        return lines
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.function = function # Called at scrape time when given, for
+        # values that are cheaper to read than to keep up to date
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception as e:
+                logger.error(f"Error reading gauge {self.name}: {e}")
+        return super().render()
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None: # [count per bucket, +Inf count, sum]
+                entry = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    def time(self, **labels):
+        # with histogram.time(label=...): observes the block's duration,
+        # also when it raises
+        return HistogramTimer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", 
+        f"# TYPE {self.name} {self.type_name}"]
+        with self.lock:
+            values = {key: (list(entry[0]), entry[1], entry[2]) 
+            for key, entry in self.values.items()}
+        for key, (counts, count, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self.format_labels(key, ('le', str(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{self.format_labels(key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {count}")
+        return lines
+
+class HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False # Exceptions are not swallowed
+
+class MetricsRegistry:
+    # Every metric of the process, served at /metrics for Prometheus.
+    def __init__(self):
+        self.metrics = {} # Name -> metric
+        self.lock = Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), function=None):
+        return self.register(Gauge(name, help_text, labelnames, function))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry() # Process-wide metrics registry
+hardware_seconds = metrics.histogram('blockbox_hardware_seconds', 
+'Duration of hardware operations.', ('compartment', 'operation'))
+hardware_errors = metrics.counter('blockbox_hardware_errors_total', 
+'Failed hardware operations.', ('compartment', 'operation'))
+weight_gauge = metrics.gauge('blockbox_weight_kg', 
+'Latest filtered weight per compartment.', ('compartment',))
+door_closed_gauge = metrics.gauge('blockbox_door_closed', 
+'1 when the compartment door is closed.', ('compartment',))
+keypad_entry_seconds = metrics.histogram('blockbox_keypad_entry_seconds',
+'Time the buyer took to type the OTP on the keypad.', buckets=SLOW_BUCKETS)
+rpc_seconds = metrics.histogram('blockbox_rpc_seconds', 
+'Duration of Ethereum JSON-RPC requests.', ('method',))
+rpc_errors = metrics.counter('blockbox_rpc_errors_total', 
+'Ethereum JSON-RPC requests that failed or returned an error.', ('method',))
+exchange_rate_seconds = metrics.histogram('blockbox_exchange_rate_seconds',
+'Duration of USD/ZAR exchange rate fetches.', ('outcome',))
+payment_confirm_seconds = metrics.histogram('blockbox_payment_confirm_seconds',
+'Time from broadcast until a payment was confirmed, failed or timed out.', 
+('status',), buckets=SLOW_BUCKETS)
+telegram_send_seconds = metrics.histogram('blockbox_telegram_send_seconds',
+'Duration of Telegram sendMessage calls.', ('role', 'outcome'))
+http_request_seconds = metrics.histogram('blockbox_http_request_seconds',
+'Duration of Flask requests until the response is returned.', 
+('endpoint', 'method', 'status'))
+
+# Tracing Classes
+class Span:
+    # One timed step of a transaction. Spans of a transaction share its
+    # transaction ID as trace ID and point at the span they ran inside 
+    # (parent_id), also when that span ran in another thread or on the
+    # other side of an HTTP call.
+    def __init__(self, tracer, trace_id, name, parent_id=None, attributes=None):
+        self.tracer = tracer
+        self.trace_id = trace_id # May be filled in before end() when 
+        # the transaction ID is only known once the step has run
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.thread = current_thread().name
+        self.start_time = time.time() # Wall clock, comparable between 
+        # threads
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def header(self):
+        # Headers that make the receiving Flask endpoint a child span
+        if self.trace_id is None:
+            return {}
+        return {TRACE_HEADER: f"{self.trace_id}/{self.span_id}"}
+
+    def end(self, error=None):
+        if self.duration is not None: # Already ended
+            return
+        self.duration = time.perf_counter() - self.start
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        self.tracer.record(self)
+
+    def __enter__(self):
+        self.tracer.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.tracer.pop(self)
+        self.end(exc)
+        return False # Exceptions are not swallowed
+
+    def to_dict(self):
+        return {'span_id': self.span_id, 'parent_id': self.parent_id, 
+        'name': self.name, 'thread': self.thread, 'start': self.start_time,
+        'duration': self.duration, 'error': self.error, 
+        'attributes': self.attributes}
+
+class Tracer:
+    # Collects the spans of every transaction in memory, keyed by 
+    # transaction ID, so the timeline of one slow transaction can be 
+    # broken down stage by stage. Each thread keeps a stack of its open
+    # spans, a new span becomes a child of the innermost one. Finished
+    # transactions are appended to TRACE_FILE as JSON.
+    def __init__(self, path=TRACE_FILE, max_traces=TRACE_MAX_TRACES):
+        self.path = path
+        self.max_traces = max_traces
+        self.traces = OrderedDict() # Transaction ID -> list of span 
+        # dicts, oldest transaction first
+        self.lock = Lock() # Guards traces and the trace file
+        self.local = local() # Per-thread stack of open spans
+
+    def span(self, trace_id, name, parent_id=None, **attributes):
+        # Use as "with tracer.span(transaction_id, 'step'):"
+        if parent_id is None:
+            current = self.current()
+            if current is not None and current.trace_id in (trace_id, None):
+                parent_id = current.span_id
+        return Span(self, trace_id, name, parent_id, attributes)
+
+    def current(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def push(self, span):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append(span)
+
+    def pop(self, span):
+        stack = getattr(self.local, 'stack', [])
+        if span in stack:
+            stack.remove(span)
+
+    def child(self, name, **attributes):
+        # Span under the innermost open span of this thread, or None when
+        # the thread is not working on a transaction
+        current = self.current()
+        if current is None or current.trace_id is None:
+            return None
+        return Span(self, current.trace_id, name, current.span_id, attributes)
+
+    def from_header(self, value, name, **attributes):
+        # Span continuing a trace received in a TRACE_HEADER value
+        trace_id, _, parent_id = (value or '').partition('/')
+        if not trace_id:
+            return None
+        return Span(self, trace_id, name, parent_id or None, attributes)
+
+    def record(self, span):
+        if span.trace_id is None:
+            return
+        with self.lock:
+            spans = self.traces.get(span.trace_id)
+            if spans is None:
+                spans = self.traces[span.trace_id] = []
+                while len(self.traces) > self.max_traces:
+                    self.traces.popitem(last=False)
+            if len(spans) < TRACE_MAX_SPANS:
+                spans.append(span.to_dict())
+
+    def add(self, trace_id, name, start_time, duration, **attributes):
+        # Record a step that was timed elsewhere, e.g. the wait for a
+        # payment to be mined
+        span = Span(self, trace_id, name, attributes=attributes)
+        span.start_time = start_time
+        span.duration = duration
+        self.record(span)
+
+    def timeline(self, trace_id):
+        # The spans of one transaction ordered by start time, with each 
+        # span's offset from the start of the transaction, or None
+        with self.lock:
+            spans = [dict(span) for span in self.traces.get(trace_id, [])]
+        if not spans:
+            return None
+        spans.sort(key=lambda span: span['start'])
+        start = spans[0]['start']
+        end = max(span['start'] + (span['duration'] or 0) for span in spans)
+        for span in spans:
+            span['offset'] = span['start'] - start
+        return {'transaction_id': trace_id, 'start': start, 
+        'duration': end - start, 'spans': spans}
+
+    def recent(self):
+        with self.lock:
+            return list(reversed(self.traces))
+
+    def finish(self, trace_id):
+        # Append the timeline of a transaction that reached a final 
+        # status to the trace file
+        timeline = self.timeline(trace_id)
+        if timeline is None:
+            return
+        try:
+            with self.lock, open(self.path, 'a') as trace_file:
+                trace_file.write(json.dumps(timeline, default=str) + '\n')
+        except Exception as e:
+            logger.error(f"Failed to export trace of transaction {trace_id}: {e}")
+
+tracer = Tracer() # Timelines of the transactions
+
+def traced(name):
+    # Decorator for BlockBoxGUI steps. The span belongs to the 
+    # transaction shown in the GUI when the step starts or, for steps 
+    # that create the transaction, when it ends.
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with tracer.span(self.transaction_id, name) as span:
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    if span.trace_id is None:
+                        span.trace_id = self.transaction_id
+        return wrapper
+    return decorator
+
+# Telegram Event Loop Class
+class TelegramLoop:
+    # python-telegram-bot's Bot methods are coroutines. A single asyncio 
+    # event loop runs in its own thread and owns every Bot together with
+    # one pooled HTTP client that the bots share, so connections to 
+    # Telegram are reused and sends run concurrently. Other threads hand
+    # it coroutines with submit() and get a concurrent.futures.Future.
+    def __init__(self, pool_size=TELEGRAM_POOL_SIZE, base_url=TELEGRAM_BASE_URL):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.loop = asyncio.new_event_loop()
+        self.request = None # Shared HTTP connection pool, from start()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        from telegram.request import HTTPXRequest # Deferred import
+        self.request = HTTPXRequest(connection_pool_size=self.pool_size)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.submit(self.request.initialize()).result()
+        logger.info("Telegram event loop started.")
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        # Thread-safe, schedules the coroutine on the loop thread
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def create_bot(self, token):
+        # Both request slots use the shared client so a bot does not 
+        # open connections of its own
+        import telegram
+        return telegram.Bot(token=token, base_url=self.base_url, 
+        request=self.request, get_updates_request=self.request)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        try:
+            self.submit(self.request.shutdown()).result(timeout=5)
+        except Exception as e:
+            logger.error(f"Error closing Telegram HTTP client: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+telegram_loop = TelegramLoop() # Owns both bots and their HTTP pool
+
 # Telegram Handler Class
 class TelegramHandler:
-    def __init__(self, token, chat_id, role): # Handler to send
-        # messages via telegram
+    def __init__(self, token, chat_id, role, loop=None): # Handler to 
+        # send messages via telegram
         # token - Authentication token from telegram botFather
         # chat_id - Which chat is the bot sending messages to
         # role - String which reps role of the bot (Buyer or seller)
+        # loop - TelegramLoop running the bot, the shared one by default
         self.token = token
         self.chat_id = chat_id
         self.role = role
+        self.loop = loop if loop is not None else telegram_loop
         try:
-            self.bot = telegram.Bot(token=self.token) 
+            self.bot = self.loop.create_bot(self.token) 
             logger.info(f"{role.capitalize()} Telegram Bot initialized successfully.")
         except Exception as e:
             logger.critical(f"Failed to initialize {role} Telegram Bot: {e}")
@@ -117,47 +662,759 @@ class TelegramHandler:
             # continue operating and silently ignore the exception at 
             # higher levels of the code.
 
-    def send_message(self, message):
+    def send_async(self, message):
+        # Start sending on the Telegram event loop and return a Future
+        # that completes when Telegram has accepted the message
+        start = time.perf_counter()
+        future = self.loop.submit(self.bot.send_message(chat_id=self.chat_id, text=message))
+        future.add_done_callback(lambda future: telegram_send_seconds.observe(
+        time.perf_counter() - start, role=self.role, 
+        outcome='error' if future.exception() else 'ok'))
+        return future
+
+    def notify(self, message):
+        # Queue the message in the notification outbox and return at 
+        # once. Delivery, rate limiting and retries happen in the 
+        # background.
+        notification_outbox.enqueue(self, message)
+
+# Notification Outbox Class
+class NotificationOutbox:
+    # Background delivery of Telegram notifications. Callers enqueue and
+    # return immediately, a worker thread then sends each chat's queue:
+    # - at most one message per TELEGRAM_CHAT_INTERVAL per chat and 
+    #   TELEGRAM_GLOBAL_RATE messages per second overall,
+    # - messages queued to one chat within OUTBOX_COALESCE_WINDOW are 
+    #   joined into a single message (up to Telegram's length limit),
+    # - failed sends are retried with exponential backoff, honouring 
+    #   Telegram's retry_after when it asks the bot to slow down.
+    # Sends run on the Telegram event loop, so different chats are sent
+    # to concurrently while each chat has at most one send in flight.
+    def __init__(self):
+        self.queues = {} # (role, chat ID) -> deque of pending entries
+        self.in_flight = set() # Chats with a send not finished yet
+        self.handlers = {} # (role, chat ID) -> TelegramHandler
+        self.next_send = {} # (role, chat ID) -> earliest next send time
+        self.recent_sends = deque() # Send times within the last second
+        self.condition = Condition() # Guards the above and wakes worker
+        self.stop_event = Event()
+        self.thread = None
+
+    def enqueue(self, handler, message):
+        key = (handler.role, handler.chat_id)
+        with self.condition:
+            self.handlers[key] = handler
+            self.queues.setdefault(key, deque()).append(
+            {'text': message, 'enqueued_at': time.time(), 'attempts': 0})
+            self.condition.notify()
+        logger.debug(f"{handler.role.capitalize()} message queued.")
+
+    def pending(self):
+        # Number of messages not delivered yet
+        with self.condition:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        logger.info("Notification outbox started.")
+
+    def stop(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.condition:
+                key, batch, delay = self.next_batch(time.time())
+                if key is None: # Nothing is due, sleep until something 
+                    # is or a new message arrives
+                    self.condition.wait(delay)
+                    continue
+                handler = self.handlers[key]
+            self.send_batch(key, handler, batch)
+
+    def next_batch(self, now):
+        # Pick a chat whose first message is due and take as many of its
+        # queued messages as fit in one Telegram message. Returns (key,
+        # entries, None) or (None, None, seconds until something is due).
+        while self.recent_sends and now - self.recent_sends[0] >= 1:
+            self.recent_sends.popleft()
+        if len(self.recent_sends) >= TELEGRAM_GLOBAL_RATE:
+            return None, None, 1 - (now - self.recent_sends[0])
+
+        delay = None
+        for key, queue in self.queues.items():
+            if not queue or key in self.in_flight: # Keeps the order
+                continue
+            ready_at = max(self.next_send.get(key, 0), 
+            queue[0]['enqueued_at'] + OUTBOX_COALESCE_WINDOW)
+            if ready_at > now:
+                delay = ready_at - now if delay is None else min(delay, ready_at - now)
+                continue
+            batch = [queue.popleft()]
+            length = len(batch[0]['text'])
+            while queue and length + 2 + len(queue[0]['text']) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+                length += 2 + len(queue[0]['text'])
+                batch.append(queue.popleft())
+            self.recent_sends.append(now)
+            self.next_send[key] = now + TELEGRAM_CHAT_INTERVAL
+            self.in_flight.add(key)
+            return key, batch, None
+        return None, None, delay
+
+    def send_batch(self, key, handler, batch):
+        # Start the send and return, sent() runs when it finishes
+        text = "\n\n".join(entry['text'] for entry in batch)
         try:
-            self.bot.send_message(chat_id=self.chat_id, text=message)
-            logger.info(f"{self.role.capitalize()} message sent successfully.")
+            future = handler.send_async(text)
         except Exception as e:
-            logger.error(f"Error sending {self.role} message: {e}")
-            with state_lock: # system_state is a shared resource that 
-                # is multi-threaded, therefore, state_lock ensures that
-                #only one thread can modify system_state at a time. 
-                system_state['error_logs'].append(f"Error sending {self.role} message: {e}")
-            raise # Raise again without argument -> re-raise
+            self.sent(key, handler, batch, text, e)
+            return
+        future.add_done_callback(lambda future: self.sent(key, handler, 
+        batch, text, future.exception()))
+
+    def sent(self, key, handler, batch, text, error):
+        retry = None # Entry put back in the queue when the send failed
+        if error is None:
+            logger.info(f"{handler.role.capitalize()} message sent successfully.")
+        else:
+            attempts = max(entry['attempts'] for entry in batch) + 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Giving up on {handler.role} message after {attempts} attempts: {error}")
+                record_error(f"Error sending {handler.role} message: {error}", "telegram")
+            else:
+                # Telegram's RetryAfter error says how long to wait
+                delay = getattr(error, 'retry_after', None)
+                if delay is None:
+                    delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+                if hasattr(delay, 'total_seconds'): # Newer versions give
+                    # a timedelta
+                    delay = delay.total_seconds()
+                logger.warning(f"Sending {handler.role} message failed (attempt {attempts}), retrying in {delay:.1f}s: {error}")
+                retry = {'text': text, 'enqueued_at': batch[0]['enqueued_at'], 
+                'attempts': attempts}
+        with self.condition:
+            # The failed batch goes back in front of newer messages as one
+            # entry in the same step that frees the chat, otherwise the 
+            # worker could send a newer message of the chat in between
+            if retry is not None:
+                self.queues[key].appendleft(retry)
+                self.next_send[key] = time.time() + delay
+            self.in_flight.discard(key)
+            self.condition.notify() # The chat may have more messages
+
+notification_outbox = NotificationOutbox() # Shared by both bots
+metrics.gauge('blockbox_outbox_pending', 'Telegram messages waiting to be sent.',
+function=notification_outbox.pending)
+
+# Hardware Backend Classes
+class PiBackend:
+    # The real Raspberry Pi hardware. The driver libraries only exist on
+    # the Pi so they are imported here rather than at module level.
+    name = 'pi'
+
+    def __init__(self):
+        import RPi.GPIO as GPIO # GPIO pin control
+        from hx711 import HX711 # Weight sensor amplifier
+        import board # Keypad control
+        import digitalio
+        from adafruit_matrixkeypad import Matrix_Keypad
+        self.gpio = GPIO
+        self.hx711_class = HX711
+        self.board = board
+        self.digitalio = digitalio
+        self.keypad_class = Matrix_Keypad
+
+    def create_scale(self, data_pin, sck_pin):
+        return self.hx711_class(data_pin, sck_pin)
+
+    def create_keypad(self, row_pins=KEYPAD_ROWS_PINS, 
+    col_pins=KEYPAD_COLS_PINS, keys=KEYPAD_KEYS):
+        rows = [self.digitalio.DigitalInOut(getattr(self.board, f"D{pin}")) 
+        for pin in row_pins] # e.g. GPIO 17 (Key_R1) is board.D17
+        cols = [self.digitalio.DigitalInOut(getattr(self.board, f"D{pin}")) 
+        for pin in col_pins]
+        return self.keypad_class(cols, rows, keys) # Columns are passed 
+        # first to match how the keypad is wired
+
+class SimGPIO:
+    # Stand-in for the RPi.GPIO module with the calls the controllers 
+    # use. Outputs are remembered, inputs are driven by the SimWorld and
+    # edge callbacks run in their own thread like RPi.GPIO's event thread.
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_UP = 22
+    PUD_DOWN = 21
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.lock = Lock() # Guards the pin tables
+        self.mode = None
+        self.directions = {} # Pin -> IN or OUT
+        self.levels = {} # Pin -> LOW or HIGH
+        self.callbacks = {} # Pin -> (edge, callback)
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        with self.lock:
+            self.directions[pin] = direction
+            if pin not in self.levels: # The world may have set it first
+                if initial is not None:
+                    self.levels[pin] = initial
+                else:
+                    self.levels[pin] = self.LOW if pull_up_down == self.PUD_DOWN else self.HIGH
+
+    def output(self, pin, value):
+        with self.lock:
+            self.levels[pin] = value
+
+    def input(self, pin):
+        with self.lock:
+            return self.levels.get(pin, self.HIGH)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.lock:
+            self.callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.callbacks.pop(pin, None)
+
+    def set_input(self, pin, level):
+        # Drive an input pin from the simulated world
+        with self.lock:
+            previous = self.levels.get(pin, self.HIGH)
+            self.levels[pin] = level
+            edge, callback = self.callbacks.get(pin, (None, None))
+        if callback is None or previous == level:
+            return
+        rising = level == self.HIGH
+        if edge == self.BOTH or edge == (self.RISING if rising else self.FALLING):
+            Thread(target=callback, args=(pin,), daemon=True).start()
+
+    def cleanup(self):
+        with self.lock:
+            self.callbacks.clear()
+            self.directions.clear()
+
+class SimHX711:
+    # Simulated HX711 with the methods of the hx711 library used by the 
+    # controllers. The load on the platform approaches its new value 
+    # exponentially with time constant settle_time, like a platform that
+    # wobbles after a parcel is put down, and every reading has gaussian
+    # noise of noise kg.
+    RAW_ZERO = 8388 # Raw reading of the empty platform
+
+    def __init__(self, data_pin, sck_pin, noise=SIM_WEIGHT_NOISE, 
+    settle_time=SIM_SETTLE_TIME, sample_time=SIM_SAMPLE_TIME):
+        self.data_pin = data_pin
+        self.sck_pin = sck_pin
+        self.noise = noise
+        self.settle_time = settle_time
+        self.sample_time = sample_time
+        self.reference_unit = 1
+        self.offset = 0
+        self.lock = Lock() # Guards the load model
+        self.previous_load = 0.0 # kg before the last change
+        self.target_load = 0.0 # kg the platform is settling towards
+        self.changed_at = time.monotonic()
+
+    def load(self, now=None):
+        # Load in kg the platform currently reports, without noise
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.settle_time <= 0:
+                return self.target_load
+            decay = math.exp(-(now - self.changed_at) / self.settle_time)
+            return self.target_load + (self.previous_load - self.target_load) * decay
+
+    def set_load(self, kg):
+        now = time.monotonic()
+        current = self.load(now)
+        with self.lock:
+            self.previous_load = current
+            self.target_load = kg
+            self.changed_at = now
+
+    def read_raw(self):
+        if self.sample_time > 0:
+            time.sleep(self.sample_time)
+        kg = self.load() + random.gauss(0, self.noise)
+        return self.RAW_ZERO + kg * REFERENCE_UNIT
+
+    def read_average(self, times=3):
+        return sum(self.read_raw() for _ in range(times)) / times
+
+    def get_weight(self, times=3):
+        return (self.read_average(times) - self.offset) / self.reference_unit
+
+    def tare(self, times=15):
+        self.offset = self.read_average(times)
+        return self.offset
+
+    def get_offset(self):
+        return self.offset
+
+    def set_offset(self, offset):
+        self.offset = offset
+
+    def get_reference_unit(self):
+        return self.reference_unit
+
+    def set_reference_unit(self, reference_unit):
+        self.reference_unit = reference_unit
+
+    def reset(self):
+        pass
+
+class SimKeypad:
+    # Simulated matrix keypad. pressed_keys behaves like the Adafruit
+    # driver's, keys are pressed by scripts given to type_keys().
+    def __init__(self, keys=KEYPAD_KEYS, press_time=SIM_KEY_PRESS_TIME, 
+    gap=SIM_KEY_GAP):
+        self.keys = set(key for row in keys for key in row)
+        self.press_time = press_time
+        self.gap = gap
+        self.pressed = []
+        self.lock = Lock() # Guards pressed
+        self.script_lock = Lock() # Scripts are typed one after another
+
+    @property
+    def pressed_keys(self):
+        with self.lock:
+            return list(self.pressed)
+
+    def type_keys(self, sequence):
+        # Press every key of sequence in turn in a background thread
+        unknown = [key for key in sequence if key not in self.keys]
+        if unknown:
+            raise ValueError(f"Keys not on the keypad: {unknown}")
+        thread = Thread(target=self.run_script, args=(list(sequence),), daemon=True)
+        thread.start()
+        return thread
+
+    def run_script(self, sequence):
+        with self.script_lock:
+            for key in sequence:
+                with self.lock:
+                    self.pressed = [key]
+                time.sleep(self.press_time)
+                with self.lock:
+                    self.pressed = []
+                time.sleep(self.gap)
+
+class SimWorld:
+    # The physical side of the simulator: doors, parcels and the person 
+    # at the keypad. A door can only be opened while its solenoid is 
+    # released and parcels can only be put in or taken out of an open 
+    # compartment, like the real locker.
+    def __init__(self, gpio, config=COMPARTMENTS):
+        self.gpio = gpio
+        self.config = config # Compartment ID -> pin numbers
+        self.scales = {} # Data pin -> SimHX711
+        self.keypad = None
+        self.lock = Lock() # Guards the door and parcel tables
+        self.doors_open = {compartment_id: False for compartment_id in config}
+        self.parcels = {compartment_id: 0.0 for compartment_id in config}
+        for pins in config.values(): # Doors start closed, reed LOW
+            self.gpio.set_input(pins['door_pin'], self.gpio.LOW)
+
+    def compartment(self, compartment_id):
+        if compartment_id not in self.config:
+            raise KeyError(f"Unknown compartment {compartment_id}")
+        return self.config[compartment_id]
+
+    def is_locked(self, compartment_id):
+        # LOW on the lock pin engages the solenoid
+        return self.gpio.input(self.compartment(compartment_id)['lock_pin']) == self.gpio.LOW
+
+    def open_door(self, compartment_id):
+        # Returns False when the door is locked
+        pins = self.compartment(compartment_id)
+        if self.is_locked(compartment_id):
+            return False
+        with self.lock:
+            self.doors_open[compartment_id] = True
+        self.gpio.set_input(pins['door_pin'], self.gpio.HIGH)
+        return True
+
+    def close_door(self, compartment_id):
+        pins = self.compartment(compartment_id)
+        with self.lock:
+            self.doors_open[compartment_id] = False
+        self.gpio.set_input(pins['door_pin'], self.gpio.LOW)
+        return True
+
+    def set_parcel(self, compartment_id, weight):
+        # Put a parcel of weight kg in, or take it out with weight 0. 
+        # Returns False when the door is closed.
+        pins = self.compartment(compartment_id)
+        with self.lock:
+            if not self.doors_open[compartment_id]:
+                return False
+            self.parcels[compartment_id] = max(float(weight), 0.0)
+        scale = self.scales.get(pins['data_pin'])
+        if scale is not None:
+            scale.set_load(self.parcels[compartment_id])
+        return True
+
+    def type_keys(self, sequence):
+        if self.keypad is None:
+            raise RuntimeError("The keypad has not been created yet")
+        self.keypad.type_keys(sequence)
+
+    def state(self):
+        compartments_state = {}
+        for compartment_id, pins in self.config.items():
+            scale = self.scales.get(pins['data_pin'])
+            with self.lock:
+                door_open = self.doors_open[compartment_id]
+                parcel = self.parcels[compartment_id]
+            compartments_state[compartment_id] = {
+                'locked': self.is_locked(compartment_id),
+                'door_open': door_open,
+                'parcel_kg': parcel,
+                'scale_load_kg': scale.load() if scale is not None else None,
+            }
+        return {'compartments': compartments_state, 'keys_pressed': 
+        self.keypad.pressed_keys if self.keypad is not None else []}
+
+class SimulatorBackend:
+    # Software stand-in for the locker hardware, selected with 
+    # BLOCKBOX_HARDWARE=sim, so the whole system (GUI flows, Flask API,
+    # sensor scheduler) can run, be profiled and load-tested off-device.
+    name = 'sim'
+
+    def __init__(self, config=COMPARTMENTS, noise=SIM_WEIGHT_NOISE, 
+    settle_time=SIM_SETTLE_TIME, sample_time=SIM_SAMPLE_TIME):
+        self.gpio = SimGPIO()
+        self.world = SimWorld(self.gpio, config)
+        self.noise = noise
+        self.settle_time = settle_time
+        self.sample_time = sample_time
+
+    def create_scale(self, data_pin, sck_pin):
+        scale = SimHX711(data_pin, sck_pin, self.noise, self.settle_time, 
+        self.sample_time)
+        self.world.scales[data_pin] = scale
+        return scale
+
+    def create_keypad(self, row_pins=KEYPAD_ROWS_PINS, 
+    col_pins=KEYPAD_COLS_PINS, keys=KEYPAD_KEYS):
+        self.world.keypad = SimKeypad(keys)
+        return self.world.keypad
+
+def create_hardware_backend(name=HARDWARE_BACKEND):
+    if name == 'pi':
+        return PiBackend()
+    if name == 'sim':
+        logger.info("Using the hardware simulator.")
+        return SimulatorBackend()
+    raise ValueError(f"Unknown hardware backend: {name}")
+
+hardware_backend = None # Selected in main() from BLOCKBOX_HARDWARE
 
 # Hardware Controller Class
 class HardwareController:
     # This class concerns itself with the setup and operational 
     # controll of the hardware components (lock, door sensor, weight 
     # module) of the Block Box System.
-    def __init__(self): #Initalisation of class upon instance creation
-        GPIO.setmode(GPIO.BCM) # Broadcom numbering used for GPIO which
-        # refers to the pin numbers of RPi
+    # One instance controls one compartment of the locker bank.
+    calibration_file_lock = Lock() # Shared by all compartments as they
+    # store their calibration in the same file
+
+    def __init__(self, compartment_id=DEFAULT_COMPARTMENT, lock_pin=LOCK_PIN,
+    door_pin=DOOR_SENSOR_PIN, data_pin=DATA_PIN, sck_pin=SCK_PIN,
+    weight_filter=WEIGHT_FILTER, backend=None): #Initalisation of class 
+        # upon instance creation
+        self.compartment_id = compartment_id # Key in the registry
+        self.lock_pin = lock_pin # Solenoid lock GPIO pin
+        self.door_pin = door_pin # Magnetic reed sensor GPIO pin
+        self.backend = backend if backend is not None else hardware_backend
+        self.gpio = self.backend.gpio # RPi.GPIO or the simulator's
+        self.gpio.setmode(self.gpio.BCM) # Broadcom numbering used for 
+        # GPIO which refers to the pin numbers of RPi
         self.setup_gpio() #Calling setup_gpio method below
-        self.hx711 = HX711(DATA_PIN, SCK_PIN) # Initialisation of an
-        # an instance of the HX711 class'''
-        self.hx711.set_reference_unit(-21263) # The reference unit
-        # in the arguments of the set_reference_unit is one that found
-        # when calibrating this system using known weight. This value 
-        # is known as the calibration factor and ranges according to setup
-        # of the scale.
-        self.hx711.reset() # Scale reset to start with clean state
-        self.hx711.tare() # Zeroing of load cell readings
-        logger.info("Hardware Controller initialized.") #Logging
+        self.hx711 = self.backend.create_scale(data_pin, sck_pin) # 
+        # Initialisation of an instance of the HX711 class
+        self.hx711_lock = Lock() # Held while the HX711 is being read
+        self.set_tare_required(False) # True when the stored tare offset
+        # failed its plausibility check and an empty-box tare is needed
+        self.setup_weight_buffer(weight_filter) # Filled by the scheduler
+        self.load_calibration() # Warm start from the stored tare offset
+        self.setup_door_events() # Edge-triggered door sensor
+        logger.info(f"Hardware Controller initialized for compartment {compartment_id}.") #Logging
+
+    def setup_weight_buffer(self, weight_filter):
+        # Only the sensor scheduler samples the HX711 (through 
+        # sample_weight). Samples go into a fixed-size ring buffer and a
+        # filtered weight is kept that every other thread reads without
+        # touching the DT and SCK pins, so concurrent readers can no 
+        # longer corrupt each other's bit-banged reads or wait on the 
+        # sampling themselves.
+        if weight_filter not in ('median', 'ema'):
+            raise ValueError(f"Unknown weight filter: {weight_filter}")
+        self.weight_filter = weight_filter
+        self.weight_lock = Lock() # Guards the weight fields below
+        self.weight_samples = deque(maxlen=WEIGHT_BUFFER_SIZE) # Ring 
+        # buffer of (timestamp, raw weight in kg)
+        self.filtered_weight = 0.0 # Latest filtered weight in kg
+        self.weight_timestamp = None # When filtered_weight was updated
+        self.weight_ema = None # Running EMA value
+        self.weight_error = False # Only the first of consecutive read 
+        # errors is added to the error logs
+
+    def sample_weight(self):
+        # Take one sample from the HX711, called by the sensor scheduler
+        try:
+            with self.hx711_lock, hardware_seconds.time(
+            compartment=self.compartment_id, operation='hx711_read'):
+                raw_weight = self.hx711.get_weight(1)
+            self.add_weight_sample(raw_weight)
+            self.weight_error = False
+        except Exception as e:
+            hardware_errors.inc(compartment=self.compartment_id, operation='hx711_read')
+            if not self.weight_error:
+                logger.error(f"Compartment {self.compartment_id}: error reading weight: {e}")
+                record_error(f"Compartment {self.compartment_id}: error reading weight: {e}", "weight")
+            self.weight_error = True
+
+    def add_weight_sample(self, raw_weight):
+        # Store a raw sample and update the filtered weight
+        now = time.time()
+        with self.weight_lock:
+            self.weight_samples.append((now, raw_weight))
+            if self.weight_filter == 'ema':
+                if self.weight_ema is None:
+                    self.weight_ema = raw_weight
+                else:
+                    self.weight_ema = (WEIGHT_EMA_ALPHA * raw_weight + 
+                    (1 - WEIGHT_EMA_ALPHA) * self.weight_ema)
+                filtered = self.weight_ema
+            else: # Median rejects single-sample spikes
+                recent = [w for _, w in list(self.weight_samples)[-WEIGHT_FILTER_WINDOW:]]
+                filtered = statistics.median(recent)
+            self.filtered_weight = max(filtered, 0.0) # Ensures that the 
+            # weight value cannot be negative.
+            self.weight_timestamp = now
+        weight_gauge.set(self.filtered_weight, compartment=self.compartment_id)
+
+    def latest_weight(self):
+        # Latest filtered weight in kg and the time it was measured (None 
+        # before the first sample)
+        with self.weight_lock:
+            return self.filtered_weight, self.weight_timestamp
+
+    def weight_history(self, count=None):
+        # Copy of the newest count raw (timestamp, weight) samples, oldest
+        # first
+        with self.weight_lock:
+            samples = list(self.weight_samples)
+        return samples if count is None else samples[-count:]
+
+    def load_calibration(self):
+        # The tare offset and reference unit are kept on disk. With a
+        # stored calibration the scale is not reset and re-tared at boot,
+        # which is faster and, if the Pi rebooted mid-transaction, does 
+        # not zero the scale with a parcel inside. Instead a quick reading
+        # with the stored offset is checked for plausibility.
+        calibration = self.read_calibration_file().get(self.compartment_id)
+
+        if calibration is None: # First boot, the box must be empty
+            self.hx711.set_reference_unit(REFERENCE_UNIT) # The reference
+            # unit in the arguments of the set_reference_unit is one that
+            # found when calibrating this system using known weight. This 
+            # value is known as the calibration factor and ranges 
+            # according to setup of the scale.
+            self.hx711.reset() # Scale reset to start with clean state
+            self.tare() # Zeroing of load cell readings
+            return
+
+        self.hx711.set_reference_unit(calibration['reference_unit'])
+        self.hx711.set_offset(calibration['offset'])
+        weight = self.hx711.get_weight(3)
+        if -TARE_DRIFT_LIMIT <= weight <= MAX_PLAUSIBLE_WEIGHT:
+            logger.info(f"Compartment {self.compartment_id}: warm start with stored tare offset, scale reads {weight:.2f} kg.")
+        else: # Not re-tared here as the box may not be empty
+            self.set_tare_required(True)
+            logger.warning(f"Compartment {self.compartment_id}: stored tare offset is implausible "
+            f"(scale reads {weight:.2f} kg). Re-tare once the box is confirmed empty.")
+
+    def read_calibration_file(self):
+        # Stored calibrations keyed by compartment ID
+        try:
+            with open(CALIBRATION_FILE) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Could not read {CALIBRATION_FILE}: {e}")
+            return {}
+
+    def tare(self):
+        # Zero the scale and store the new offset. Only call this when the
+        # box is known to be empty.
+        with self.hx711_lock: # Waits for the sampler to finish a read
+            self.hx711.tare()
+            offset = self.hx711.get_offset()
+        calibration = {
+            'offset': offset,
+            'reference_unit': self.hx711.get_reference_unit(),
+            'tared_at': time.time(),
+        }
+        try:
+            with HardwareController.calibration_file_lock:
+                calibrations = self.read_calibration_file()
+                calibrations[self.compartment_id] = calibration
+                # Written to a temporary file first so a power cut cannot
+                # leave a half-written calibration file behind
+                with open(CALIBRATION_FILE + ".tmp", "w") as file:
+                    json.dump(calibrations, file)
+                os.replace(CALIBRATION_FILE + ".tmp", CALIBRATION_FILE)
+        except Exception as e:
+            logger.error(f"Could not save {CALIBRATION_FILE}: {e}")
+        with self.weight_lock: # Samples taken with the old offset no 
+            # longer apply
+            self.weight_samples.clear()
+            self.weight_ema = None
+        self.set_tare_required(False)
+        logger.info(f"Compartment {self.compartment_id}: scale tared, offset {offset} saved.")
+
+    def tare_if_empty(self, timeout=SETTLE_TIMEOUT):
+        # Re-zero the scale after an item was taken out, but only once 
+        # the box is confirmed empty: the door is shut and the weight has
+        # settled near zero. An open door, a hand on the platform or a 
+        # small item left behind would otherwise become the new zero.
+        # Returns True if the scale was tared.
+        if not self.wait_for_door(closed=True, timeout=COLLECTION_TIMEOUT):
+            logger.warning(f"Compartment {self.compartment_id}: the door was left open, scale not re-tared.")
+            return False
+        result = WeightVerifier(self).wait_until_settled(timeout=timeout, 
+        condition=lambda weight: weight <= TARE_EMPTY_LIMIT)
+        if not result['settled'] or result['weight'] > TARE_EMPTY_LIMIT:
+            logger.warning(f"Compartment {self.compartment_id}: box not confirmed empty, scale not re-tared. {result['message']}")
+            return False
+        self.tare()
+        return True
+
+    def set_tare_required(self, tare_required):
+        # Published in the compartment's state so the dashboard shows it
+        # and no item is listed into the compartment until it is tared
+        self.tare_required = tare_required
+        update_compartment_state(self.compartment_id, 'tare_required', tare_required)
+
+    def setup_door_events(self):
+        # The reed switch is turned into an event source. An edge on the
+        # door pin wakes a callback which debounces it in software and
+        # publishes a timestamped open/close event to anyone waiting on 
+        # or subscribed to the door, so nothing has to poll the pin.
+        self.door_condition = Condition() # Guards the door fields below
+        # and wakes threads blocked in wait_for_door()
+        self.door_closed = self.read_door_sensor() # Debounced state
+        self.door_changed_at = time.time() # Timestamp of last change
+        self.door_events = deque(maxlen=DOOR_EVENT_HISTORY) # Recent 
+        # events, oldest dropped first
+        self.door_listeners = [] # Functions called with every event
+        try:
+            self.gpio.add_event_detect(self.door_pin, self.gpio.BOTH, 
+            callback=self.on_door_edge, bouncetime=int(DOOR_DEBOUNCE * 1000))
+            logger.info(f"Compartment {self.compartment_id}: door sensor edge detection enabled.")
+        except Exception as e:
+            logger.warning(f"Compartment {self.compartment_id}: door sensor edge detection unavailable, polling instead: {e}")
+            Thread(target=self.poll_door_sensor, daemon=True).start()
+
+    def read_door_sensor(self):
+        # Raw, non-debounced read of the reed switch
+        with hardware_seconds.time(compartment=self.compartment_id, operation='door_read'):
+            return self.gpio.input(self.door_pin) == self.gpio.LOW # LOW is closed
+
+    def on_door_edge(self, channel):
+        # Called from the GPIO event thread on a rising or falling edge.
+        # The switch is read again after it has had time to settle so a
+        # bounce does not publish a false event.
+        time.sleep(DOOR_DEBOUNCE)
+        self.sync_door_state()
+
+    def poll_door_sensor(self):
+        # Fallback for boards where edge detection cannot be set up. A
+        # change is only published after two equal reads DOOR_DEBOUNCE
+        # apart.
+        while True:
+            closed = self.read_door_sensor()
+            if closed != self.door_closed:
+                time.sleep(DOOR_DEBOUNCE)
+                if self.read_door_sensor() == closed:
+                    self.publish_door_state(closed)
+            time.sleep(DOOR_POLL_INTERVAL)
+
+    def sync_door_state(self):
+        # Read the switch and publish an event if it no longer matches 
+        # the debounced state. Also called periodically by the system
+        # monitor in case an edge was swallowed by the hardware debounce.
+        try:
+            self.publish_door_state(self.read_door_sensor())
+        except Exception as e:
+            hardware_errors.inc(compartment=self.compartment_id, operation='door_read')
+            logger.error(f"Error reading door sensor: {e}")
+            record_error(f"Compartment {self.compartment_id}: error reading door sensor: {e}", "door")
+
+    def publish_door_state(self, closed):
+        with self.door_condition:
+            if closed == self.door_closed: # Not a real transition
+                return
+            self.door_closed = closed
+            self.door_changed_at = time.time()
+            door_closed_gauge.set(int(closed), compartment=self.compartment_id)
+            event = {'compartment': self.compartment_id, 'closed': closed,
+            'timestamp': self.door_changed_at}
+            self.door_events.append(event)
+            self.door_condition.notify_all() # Wake wait_for_door()
+            listeners = list(self.door_listeners)
+        logger.info(f"Compartment {self.compartment_id}: door {'closed' if closed else 'opened'}.")
+        for listener in listeners: # Called outside the condition so a
+            # slow listener cannot block the sensor
+            try:
+                listener(event)
+            except Exception as e:
+                logger.error(f"Door event listener failed: {e}")
+
+    def subscribe_door(self, listener):
+        # listener(event) is called with {'compartment', 'closed', 
+        # 'timestamp'} on every debounced door transition.
+        with self.door_condition:
+            self.door_listeners.append(listener)
+
+    def wait_for_door(self, closed, timeout=None):
+        # Block until the door reaches the requested state or timeout 
+        # seconds pass (None waits forever). Returns True if the state
+        # was reached.
+        with self.door_condition:
+            return self.door_condition.wait_for(lambda: self.door_closed == closed, timeout)
+
+    def last_door_event(self):
+        with self.door_condition:
+            return self.door_events[-1] if self.door_events else None
 
     def setup_gpio(self):
         try:
-            GPIO.setup(LOCK_PIN, GPIO.OUT) # Lock GPIO pin configured 
+            self.gpio.setup(self.lock_pin, self.gpio.OUT) # Lock GPIO pin configured 
             # as an output pin
-            GPIO.output(LOCK_PIN, GPIO.HIGH) # The pin is initially
+            self.gpio.output(self.lock_pin, self.gpio.HIGH) # The pin is initially
             # set to HIGH and a HIGH signal disengages the lock, 
             # therefore, lock is unlocked at startup
 
-            GPIO.setup(DOOR_SENSOR_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)# Door MAG reed sensor GPIO pin  
+            self.gpio.setup(self.door_pin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)# Door MAG reed sensor GPIO pin  
             # configured as an input pin with the the internal pull-up
             # resistor active
             logger.info("GPIO pins for lock and door sensor set up successfully.") # Success log
@@ -167,117 +1424,497 @@ class HardwareController:
 
     def lock_door(self):
         try:
-            GPIO.output(LOCK_PIN, GPIO.LOW)  # Lock engaged (locked)
-            logger.info("The door is currently LOCKED.") # Success log
-            update_system_state('door_status', 'Locked') # State change
+            with hardware_seconds.time(compartment=self.compartment_id, operation='lock'):
+                self.gpio.output(self.lock_pin, self.gpio.LOW)  # Lock engaged (locked)
+            logger.info(f"Compartment {self.compartment_id}: the door is currently LOCKED.") # Success log
+            update_compartment_state(self.compartment_id, 'door_status', 'Locked') # State change
         except Exception as e:
+            hardware_errors.inc(compartment=self.compartment_id, operation='lock')
             logger.error(f"Error locking door: {e}")
-            with state_lock: # Lock Thread event for single data append
-                system_state['error_logs'].append(f"Error locking door: {e}")
+            record_error(f"Compartment {self.compartment_id}: error locking door: {e}", "lock")
 
     def unlock_door(self):
         try:
-            GPIO.output(LOCK_PIN, GPIO.HIGH)# Lock disengaged (unlocked)
-            logger.info("The door is currently UNLOCKED.")# Success log
-            update_system_state('door_status', 'Unlocked')# State change
+            with hardware_seconds.time(compartment=self.compartment_id, operation='unlock'):
+                self.gpio.output(self.lock_pin, self.gpio.HIGH)# Lock disengaged (unlocked)
+            logger.info(f"Compartment {self.compartment_id}: the door is currently UNLOCKED.")# Success log
+            update_compartment_state(self.compartment_id, 'door_status', 'Unlocked')# State change
         except Exception as e:
+            hardware_errors.inc(compartment=self.compartment_id, operation='unlock')
             logger.error(f"Error unlocking door: {e}")
-            with state_lock:# Lock Thread event for single data append
-                system_state['error_logs'].append(f"Error unlocking door: {e}")
+            record_error(f"Compartment {self.compartment_id}: error unlocking door: {e}", "lock")
 
     def is_door_closed(self):
-        try:
-            return GPIO.input(DOOR_SENSOR_PIN) == GPIO.LOW # Boolean 
-            # returned to check if the lock is engaged (locked state)
-        except Exception as e:
-            logger.error(f"Error reading door sensor: {e}")
-            with state_lock:# Lock Thread event for single data append
-                system_state['error_logs'].append(f"Error reading door sensor: {e}")
-            return False
+        # Debounced door state kept up to date by the door events, so 
+        # this does not touch the GPIO pin
+        with hardware_seconds.time(compartment=self.compartment_id, 
+        operation='is_door_closed'), self.door_condition:
+            return self.door_closed
 
     def read_weight(self):
-        try:
-            weight = self.hx711.get_weight(5) # the weight value is an 
-            # average of 5 measurements for better accuracy
-            self.hx711.power_down() # Power down and power up of load
-            # cells between readings to save power
-            self.hx711.power_up()
-            weight = max(weight, 0.0)  # Ensures that the weight value 
-            # from the load cells cannot be negative.
-            logger.debug(f"Actual weight: {weight:.2f} kg") # This line 
-            # of code is only for development debug purposes and will 
-            # only be logged if LEVEL changed from INFO to DEBUG
-            return weight
-        except Exception as e:
-            logger.error(f"Error reading weight: {e}")
-            with state_lock:
-                system_state['error_logs'].append(f"Error reading weight: {e}")
-            return 0.0 # Value of zero returned when there is an issue
-            # reading the weight value
+        # Latest filtered weight from the sampling thread. This returns
+        # immediately and never touches the HX711.
+        with hardware_seconds.time(compartment=self.compartment_id, operation='read_weight'):
+            weight, _ = self.latest_weight()
+        logger.debug(f"Actual weight: {weight:.2f} kg") # This line 
+        # of code is only for development debug purposes and will 
+        # only be logged if LEVEL changed from INFO to DEBUG
+        return weight
 
     def cleanup(self):
         try:
-            GPIO.cleanup() # GPIO pins are taken back to default states
+            self.gpio.cleanup() # GPIO pins are taken back to default states
             logger.info("GPIO cleanup successful.")
         except Exception as e:
             logger.error(f"Error during GPIO cleanup: {e}")
 
+# Compartment Registry Class
+class CompartmentRegistry:
+    # Maps every compartment ID to the HardwareController driving its
+    # lock, door sensor and load cell channel.
+    def __init__(self, config=COMPARTMENTS):
+        self.config = config # Compartment ID -> pin numbers
+        self.controllers_by_id = {}
+
+    def setup(self):
+        # Controllers are created concurrently as each one may have to 
+        # tare its load cell, which takes a while per channel.
+        with ThreadPoolExecutor(max_workers=len(self.config)) as pool:
+            futures = {compartment_id: pool.submit(HardwareController, compartment_id, **pins)
+            for compartment_id, pins in self.config.items()}
+        for compartment_id, future in futures.items():
+            self.controllers_by_id[compartment_id] = future.result()
+        logger.info(f"{len(self.controllers_by_id)} compartment(s) set up.")
+
+    def get(self, compartment_id):
+        return self.controllers_by_id[compartment_id]
+
+    def ids(self):
+        return list(self.controllers_by_id)
+
+    def controllers(self):
+        return list(self.controllers_by_id.values())
+
+    def __len__(self):
+        return len(self.controllers_by_id)
+
+    def cleanup(self):
+        # All compartments share the GPIO library so cleaning up once 
+        # frees every pin
+        if self.controllers_by_id:
+            self.controllers()[0].cleanup()
+
+# Sensor Scheduler Class
+class SensorScheduler:
+    # Samples the load cell of every compartment at a fixed rate. Each
+    # tick submits one sample per compartment to a thread pool, so the 
+    # HX711 channels (which sit on separate pins) are read concurrently 
+    # and the per-compartment update interval stays the same however many
+    # compartments there are. Door sensors are interrupt driven and are 
+    # only re-synced every door_sync_interval seconds as a safety net.
+    def __init__(self, registry, interval=WEIGHT_SAMPLE_INTERVAL, 
+    door_sync_interval=1.0):
+        self.registry = registry
+        self.interval = interval # Seconds between samples of a channel
+        self.door_sync_interval = door_sync_interval
+        self.pool = ThreadPoolExecutor(max_workers=max(1, len(registry)))
+        self.stop_event = Event()
+        self.thread = None
+        self.last_tick_duration = 0.0 # Seconds the last tick took
+        self.overruns = 0 # Ticks that took longer than interval
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        logger.info(f"Sensor scheduler started for {len(self.registry)} compartment(s).")
+
+    def run(self):
+        next_tick = time.monotonic()
+        last_door_sync = next_tick
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            controllers = self.registry.controllers()
+            futures = [self.pool.submit(controller.sample_weight) for controller in controllers]
+            if started - last_door_sync >= self.door_sync_interval:
+                futures += [self.pool.submit(controller.sync_door_state) for controller in controllers]
+                last_door_sync = started
+            wait(futures) # Tick ends when every channel was read
+            self.last_tick_duration = time.monotonic() - started
+
+            next_tick += self.interval # Fixed rate, not fixed delay
+            delay = next_tick - time.monotonic()
+            if delay < 0: # Sampling took longer than the interval
+                self.overruns += 1
+                logger.debug(f"Sensor tick overran by {-delay:.3f}s")
+                next_tick = time.monotonic()
+                delay = 0
+            self.stop_event.wait(delay)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+        self.pool.shutdown(wait=False)
+
+# Weight Verification Class
+class WeightVerifier:
+    # Decides from the sliding window of load cell samples whether the
+    # platform has settled. Outliers are rejected using the median 
+    # absolute deviation, then the spread (standard deviation) and the
+    # trend (least squares slope in kg/s) of the remaining samples are 
+    # compared with their limits. A settled window is reported with the
+    # mean weight and a confidence between 0 and 1, so placement and 
+    # buyer verification can finish as soon as the reading is stable
+    # instead of after a fixed number of reads.
+    def __init__(self, hardware, window=SETTLE_WINDOW, 
+    max_stddev=SETTLE_MAX_STDDEV, max_slope=SETTLE_MAX_SLOPE):
+        self.hardware = hardware # Source of the weight samples
+        self.window = window
+        self.max_stddev = max_stddev
+        self.max_slope = max_slope
+
+    def assess(self, samples=None):
+        # Judge a list of (timestamp, weight) samples, by default the 
+        # newest window of samples from the hardware.
+        if samples is None:
+            samples = self.hardware.weight_history(self.window)
+        if len(samples) < self.window:
+            return {'settled': False, 'weight': None, 'confidence': 0.0,
+            'stddev': None, 'slope': None, 'rejected': 0,
+            'message': "Still settling: not enough samples."}
+
+        # Outlier rejection using the robust z-score 
+        # 0.6745 * |w - median| / MAD
+        weights = [w for _, w in samples]
+        median = statistics.median(weights)
+        mad = statistics.median([abs(w - median) for w in weights])
+        if mad > 0:
+            kept = [(t, w) for t, w in samples 
+            if 0.6745 * abs(w - median) / mad <= SETTLE_OUTLIER_LIMIT]
+        else: # Most samples are identical, keep those close to them
+            kept = [(t, w) for t, w in samples 
+            if abs(w - median) <= self.max_stddev]
+        rejected = len(samples) - len(kept)
+
+        kept_weights = [w for _, w in kept]
+        mean = statistics.fmean(kept_weights)
+        stddev = statistics.pstdev(kept_weights)
+        slope = self.slope(kept)
+
+        # Each check gives a score of 1 when perfect and 0 at its limit
+        noise_score = max(0.0, 1 - stddev / self.max_stddev)
+        trend_score = max(0.0, 1 - abs(slope) / self.max_slope)
+        kept_score = len(kept) / len(samples)
+        confidence = min(noise_score, trend_score) * kept_score
+        settled = (stddev <= self.max_stddev and abs(slope) <= self.max_slope
+        and len(kept) * 2 >= len(samples)) # At most half may be outliers
+
+        weight = max(mean, 0.0)
+        if settled:
+            message = f"Settled at {weight:.3f} kg with confidence {confidence:.2f}."
+        else:
+            message = f"Still settling: spread {stddev:.3f} kg, trend {slope:.3f} kg/s."
+        return {'settled': settled, 'weight': weight, 'confidence': confidence,
+        'stddev': stddev, 'slope': slope, 'rejected': rejected, 'message': message}
+
+    def slope(self, samples):
+        # Least squares slope of weight against time in kg/s
+        times = [t for t, _ in samples]
+        weights = [w for _, w in samples]
+        mean_t = statistics.fmean(times)
+        mean_w = statistics.fmean(weights)
+        spread_t = sum((t - mean_t) ** 2 for t in times)
+        if spread_t == 0:
+            return 0.0
+        return sum((t - mean_t) * (w - mean_w) for t, w in samples) / spread_t
+
+    def wait_until_settled(self, timeout=None, condition=None):
+        # Assess every new sample until the weight has settled (and, if
+        # given, condition(weight) is True) or timeout seconds pass. The
+        # last assessment is returned either way.
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            result = self.assess()
+            if result['settled'] and (condition is None or condition(result['weight'])):
+                return result
+            if deadline is not None and time.time() >= deadline:
+                return result
+            time.sleep(WEIGHT_SAMPLE_INTERVAL)
+
 # OTP Managerment Class
 class OTPManager:
-    def __init__(self, secret_key, valid_duration=OTP_TIMEOUT): 
-        self.secret_key = secret_key # Key to synchronise the OTPs btw 
-        # system and the user
+    # Every transaction gets its own random OTP. Only an HMAC of the OTP
+    # and the transaction ID, keyed with OTP_SECRET, is kept in the 
+    # transaction record, so an OTP opens only the compartment of its 
+    # own transaction and the journal does not give the OTPs away.
+    def __init__(self, secret_key, valid_duration=OTP_TIMEOUT, 
+    length=OTP_LENGTH): 
+        self.secret_key = secret_key.encode() # Key of the OTP hashes
         self.valid_duration = valid_duration # Time in seconds that OTP
         # is valid
-        self.totp = pyotp.TOTP(self.secret_key, interval=self.valid_duration) # instance of pyotp.TOTP class 
-        # that takes in a secret key and a time in seconds and makes an
-        # OTP
-        
-        self.otp_creation_time = None # Showcases that no OTP created 
-        # yet as there is no timestamp
+        self.length = length # Number of digits typed on the keypad
         logger.info("OTPManager initialized.")
 
-    def generate_otp(self):
-        self.otp_creation_time = time.time() # Saving current time step
-        # for OTP gen tracking
-        otp = self.totp.now() # Collection of current OTP
-        logger.info(f"OTP generated: {otp}")
-        return otp
-
-    def verify_otp(self, otp_entered): # Purpose of this method is to
-        # cross check the user inputted OTP and the OTP of the system
-        # to ensure that these two match.
-        if self.is_otp_expired(): # expired OTP method below
+    def generate_otp(self, transaction_id):
+        # New OTP for one transaction. Returns the OTP, which is only 
+        # sent to the buyer, and the fields to store in the transaction
+        # record: the OTP's hash and the time it was issued.
+        otp = ''.join(secrets.choice(string.digits) for _ in range(self.length))
+        logger.info(f"OTP generated for transaction {transaction_id}.")
+        return otp, {'otp_hash': self.hash_otp(transaction_id, otp), 
+        'otp_created_at': time.time()}
+
+    def generate_reclaim_code(self, transaction_id):
+        # Code the seller gives to /kiosk/reclaim to take back an 
+        # uncollected item. It is only sent to the seller and does not 
+        # expire. Returns the code and the field to store in the record.
+        code = ''.join(secrets.choice(string.ascii_uppercase + string.digits) 
+        for _ in range(RECLAIM_CODE_LENGTH))
+        logger.info(f"Reclaim code generated for transaction {transaction_id}.")
+        return code, {'reclaim_hash': self.hash_otp(f"reclaim:{transaction_id}", code)}
+
+    def verify_reclaim_code(self, code, record):
+        if not record.get('reclaim_hash') or not code:
+            return False
+        return hmac.compare_digest(record['reclaim_hash'], 
+        self.hash_otp(f"reclaim:{record['transaction_id']}", code))
+
+    def hash_otp(self, transaction_id, otp):
+        return hmac.new(self.secret_key, f"{transaction_id}:{otp}".encode(), 
+        hashlib.sha256).hexdigest()
+
+    def verify_otp(self, otp_entered, record): # Purpose of this method
+        # is to cross check the user inputted OTP against the OTP issued
+        # for the transaction record
+        if self.is_otp_expired(record['otp_created_at']): # expired OTP 
+            # method below
             logger.warning("OTP verification failed: OTP expired.")
             return False # Verification unsuccessful if OTP had already
             # expired.
-        result = self.totp.verify(otp_entered, valid_window=1)
-        # verify() method checks whether system OTP from pyotp.TOTP is 
-        # the same as entered otp allowing a small clock window of 1s 
-        # in checking the validity
-        logger.info(f"OTP verification result: {result}")
+        if not record.get('otp_hash') or otp_entered is None:
+            return False
+        result = hmac.compare_digest(record['otp_hash'], 
+        self.hash_otp(record['transaction_id'], otp_entered)) # Constant 
+        # time comparison so the timing gives nothing away
+        logger.info(f"OTP verification result for transaction {record['transaction_id']}: {result}")
         return result
 
-    def is_otp_expired(self): # This method checks if the OTP has
-        # expired by checking the current time and subtracting the time
-        # when the OTP was created and making sure that if that time is 
-        # greater than the allowed validity time of the OTP then the OTP
-        # has expired.
-        if self.otp_creation_time is None:
+    def is_otp_expired(self, created_at): # This method checks if the 
+        # OTP has expired by checking the current time and subtracting 
+        # the time when the OTP was created and making sure that if that
+        # time is greater than the allowed validity time of the OTP then
+        # the OTP has expired.
+        if created_at is None:
             return True #The OTP is set as expired if it was never
             #created
-        expired = ((time.time() - self.otp_creation_time) > 
+        expired = ((time.time() - created_at) > 
         self.valid_duration)
         if expired:
             logger.info("OTP has expired.")
         return expired
 
+# Transaction Store Class
+ACTIVE_STATUSES = ('listing', 'awaiting_pickup', 'awaiting_payment') # A
+# transaction in one of these statuses still needs its compartment or 
+# the payment tracker. The other statuses are 'completed', 
+# 'payment_failed', 'uncollected' and 'cancelled'.
+
+# Transaction Journal Class
+class TransactionJournal:
+    # Durable record of transactions and state changes in an embedded
+    # SQLite database in WAL (write-ahead log) mode. Every change is a 
+    # small single-row write appended to the log, so a power cut can at
+    # worst lose the change being written but never corrupts earlier 
+    # ones, and nothing is rewritten as a whole. At boot the journal is
+    # read back so in-flight transactions can be resumed.
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.lock = Lock() # One writer at a time on the shared connection
+        self.connection = sqlite3.connect(path, check_same_thread=False,
+        isolation_level=None) # isolation_level None means every 
+        # statement is committed on its own
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL") # Each commit 
+        # is on disk before the call returns
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS transactions ("
+            "transaction_id TEXT PRIMARY KEY, status TEXT NOT NULL, "
+            "compartment TEXT, buyer_address TEXT, record TEXT NOT NULL, "
+            "updated_at REAL NOT NULL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS transactions_status ON transactions (status)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)")
+        logger.info(f"Transaction journal opened at {path}.")
+
+    def save_transaction(self, record):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?, ?)",
+                (record['transaction_id'], record['status'], record['compartment'],
+                record['buyer_address'], json.dumps(record), record['updated_at']))
+
+    def save_state(self, key, value):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time()))
+
+    def load_transactions(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT record FROM transactions ORDER BY updated_at").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def load_state(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT key, value FROM state").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class TransactionStore:
+    # Holds one record (a dictionary) per transaction keyed by its 
+    # transaction ID, with indexes by status, compartment and buyer 
+    # address. Several listings can therefore be listed, awaiting pickup
+    # or awaiting payment at the same time and every lookup stays O(1)
+    # as the history grows. Copies are returned so callers never hold a
+    # record that another thread is changing.
+    INDEXED_FIELDS = ('status', 'compartment', 'buyer_address')
+
+    def __init__(self, journal=None):
+        self.records = {} # Transaction ID -> record
+        self.indexes = {field: {} for field in self.INDEXED_FIELDS} # 
+        # Field -> value -> set of transaction IDs
+        self.journal = journal # Every change is written through to it
+        self.lock = Lock()
+
+    def index_key(self, field, value):
+        # Ethereum addresses are compared case-insensitively
+        if field == 'buyer_address' and isinstance(value, str):
+            return value.lower()
+        return value
+
+    def add_to_indexes(self, record):
+        for field in self.INDEXED_FIELDS:
+            key = self.index_key(field, record.get(field))
+            self.indexes[field].setdefault(key, set()).add(record['transaction_id'])
+
+    def remove_from_indexes(self, record):
+        for field in self.INDEXED_FIELDS:
+            key = self.index_key(field, record.get(field))
+            ids = self.indexes[field].get(key)
+            if ids is not None:
+                ids.discard(record['transaction_id'])
+                if not ids:
+                    del self.indexes[field][key]
+
+    def create(self, transaction_id, compartment, **fields):
+        now = time.time()
+        record = {
+            'transaction_id': transaction_id,
+            'status': 'listing',
+            'compartment': compartment, # Compartment holding the item
+            'buyer_address': None,
+            'item_name': None,
+            'description': None,
+            'advertised_weight': None,
+            'item_price': None, # Price in Rands
+            'image_path': None,
+            'otp_hash': None, # Keyed hash of the buyer's OTP
+            'reclaim_hash': None, # Keyed hash of the seller's reclaim 
+            # code, set once the item is uncollected
+            'otp_created_at': None, # When the buyer's OTP was issued
+            'payment_job_id': None, # Job ID from /trigger_payment
+            'created_at': now,
+            'updated_at': now,
+        }
+        record.update(fields)
+        with self.lock:
+            if transaction_id in self.records:
+                raise ValueError(f"Transaction {transaction_id} already exists.")
+            self.records[transaction_id] = record
+            self.add_to_indexes(record)
+            self.write_through(record)
+        logger.info(f"Transaction {transaction_id} created in compartment {compartment}.")
+        return dict(record)
+
+    def update(self, transaction_id, **fields):
+        with self.lock:
+            record = self.records[transaction_id]
+            self.remove_from_indexes(record)
+            record.update(fields)
+            record['updated_at'] = time.time()
+            self.add_to_indexes(record)
+            self.write_through(record) # Under the store lock so the 
+            # journal sees the changes in the same order
+            updated = dict(record)
+        if 'status' in fields:
+            logger.info(f"Transaction {transaction_id} is now {fields['status']}.")
+            if fields['status'] not in ACTIVE_STATUSES: # Final status
+                tracer.finish(transaction_id)
+        return updated
+
+    def write_through(self, record):
+        if self.journal is None:
+            return
+        try:
+            self.journal.save_transaction(record)
+        except Exception as e:
+            logger.error(f"Failed to journal transaction {record['transaction_id']}: {e}")
+
+    def restore(self, record):
+        # Add a record read back from the journal without rewriting it
+        with self.lock:
+            self.records[record['transaction_id']] = dict(record)
+            self.add_to_indexes(record)
+
+    def get(self, transaction_id):
+        with self.lock:
+            record = self.records.get(transaction_id)
+            return dict(record) if record is not None else None
+
+    def __contains__(self, transaction_id):
+        with self.lock:
+            return transaction_id in self.records
+
+    def find(self, status=None, compartment=None, buyer_address=None):
+        # Records matching every given field, oldest first. Each field is
+        # looked up in its index and the ID sets are intersected.
+        criteria = {'status': status, 'compartment': compartment, 
+        'buyer_address': buyer_address}
+        with self.lock:
+            ids = None
+            for field, value in criteria.items():
+                if value is None:
+                    continue
+                matches = self.indexes[field].get(self.index_key(field, value), set())
+                ids = set(matches) if ids is None else ids & matches
+            if ids is None:
+                ids = set(self.records)
+            found = [dict(self.records[transaction_id]) for transaction_id in ids]
+        return sorted(found, key=lambda record: record['created_at'])
+
+    def find_active(self, compartment=None):
+        # Records that are not finished yet
+        found = []
+        for status in ACTIVE_STATUSES:
+            found += self.find(status=status, compartment=compartment)
+        return sorted(found, key=lambda record: record['created_at'])
+
+    def all(self):
+        return self.find()
+
 # Flask Web Server Class 
 class FlaskServer(Thread): # Thread class inheritance
     # This class is responsible for serving an HTML interface and a JSON
     # API which can then be used to integrate the system with a
     # Blockchain system. The server is ran in a separate thread.
-    def __init__(self, app, host='0.0.0.0', port=5000):
+    def __init__(self, app, host='0.0.0.0', port=FLASK_PORT):
         Thread.__init__(self) # Calling constructor of Thread class to 
         # initialise it properly
         self.daemon = True # daemon thread implies that server thread 
@@ -288,39 +1925,381 @@ class FlaskServer(Thread): # Thread class inheritance
         # all network interfaces. Therefore, external devices can access
         # the system which is cruciaL!
         self.port = port # Port specification on where server runs
+        # The socket is bound here, in the caller's thread, so startup
+        # knows the port is open (or fails with the reason) before the 
+        # server thread starts. Same threaded server as app.run() uses.
+        self.server = make_server(self.host, self.port, self.app, threaded=True)
+        logger.info(f"Flask web server bound to {self.host}:{self.server.server_port}.")
 
     def run(self):
         logger.info("Starting Flask web server.")
-        self.app.run(host=self.host, port=self.port, debug=False, 
-        use_reloader=False) #app.run() starts server when thread starts
-        # debug turned off because function is used for development
-        # purposes. Similarly with use_reloader as this is a development
-        # tool that causes the flask server change in real-time with 
-        # code-changes.
+        self.server.serve_forever() # Serves until shutdown()
+
+    def shutdown(self):
+        self.server.shutdown()
 
 
 app = Flask(__name__) # Flask application instance creation
 
+@app.before_request
+def start_request_timer():
+    request.environ['blockbox.start'] = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    # Record how long the endpoint took, labelled by its route rather 
+    # than the URL so IDs in the path do not create new label values
+    start = request.environ.get('blockbox.start')
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_request_seconds.observe(time.perf_counter() - start, 
+        endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.before_request
+def start_request_span():
+    # Requests sent with a TRACE_HEADER (the GUI's calls) become a span
+    # of the transaction, so the time spent in the API shows up in its
+    # timeline next to the GUI steps.
+    span = tracer.from_header(request.headers.get(TRACE_HEADER), 
+    f"{request.method} {request.path}")
+    if span is not None:
+        tracer.push(span) # RPC calls made by the endpoint are children
+        request.environ['blockbox.span'] = span
+
+@app.teardown_request
+def end_request_span(error=None):
+    span = request.environ.pop('blockbox.span', None)
+    if span is not None:
+        tracer.pop(span)
+        span.end(error)
+
+@app.route('/traces') # Transactions with a recorded timeline
+def get_traces():
+    return jsonify({'transactions': tracer.recent()}), 200
+
+@app.route('/traces/<transaction_id>') # Timeline of one transaction
+def get_trace(transaction_id):
+    timeline = tracer.timeline(transaction_id)
+    if timeline is None:
+        return jsonify({'message': 'No trace for this transaction'}), 404
+    return jsonify(timeline), 200
+
+@app.route('/metrics') # Prometheus scrape endpoint
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/') # This is the root URL definition of the web server
 def index():
-    with state_lock: # thread-safe access to modify system state
-        return render_template('index.html', system_state=system_state)
-        # The current system_state is passed to the .html template in 
-        # the templates folder which lies in the project directory. Note
-        # that system_state is essentially a database carrying system 
-        # information
+    # The current system_state is passed to the .html template in the 
+    # templates folder which lies in the project directory. Note that 
+    # system_state is essentially a database carrying system information
+    return render_template('index.html', system_state=state_store.snapshot().data)
 
 @app.route('/system_state') # Route to an endpoint 
 def get_system_state():
     #Provide the system state in JSON format.
-    with state_lock:
-        return jsonify(system_state) # State of the system converted to
-        # JSON which is useful for APIs and/or blockchain based systems 
-        # to fetch the data and be able to use it.
+    # State of the system converted to JSON which is useful for APIs 
+    # and/or blockchain based systems to fetch the data and be able to 
+    # use it. The snapshot is immutable so no lock is held while it is
+    # serialised (once per version) and sent.
+    snapshot = state_store.snapshot()
+    return Response(snapshot.to_json(), mimetype='application/json')
+
+@app.route('/errors', methods=['GET']) # Recent error log entries
+def get_errors():
+    # Paginated: /errors?after=<seq> returns the entries newer than seq,
+    # a client passes the 'next' value back to get the following page
+    try:
+        after = int(request.args.get('after', 0))
+        limit = min(int(request.args.get('limit', ERROR_PAGE_SIZE)), ERROR_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'message': 'after and limit must be integers'}), 400
+    entries, missed = error_log.page(after, max(limit, 1))
+    return jsonify({
+        'errors': entries,
+        'next': entries[-1]['seq'] if entries else max(after, 0),
+        'latest': error_log.latest(),
+        'missed': missed # Entries dropped before they were read
+    }), 200
+
+@app.route('/events') # Server-Sent Events stream of system state changes
+def stream_events():
+    # The first event is a full snapshot of the state, after that only 
+    # the keys that changed are sent. Nothing is sent while the system
+    # is idle apart from a keep-alive comment.
+    subscriber = state_events.subscribe() # Before the snapshot so no
+    # change is missed in between
+    snapshot = state_store.snapshot()
+
+    def generate():
+        try:
+            yield f"event: snapshot\nid: {snapshot.version}\ndata: {snapshot.to_json()}\n\n"
+            while True:
+                try:
+                    event = subscriber.get(timeout=EVENT_KEEPALIVE_INTERVAL)
+                except Empty:
+                    event = ": keep-alive"
+                if event is None: # Dropped for falling behind, the 
+                    # browser reconnects and gets a new snapshot
+                    return
+                yield f"{event}\n\n"
+        finally: # Runs when the client disconnects
+            state_events.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Price Oracle Class
+class PriceOracle:
+    # Process-wide in-memory store of the quotes needed to price an item
+    # (ETH/USD and USD/ZAR). A quote is fetched on first use, refreshed
+    # in the background every ttl seconds and, when a caller finds it
+    # older than ttl, the cached value is returned straight away while a
+    # refresh runs in another thread (stale-while-revalidate). This way
+    # a slow or failing upstream only delays or fails a payment once
+    # the quote is older than max_stale.
+    def __init__(self, ttl=PRICE_CACHE_TTL, max_stale=PRICE_MAX_STALE):
+        self.ttl = ttl # Seconds a quote is considered fresh
+        self.max_stale = max_stale # Seconds a quote may still be served
+        self.quotes = {} # Quote name -> (value, time it was fetched)
+        self.fetchers = {} # Quote name -> function fetching the quote
+        self.refreshing = set() # Names with a background refresh running
+        self.lock = Lock() # Guards the three containers above
+        self.stop_event = Event() # Set to stop the refresh thread
+        self.thread = None
+
+    def get(self, name, fetcher):
+        # Return the quote called name, using fetcher to (re)load it.
+        with self.lock:
+            self.fetchers[name] = fetcher # Latest fetcher is kept for
+            # the background refresh
+            quote = self.quotes.get(name)
+
+        if quote is None: # Never fetched so the caller has to wait
+            return self.refresh(name)
+
+        value, fetched_at = quote
+        age = time.time() - fetched_at
+        if age <= self.ttl: # Fresh quote
+            return value
+        if age <= self.max_stale: # Stale but usable, serve it and
+            # revalidate in the background
+            self.refresh_in_background(name)
+            return value
+        logger.warning(f"{name} quote is {age:.0f}s old, refreshing before use.")
+        return self.refresh(name) # Too old to serve, wait on upstream
+
+    def is_fresh(self, name):
+        # True if the quote exists and is younger than ttl
+        age = self.age(name)
+        return age is not None and age <= self.ttl
+
+    def put(self, name, value, fetcher):
+        # Store a quote that was fetched by the caller, e.g. as part of a
+        # batch request, together with the fetcher for later refreshes.
+        with self.lock:
+            self.fetchers[name] = fetcher
+            self.quotes[name] = (value, time.time())
+
+    def refresh(self, name):
+        # Fetch the quote from upstream and store it with its timestamp.
+        with self.lock:
+            fetcher = self.fetchers[name]
+        value = fetcher()
+        with self.lock:
+            self.quotes[name] = (value, time.time())
+        logger.debug(f"{name} quote refreshed: {value}")
+        return value
+
+    def refresh_in_background(self, name):
+        with self.lock:
+            if name in self.refreshing: # One refresh per quote at a time
+                return
+            self.refreshing.add(name)
+        Thread(target=self.background_refresh, args=(name,), daemon=True).start()
+
+    def background_refresh(self, name):
+        try:
+            self.refresh(name)
+        except Exception as e: # The cached quote keeps being served
+            logger.warning(f"Background refresh of {name} quote failed: {e}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(name)
+
+    def age(self, name):
+        # Seconds since the quote was fetched, None if never fetched.
+        with self.lock:
+            quote = self.quotes.get(name)
+        if quote is None:
+            return None
+        return time.time() - quote[1]
+
+    def ages(self):
+        # Age of every cached quote, used to report how old the prices
+        # behind an ETH amount were.
+        with self.lock:
+            names = list(self.quotes)
+        return {name: self.age(name) for name in names}
+
+    def start(self):
+        # Start the thread that keeps every known quote refreshed.
+        if self.thread is not None:
+            return
+        self.thread = Thread(target=self.refresh_loop, daemon=True)
+        self.thread.start()
+        logger.info(f"Price oracle started with a {self.ttl}s refresh interval.")
+
+    def refresh_loop(self):
+        while not self.stop_event.wait(self.ttl): # Wakes every ttl
+            # seconds until stop_event is set
+            with self.lock:
+                names = list(self.fetchers)
+            for name in names:
+                self.refresh_in_background(name)
+
+    def stop(self):
+        self.stop_event.set()
+
+price_oracle = PriceOracle() # Shared by every BlockchainIntegration
+
+# Chainlink Price Feed Class
+class PriceFeed:
+    # Wrapper around one Chainlink AggregatorV3 contract. The contract 
+    # object is built once and the results of view functions that never
+    # change for a deployed feed (decimals, description, version) are
+    # kept after their first call, leaving latestRoundData() as the only
+    # call that needs the network.
+    def __init__(self, web3_client, address):
+        from web3 import Web3
+        self.address = Web3.to_checksum_address(address)
+        self.contract = web3_client.eth.contract(address=self.address, abi=AGGREGATOR_V3_ABI)
+        self.static_values = {} # Function name -> memoised result
+        self.lock = Lock()
+
+    def is_cached(self, name):
+        with self.lock:
+            return name in self.static_values
+
+    def remember(self, name, value):
+        # Store the result of an immutable call made elsewhere (e.g. in a
+        # batch request)
+        with self.lock:
+            self.static_values[name] = value
+
+    def static_call(self, name):
+        with self.lock:
+            if name in self.static_values:
+                return self.static_values[name]
+        value = getattr(self.contract.functions, name)().call()
+        self.remember(name, value)
+        return value
+
+    def decimals(self):
+        return self.static_call('decimals')
+
+    def description(self):
+        return self.static_call('description')
+
+    def version(self):
+        return self.static_call('version')
+
+    def latest_round_data(self):
+        return self.contract.functions.latestRoundData().call()
+
+# Nonce Manager Class
+class NonceManager:
+    # Tracks the next nonce of every sending account in memory. The node
+    # is only asked for the account's 'pending' transaction count the 
+    # first time the account sends and after resync(), which is called
+    # whenever a send fails or a sent transaction is not mined. Nonces
+    # handed out back to back let several signed transactions be
+    # broadcast without waiting for earlier receipts.
+    def __init__(self, web3_client):
+        self.web3 = web3_client
+        self.next_nonces = {} # Account address -> next unused nonce
+        self.lock = Lock() # Two threads never get the same nonce
+
+    def allocate(self, address):
+        with self.lock:
+            if address not in self.next_nonces:
+                # 'pending' includes transactions still in the mempool
+                self.next_nonces[address] = self.web3.eth.get_transaction_count(address, 'pending')
+            nonce = self.next_nonces[address]
+            self.next_nonces[address] = nonce + 1
+        logger.debug(f"Allocated nonce {nonce} for {address}")
+        return nonce
+
+    def resync(self, address):
+        # Forget the cached nonce so the next allocation asks the node
+        with self.lock:
+            self.next_nonces.pop(address, None)
+        logger.info(f"Nonce for {address} will be resynced with the node.")
+
+def create_http_session(pool_size=HTTP_POOL_SIZE):
+    # A requests Session keeps TCP/TLS connections alive between calls so
+    # only the first request to a host pays for the handshake. The pool
+    # is bounded and pool_block makes extra threads wait for a free
+    # connection instead of opening new ones.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+    pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+@functools.lru_cache(maxsize=None)
+def instrumented_http_provider():
+    # The provider class is built on first use as it subclasses web3's
+    # HTTPProvider and web3 is only imported then.
+    from web3 import HTTPProvider
+
+    class InstrumentedHTTPProvider(HTTPProvider):
+        # HTTPProvider that records the duration and failures of every 
+        # JSON-RPC request sent to the node, per RPC method.
+        def make_request(self, method, params):
+            span = tracer.child(f"rpc {method}") # Only inside a transaction
+            start = time.perf_counter()
+            try:
+                response = super().make_request(method, params)
+            except Exception as e:
+                rpc_errors.inc(method=method)
+                if span is not None:
+                    span.end(e)
+                raise
+            finally:
+                rpc_seconds.observe(time.perf_counter() - start, method=method)
+            if span is not None:
+                span.end()
+            if isinstance(response, dict) and 'error' in response:
+                rpc_errors.inc(method=method)
+            return response
+
+        def make_batch_request(self, batch_requests):
+            span = tracer.child("rpc batch", methods=[method for method, _ in batch_requests])
+            start = time.perf_counter()
+            try:
+                response = super().make_batch_request(batch_requests)
+            except Exception as e:
+                rpc_errors.inc(method='batch')
+                if span is not None:
+                    span.end(e)
+                raise
+            finally:
+                rpc_seconds.observe(time.perf_counter() - start, method='batch')
+            if span is not None:
+                span.end()
+            return response
+
+    return InstrumentedHTTPProvider
 
 # Blockchain Integration
 class BlockchainIntegration:
-    def __init__(self):
+    def __init__(self, session=None, provider=None, chain_id=CHAIN_ID):
+        # provider - Web3 provider to use instead of Infura, e.g. a local
+        # test chain
+        # chain_id - Chain the payments are signed for
         # Loading blockchain-related environment variables
         self.infura_url = os.getenv('INFURA_URL') # Using INFURA node 
         # provider to connect to Ethereum network.
@@ -335,39 +2314,57 @@ class BlockchainIntegration:
         # random key was generated and then fixed in .env file.
 
         # Validation check of the above variables
-        if not all([self.infura_url, self.seller_address, self.api_key]):
+        if not all([self.infura_url or provider, self.seller_address, self.api_key]):
             logger.critical("One or more essential blockchain environment variables are missing.")
             raise EnvironmentError("Missing blockchain configuration in environment variables.")
 
+        # Keep-alive HTTP session shared by the Web3 provider and the
+        # exchange rate requests
+        self.session = session if session is not None else create_http_session()
+
         # Initialisation of Web3
-        self.web3 = Web3(Web3.HTTPProvider(self.infura_url))
+        from web3 import Web3 # First use of web3, see the imports
+        if provider is None:
+            provider = instrumented_http_provider()(self.infura_url,
+            request_kwargs={'timeout': RPC_TIMEOUT}, session=self.session)
+            source = "Infura"
+        else:
+            source = type(provider).__name__
+        self.web3 = Web3(provider)
+        self.chain_id = chain_id
+        self.nonces = NonceManager(self.web3) # Local nonce allocation
+        self.price_feeds = {} # Feed address -> PriceFeed registry
+        self.price_feeds_lock = Lock()
         
         if not self.web3.is_connected():
             logger.critical("Web3 is not connected. Check infura URL.")
             raise ConnectionError("Failed to connect to Web3.")
         # If no errors occur then log good connection    
-        logger.info("Connected to Ethereum blockchain via Infura.")
+        logger.info(f"Connected to Ethereum blockchain via {source}.")
+
+    def get_price_feed(self, address=ETH_USD_FEED_ADDRESS):
+        # Price feed contracts are built once per feed address and then
+        # reused, so the ABI is not re-parsed and the address is not 
+        # re-checksummed on every price lookup.
+        with self.price_feeds_lock:
+            feed = self.price_feeds.get(address)
+            if feed is None:
+                feed = PriceFeed(self.web3, address)
+                self.price_feeds[address] = feed
+        return feed
 
     def get_eth_price_usd(self):
         #Get current ETH/USD price using Chainlink.
         try:
-            # Chainlink ETH/USD price feed contract address on Sepolia 
-            # testnet
-            price_feed_address = (Web3.to_checksum_address
-            ('0x694AA1769357215DE4FAC081bf1f309aDC325306')) # Hardcoded
-            # contract address for ETH/USD from Chainlink docs
-            # ABI for the AggregatorV3Interface from Chainlink docs
-            aggregator_abi = '[{"inputs":[],"name":"decimals","outputs":[{"internalType":"uint8","name":"","type":"uint8"}],"stateMutability":"view","type":"function"},{"inputs":[],"name":"description","outputs":[{"internalType":"string","name":"","type":"string"}],"stateMutability":"view","type":"function"},{"inputs":[{"internalType":"uint80","name":"_roundId","type":"uint80"}],"name":"getRoundData","outputs":[{"internalType":"uint80","name":"roundId","type":"uint80"},{"internalType":"int256","name":"answer","type":"int256"},{"internalType":"uint256","name":"startedAt","type":"uint256"},{"internalType":"uint256","name":"updatedAt","type":"uint256"},{"internalType":"uint80","name":"answeredInRound","type":"uint80"}],"stateMutability":"view","type":"function"},{"inputs":[],"name":"latestRoundData","outputs":[{"internalType":"uint80","name":"roundId","type":"uint80"},{"internalType":"int256","name":"answer","type":"int256"},{"internalType":"uint256","name":"startedAt","type":"uint256"},{"internalType":"uint256","name":"updatedAt","type":"uint256"},{"internalType":"uint80","name":"answeredInRound","type":"uint80"}],"stateMutability":"view","type":"function"},{"inputs":[],"name":"version","outputs":[{"internalType":"uint256","name":"","type":"uint256"}],"stateMutability":"view","type":"function"}]'
-            price_feed = self.web3.eth.contract(address=price_feed_address, abi=aggregator_abi)# Connection
-            # to price feed data using contract address and abi
+            price_feed = self.get_price_feed()
             
             # Pulling the latest real-time price feed
-            latest_data = price_feed.functions.latestRoundData().call()
+            latest_data = price_feed.latest_round_data()
             
             # Getting the number of decimals that chainlink uses for
             # their price data to be used to divide in eth_price_usd 
-            # for real value
-            decimals = price_feed.functions.decimals().call()
+            # for real value. Only read from the chain once per feed.
+            decimals = price_feed.decimals()
             eth_price_usd = latest_data[1] / (10 ** decimals)
             logger.info(f"Fetched ETH/USD price: {eth_price_usd}")
             return eth_price_usd
@@ -375,23 +2372,63 @@ class BlockchainIntegration:
             logger.error(f"Failed to get ETH/USD price: {e}")
             raise
 
+    def get_price_and_balance(self, address):
+        # ETH/USD price and the wei balance of address. When the cached
+        # price has expired the Chainlink reads and the balance lookup 
+        # are independent, so they are sent to Infura as a single 
+        # JSON-RPC batch and cost one round trip instead of several.
+        if price_oracle.is_fresh('ETH/USD'):
+            eth_price_usd = price_oracle.get('ETH/USD', self.get_eth_price_usd)
+            return eth_price_usd, self.web3.eth.get_balance(address)
+        try:
+            price_feed = self.get_price_feed()
+            with self.web3.batch_requests() as batch:
+                batch.add(price_feed.contract.functions.latestRoundData())
+                batch.add(self.web3.eth.get_balance(address))
+                if not price_feed.is_cached('decimals'): # Only on the 
+                    # first batch for this feed
+                    batch.add(price_feed.contract.functions.decimals())
+                results = batch.execute()
+            latest_data, balance = results[0], results[1]
+            if len(results) > 2:
+                price_feed.remember('decimals', results[2])
+            decimals = price_feed.decimals()
+        except Exception as e: # e.g. a node that does not accept batches
+            logger.warning(f"Batched price and balance read failed, using single requests: {e}")
+            eth_price_usd = price_oracle.get('ETH/USD', self.get_eth_price_usd)
+            return eth_price_usd, self.web3.eth.get_balance(address)
+        eth_price_usd = latest_data[1] / (10 ** decimals)
+        logger.info(f"Fetched ETH/USD price: {eth_price_usd}")
+        price_oracle.put('ETH/USD', eth_price_usd, self.get_eth_price_usd)
+        return eth_price_usd, balance
+
     def get_usd_zar_rate(self):
         #Get USD/ZAR exchange rate from an API.
+        start = time.perf_counter()
         try:
             #Https get request to pull ZAR data from exchange rate API
-            response = requests.get('https://api.exchangerate-api.com/v4/latest/ZAR') 
+            response = self.session.get('https://api.exchangerate-api.com/v4/latest/ZAR',
+            timeout=EXCHANGE_RATE_TIMEOUT) # Bounded wait so a slow API
+            # falls back to the cached quote in the price oracle
+            response.raise_for_status()
             rates = response.json()['rates'] # converting to python 
             # JSON dictionary and then searching for rates
             usd_per_zar = rates['USD']  # pulling USD/ZAR from rates
+            exchange_rate_seconds.observe(time.perf_counter() - start, outcome='ok')
             return usd_per_zar
         except Exception as e:
+            exchange_rate_seconds.observe(time.perf_counter() - start, outcome='error')
             logger.error(f"Failed to get ZAR/USD exchange rate: {e}")
             raise
 
-    def calculate_eth_amount(self, zar_amount):
+    def calculate_eth_amount(self, zar_amount, eth_price_usd=None):
         # Calculation of the amount of ETH needed for the user ZAR value.
-        eth_price_usd = self.get_eth_price_usd() # Getting ETH/USD
-        usd_zar_rate = self.get_usd_zar_rate() # Getting USD/ZAR
+        # Both quotes come from the shared price oracle so the network is
+        # only hit when a cached quote has expired. eth_price_usd can be
+        # passed in when it was already read, e.g. in a batch request.
+        if eth_price_usd is None:
+            eth_price_usd = price_oracle.get('ETH/USD', self.get_eth_price_usd)
+        usd_zar_rate = price_oracle.get('USD/ZAR', self.get_usd_zar_rate)
         usd_amount = zar_amount * usd_zar_rate  # Convert ZAR to USD 
         # because ZAR*USD/ZAR is just USD
         eth_amount = usd_amount / eth_price_usd # Eth = USD*ETH/USD
@@ -400,14 +2437,13 @@ class BlockchainIntegration:
     def set_transaction(self, buyer_address, item_price_zar):
         # Verify buyer's balance against item price.
         try:
+            # Price and buyer's balance in one round trip
+            eth_price_usd, buyer_balance = self.get_price_and_balance(buyer_address)
             # Using method defined above and taking zar to eth
-            eth_amount = self.calculate_eth_amount(item_price_zar)
+            eth_amount = self.calculate_eth_amount(item_price_zar, eth_price_usd)
             # Taking eth to wei for more precise comparison
             wei_amount = self.web3.to_wei(eth_amount, 'ether')
             
-            # Check buyer's balance
-            buyer_balance = self.web3.eth.get_balance(buyer_address)
-            
             if buyer_balance < wei_amount: # If inputed value (value of
                 # the item being sold) is greater than the balance of
                 # the buyer than return false as the buyer cannot take 
@@ -420,7 +2456,9 @@ class BlockchainIntegration:
             return {
                 'success': True,
                 'eth_amount': eth_amount,
-                'wei_amount': wei_amount
+                'wei_amount': wei_amount,
+                'quote_age': price_oracle.ages() # Seconds since each
+                # price behind eth_amount was fetched
             }
         except Exception as e:
             logger.error(f"Error in set_transaction: {e}")
@@ -435,11 +2473,8 @@ class BlockchainIntegration:
             # Taking eth to wei for more precise item amount
             wei_amount = self.web3.to_wei(eth_amount, 'ether')
             
-            # Prepare transaction
+            # Prepare transaction, the nonce is added when it is sent
             transaction = {
-                'nonce': self.web3.eth.get_transaction_count
-                (buyer_account.address, 'latest'), # the amount of 
-                #transactions on the account
                 'to': self.seller_address, # Where the money is going
                 'value': int(wei_amount), # Money to be sent
                 'gas': 25000,  # Gas limit for ETH transfer, 21000 
@@ -450,31 +2485,183 @@ class BlockchainIntegration:
                 # in peak time, therefore, 1000 was selected to work 
                 # well as of 06/10/2024 but this is expected to increase
                 # as the testnet grows.
-                'chainId': 11155111  # Sepolia testnet ID
+                'chainId': self.chain_id  # Sepolia testnet ID by default
             }
             
-            # Sign transaction using the private key of the buyer
-            signed_txn = self.web3.eth.account.sign_transaction(transaction, buyer_private_key)
-            
-            # Send transaction
-            tx_hash = self.web3.eth.send_raw_transaction(signed_txn.raw_transaction)
+            # Sign and send transaction using the private key of the buyer
+            tx_hash = self.send_with_nonce(buyer_account.address, transaction, buyer_private_key)
             
-            # Wait for transaction receipt
-            receipt = self.web3.eth.wait_for_transaction_receipt(tx_hash)
-            
-            if receipt.status == 1: # 1 means transaction sent
-                return {
-                    'success': True,
-                    'tx_hash': tx_hash.hex(),
-                    'eth_amount': eth_amount
-                }
-            else:
-                return {'success': False,'message': "Transaction failed on the blockchain."
-}
+            # The receipt is not waited for here. The payment tracker
+            # confirms the transaction in the background so the caller 
+            # gets the transaction hash as soon as it has been broadcast.
+            return {
+                'success': True,
+                'tx_hash': tx_hash.hex(),
+                'sender': buyer_account.address,
+                'eth_amount': eth_amount,
+                'quote_age': price_oracle.ages()
+            }
         except Exception as e:
             logger.error(f"Error in trigger_payment: {e}")
             return {'success': False, 'message': str(e)}
 
+    def send_with_nonce(self, sender, transaction, private_key):
+        # Sign and broadcast a transaction using a nonce from the local 
+        # nonce manager, so sends from the same account do not wait on 
+        # each other or on a get_transaction_count() call. If the node
+        # rejects the nonce the manager resyncs and the send is retried
+        # once with a fresh nonce.
+        for attempt in range(2):
+            transaction['nonce'] = self.nonces.allocate(sender)
+            signed_txn = self.web3.eth.account.sign_transaction(transaction, private_key)
+            try:
+                return self.web3.eth.send_raw_transaction(signed_txn.raw_transaction)
+            except Exception as e:
+                self.nonces.resync(sender) # The allocated nonce was not
+                # used so the cached count can no longer be trusted
+                if attempt == 0 and 'nonce' in str(e).lower():
+                    logger.warning(f"Nonce rejected for {sender}, retrying: {e}")
+                    continue
+                raise
+
+    def get_receipt(self, tx_hash):
+        # Receipt of a sent transaction or None if it is not mined yet.
+        from web3.exceptions import TransactionNotFound
+        try:
+            return self.web3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            return None
+
+# Payment Tracker Class
+class PaymentTracker:
+    # Keeps a job for every payment that has been broadcast and confirms
+    # it in a background thread by polling for its receipt. Jobs are
+    # keyed by transaction hash, which doubles as the job ID returned by
+    # /trigger_payment and looked up by /payment_status/<job_id>.
+    def __init__(self, poll_interval=PAYMENT_POLL_INTERVAL, 
+    confirm_timeout=PAYMENT_CONFIRM_TIMEOUT):
+        self.poll_interval = poll_interval
+        self.confirm_timeout = confirm_timeout
+        self.jobs = {} # Job ID -> job dictionary
+        self.lock = Lock() # Guards jobs
+        self.stop_event = Event()
+        self.thread = None
+
+    def track(self, tx_hash, eth_amount, callback_url=None, sender=None, 
+    transaction_id=None):
+        # Register a broadcast payment as pending and return its job.
+        now = time.time()
+        job = {
+            'job_id': tx_hash,
+            'tx_hash': tx_hash,
+            'status': 'pending', # pending -> confirmed/failed/timeout
+            'eth_amount': eth_amount,
+            'sender': sender, # Account that paid, used to resync nonces
+            'transaction_id': transaction_id, # BlockBox transaction paid
+            'block_number': None,
+            'message': "Waiting for the transaction to be mined.",
+            'submitted_at': now,
+            'updated_at': now,
+            'callback_url': callback_url, # Optional URL that is POSTed 
+            # the job once it stops being pending
+        }
+        with self.lock:
+            self.jobs[tx_hash] = job
+        logger.info(f"Tracking payment {tx_hash}.")
+        return dict(job)
+
+    def status(self, job_id):
+        # Copy of the job so callers cannot change the tracker's data
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = Thread(target=self.poll_loop, daemon=True)
+        self.thread.start()
+        logger.info("Payment tracker started.")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def poll_loop(self):
+        while not self.stop_event.wait(self.poll_interval):
+            with self.lock:
+                pending = [job_id for job_id, job in self.jobs.items()
+                if job['status'] == 'pending']
+            for job_id in pending:
+                try:
+                    self.check(job_id)
+                except Exception as e: # Node errors are retried on the
+                    # next poll
+                    logger.warning(f"Error checking payment {job_id}: {e}")
+
+    def check(self, job_id):
+        # Look up the receipt of one pending job and update its status.
+        receipt = get_blockchain().get_receipt(job_id)
+        with self.lock:
+            job = self.jobs[job_id]
+            now = time.time()
+            if receipt is not None:
+                if receipt.status == 1: # 1 means transaction succeeded
+                    job['status'] = 'confirmed'
+                    job['message'] = "Payment confirmed on the blockchain."
+                else:
+                    job['status'] = 'failed'
+                    job['message'] = "Transaction failed on the blockchain."
+                job['block_number'] = receipt.blockNumber
+            elif now - job['submitted_at'] > self.confirm_timeout:
+                job['status'] = 'timeout'
+                job['message'] = "Transaction was not mined in time."
+            else:
+                return # Still pending
+            job['updated_at'] = now
+            finished = dict(job)
+        payment_confirm_seconds.observe(now - finished['submitted_at'], 
+        status=finished['status'])
+        if finished['transaction_id']:
+            tracer.add(finished['transaction_id'], 'payment_confirmation',
+            finished['submitted_at'], now - finished['submitted_at'], 
+            status=finished['status'], tx_hash=job_id)
+        logger.info(f"Payment {job_id} {finished['status']}: {finished['message']}")
+        if finished['transaction_id'] in transactions:
+            transactions.update(finished['transaction_id'], 
+            status='completed' if finished['status'] == 'confirmed' else 'payment_failed')
+        if finished['status'] == 'timeout' and finished['sender']:
+            # A transaction that never got mined leaves a nonce gap
+            get_blockchain().nonces.resync(finished['sender'])
+        if finished['callback_url']:
+            self.send_callback(finished)
+
+    def send_callback(self, job):
+        try:
+            get_blockchain().session.post(job['callback_url'], json=job,
+            timeout=CALLBACK_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Payment callback to {job['callback_url']} failed: {e}")
+
+payment_tracker = PaymentTracker() # Confirms payments in the background
+
+# Shared blockchain client. One BlockchainIntegration is created at
+# startup and used by every Flask worker thread so that reading the
+# environment, building the provider and the is_connected() probe only
+# happen once.
+blockchain = None
+blockchain_lock = Lock() # Ensures only one thread creates the client
+
+def get_blockchain():
+    # Return the shared BlockchainIntegration, creating it on first use
+    # if it could not be created at startup (e.g. Infura was down).
+    global blockchain
+    if blockchain is None:
+        with blockchain_lock:
+            if blockchain is None: # Checked again as another thread may
+                # have created it while this one waited on the lock
+                blockchain = BlockchainIntegration()
+    return blockchain
+
 # Flask App ENDPOINTS
 @app.route('/set_transaction', methods=['POST']) # Endpoint accepting 
 # POST requests
@@ -493,8 +2680,7 @@ def set_transaction():
                 # 400 is Bad request status code which is returned as
                 # as well as the JSON formatted response
 
-        blockchain = BlockchainIntegration() # Initialising an instance
-        # of the BlockchainIntegration class.
+        blockchain = get_blockchain() # Shared blockchain client
         
         #Checking if buyer has sufficient funds
         result = blockchain.set_transaction(buyer_address, item_price_zar)
@@ -502,7 +2688,7 @@ def set_transaction():
         if result['success']: # Returns a JSON response indicating if 
             # the transaction setup is successful and the buyer has 
             # the funds, moreover, showing you how much ETH is needed
-            return jsonify({'success': True,'eth_amount': result['eth_amount'],'message': f"Transaction prepared. Required ETH: {result['eth_amount']:.6f}"}), 200 # 200 status code means all is well
+            return jsonify({'success': True,'eth_amount': result['eth_amount'],'quote_age': result['quote_age'],'message': f"Transaction prepared. Required ETH: {result['eth_amount']:.6f}"}), 200 # 200 status code means all is well
         else:
             return jsonify({'success': False, 'message': result['message']}), 400 # 400 is Bad request status code 
             # which is returned as well as the JSON formatted response
@@ -517,7 +2703,9 @@ def set_transaction():
 # POST requests
 def trigger_payment():
     # Endpoint to trigger payment upon item pickup and it expects JSON 
-    # with 'buyer_private_key' and 'item_price_zar'.
+    # with 'buyer_private_key' and 'item_price_zar'. An optional 
+    # 'callback_url' is POSTed the payment job once it is confirmed. The
+    # endpoint returns as soon as the transaction has been broadcast.
     
     try:
         data = request.json # Extracting JSON data from incoming request
@@ -526,20 +2714,25 @@ def trigger_payment():
         item_price_zar = float(data.get('item_price_zar', 0))# Get item
         # price in ZAR from incoming data and make the price zero if not
         # listed
+        callback_url = data.get('callback_url')
+        transaction_id = data.get('transaction_id') # Optional BlockBox 
+        # transaction the payment belongs to
 
         if not buyer_private_key or item_price_zar <= 0:
             return jsonify({'success': False, 'message': "Invalid private key or price"}), 400
             # 400 is Bad request status code which is returned as
             # as well as the JSON formatted response
 
-        blockchain = BlockchainIntegration() # Initialising an instance
-        # of the BlockchainIntegration class.
+        blockchain = get_blockchain() # Shared blockchain client
         
         #Checking if buyer has sufficient funds
         result = blockchain.trigger_payment(buyer_private_key, item_price_zar)
 
         if result['success']:
-            return jsonify({'success': True,'tx_hash': result['tx_hash'],'eth_amount': result['eth_amount'],'message': f"Payment successful! {result['eth_amount']:.6f} ETH sent."}), 200 # 200 status code means all is well
+            job = payment_tracker.track(result['tx_hash'], result['eth_amount'], callback_url, result['sender'], transaction_id)
+            if transaction_id in transactions:
+                transactions.update(transaction_id, payment_job_id=job['job_id'])
+            return jsonify({'success': True,'job_id': job['job_id'],'tx_hash': result['tx_hash'],'eth_amount': result['eth_amount'],'quote_age': result['quote_age'],'status': job['status'],'status_url': f"/payment_status/{job['job_id']}",'message': f"Payment submitted! {result['eth_amount']:.6f} ETH pending confirmation."}), 202 # 202 status code means accepted but not finished
         else:
             return jsonify({'success': False, 'message': result['message']}), 400 # 400 is Bad request status code 
             # which is returned as well as the JSON formatted response
@@ -550,34 +2743,391 @@ def trigger_payment():
         # 500 status code means an internal server error so the Flask 
         # must be checked 
 
+@app.route('/payment_status/<job_id>') # Endpoint reporting progress
+# of a payment submitted through /trigger_payment
+def payment_status(job_id):
+    job = payment_tracker.status(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': "Unknown payment job."}), 404
+        # 404 status code means the job ID was not found
+    return jsonify({'success': True, **job}), 200
+
+@app.route('/tare', methods=['POST']) # {"compartment", "force"}
+# Endpoint to explicitly re-tare the scale of one compartment
+def tare_scale():
+    # Refused while the compartment may hold a parcel, unless the JSON 
+    # body contains 'force': true. That is when it has an active or 
+    # uncollected transaction, or its settled weight shows an item. The
+    # weight is not checked while the scale needs taring, as it is read
+    # with an offset that is known to be wrong.
+    data = request.get_json(silent=True) or {}
+    compartment_id = str(data.get('compartment', DEFAULT_COMPARTMENT))
+    if compartment_id not in compartments.ids():
+        return jsonify({'success': False, 'message': f"Unknown compartment {compartment_id}."}), 404
+    controller = compartments.get(compartment_id)
+    if not data.get('force', False):
+        if compartment_transactions(compartment_id):
+            return jsonify({'success': False, 'message': f"Compartment {compartment_id} has a transaction, it may not be empty."}), 409
+            # 409 status code means the request conflicts with the state
+        if not controller.tare_required:
+            result = WeightVerifier(controller).assess()
+            if not result['settled']:
+                return jsonify({'success': False, 'message': f"Compartment {compartment_id}: {result['message']} Please try again."}), 409
+            if result['weight'] > 0.1: # Same threshold as item detection
+                return jsonify({'success': False, 'message': f"Compartment {compartment_id} holds {result['weight']:.2f} kg, it is not empty."}), 409
+    try:
+        controller.tare()
+        return jsonify({'success': True, 'message': f"Compartment {compartment_id} tared.", 
+        'compartment': compartment_id, 'tare_required': controller.tare_required}), 200
+    except Exception as e:
+        logger.exception(f"Exception in tare endpoint: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# Simulator control endpoints. They drive the simulated world the way a
+# person at the locker would and only exist with BLOCKBOX_HARDWARE=sim.
+def simulator_world():
+    if hardware_backend is None or hardware_backend.name != 'sim':
+        return None
+    return hardware_backend.world
+
+@app.route('/sim', methods=['GET']) # Doors, parcels and keypad
+def get_simulator_state():
+    world = simulator_world()
+    if world is None:
+        return jsonify({'message': 'The hardware simulator is not running'}), 404
+    return jsonify(world.state()), 200
+
+@app.route('/sim/door', methods=['POST']) # {"compartment", "open"}
+def simulator_door():
+    world = simulator_world()
+    if world is None:
+        return jsonify({'message': 'The hardware simulator is not running'}), 404
+    data = request.get_json(silent=True) or {}
+    compartment_id = str(data.get('compartment', DEFAULT_COMPARTMENT))
+    try:
+        if data.get('open', True):
+            done = world.open_door(compartment_id)
+        else:
+            done = world.close_door(compartment_id)
+    except KeyError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    if not done:
+        return jsonify({'success': False, 'message': 'The door is locked'}), 409
+    return jsonify({'success': True, **world.state()['compartments'][compartment_id]}), 200
+
+@app.route('/sim/parcel', methods=['POST']) # {"compartment", "weight"}
+def simulator_parcel():
+    # Put a parcel of weight kg in an open compartment, 0 takes it out
+    world = simulator_world()
+    if world is None:
+        return jsonify({'message': 'The hardware simulator is not running'}), 404
+    data = request.get_json(silent=True) or {}
+    compartment_id = str(data.get('compartment', DEFAULT_COMPARTMENT))
+    try:
+        done = world.set_parcel(compartment_id, float(data.get('weight', 0)))
+    except KeyError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'weight must be a number'}), 400
+    if not done:
+        return jsonify({'success': False, 'message': 'The door is closed'}), 409
+    return jsonify({'success': True, **world.state()['compartments'][compartment_id]}), 200
+
+@app.route('/sim/keypad', methods=['POST']) # {"keys": "123456"}
+def simulator_keypad():
+    world = simulator_world()
+    if world is None:
+        return jsonify({'message': 'The hardware simulator is not running'}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        world.type_keys(str(data.get('keys', '')))
+    except (ValueError, RuntimeError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': True}), 202 # Typed in the background
+
 # Global State
-state_lock = Lock() # The threading lock ensuring multiple threads 
-# do not work on trying to update the same shared resouse (system_state)
-# at the same time.
-# Lock() essentially allows only one thread at a time to access a
-# coded section
-system_state = { # The definition of the global dictionary that stores 
-# the curremt state of the underlying Block Box system.
+# State Snapshot Class
+class StateSnapshot:
+    # One immutable version of the system state. A snapshot is never 
+    # changed after it is published, so readers use it without a lock
+    # and its JSON is serialised once and shared by every reader.
+    def __init__(self, version, values):
+        self.version = version # Increases by one with every change
+        self.data = MappingProxyType(values) # Read-only view
+        self.json = None # Serialised on first use
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def to_dict(self):
+        return dict(self.data)
+
+    def to_json(self):
+        if self.json is None: # Racing readers produce the same string
+            self.json = json.dumps(self.to_dict(), default=str)
+        return self.json
+
+# State Store Class
+class StateStore:
+    # Versioned copy-on-write store of the current state of the Block 
+    # Box system. Writers build a new snapshot under the lock and swap
+    # it in, readers take the current snapshot (a single reference read)
+    # and serialise it outside the lock, so slow HTTP clients never 
+    # stall the monitor thread, GUI or hardware callbacks and a reader
+    # never sees half of a multi-key update.
+    # Values must be treated as immutable: nested dicts are replaced, 
+    # never changed in place, and lists are stored as tuples.
+    def __init__(self, values, journaled_keys=JOURNALED_STATE_KEYS):
+        self.lock = Lock() # Held by writers only
+        self.current = StateSnapshot(0, dict(values))
+        self.journaled_keys = frozenset(journaled_keys) # Keys written
+        # to the journal when they change
+        self.journal = None # Set once the journal is open
+
+    def snapshot(self):
+        return self.current
+
+    def get(self, key, default=None):
+        return self.current.get(key, default)
+
+    def update(self, changes):
+        # Atomically set several keys, returns the (snapshot, delta) 
+        # where delta holds the keys whose value actually changed
+        return self.update_with(lambda values: changes)
+
+    def update_with(self, build_changes):
+        # Read-modify-write: build_changes gets the current values and
+        # returns the keys to set. It runs under the lock so concurrent
+        # writers of nested values such as compartments do not 
+        # lose each other's changes.
+        with self.lock:
+            values = self.current.data
+            changes = build_changes(values)
+            delta = {key: value for key, value in changes.items() 
+            if key not in values or values[key] != value}
+            if not delta:
+                return self.current, delta
+            new_values = dict(values)
+            new_values.update(delta)
+            self.current = StateSnapshot(self.current.version + 1, new_values)
+            # Journaled and published under the lock so the journal and
+            # the dashboards get the changes in version order
+            self.write_journal(delta)
+            state_events.publish(self.current.version, delta)
+            return self.current, delta
+
+    def write_journal(self, delta):
+        if self.journal is None:
+            return
+        for key in self.journaled_keys.intersection(delta):
+            try:
+                self.journal.save_state(key, delta[key])
+            except Exception as e:
+                logger.error(f"Failed to journal state {key}: {e}")
+
+state_store = StateStore({ # The current state of the underlying Block
+# Box system.
     'door_status': 'Unknown', # Door status tracking
     'item_status': 'No item placed', # Item tracking using weight 
     'item_collected': False, # Boolean flag on whether Buyer took item
     'item_price': None,
     'transaction_id': None, # Stores current custom Transaction ID
     'item_in_box': False, # Boolean version of item_status
-    'error_logs': [], # Where all the system state error logs that keep  
-     # being "appended" are saved.
+    'error_seq': 0, # Sequence number of the newest entry in error_log,
+    # the entries themselves are served by /errors
     'transaction_active': False, # Boolean flag to show if there is an
     # ongoing transaction.
-}
+    'compartment': DEFAULT_COMPARTMENT, # Compartment whose status is 
+    # mirrored in the keys above
+    'compartments': {}, # Compartment ID -> door/item status of that
+    # compartment
+    'kiosk_state': None, # State of the headless kiosk, None with the GUI
+})
+
+# State Events Class
+class StateEvents:
+    # Fan-out of system state changes to the dashboards streaming 
+    # /events. Each change is serialised once and put on the queue of 
+    # every subscriber, so the cost of a change does not depend on how
+    # many dashboards are open and an idle system sends nothing.
+    def __init__(self):
+        self.subscribers = set() # Queue per connected /events client
+        self.lock = Lock() # Guards subscribers
+
+    def subscribe(self):
+        subscriber = Queue(maxsize=EVENT_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, version, delta):
+        # version - state version the change produced, used as event ID
+        # delta - dict of the state keys that changed and their new value
+        with self.lock:
+            if not self.subscribers:
+                return
+            event = f"id: {version}\ndata: {json.dumps(delta, default=str)}"
+            for subscriber in list(self.subscribers):
+                try:
+                    subscriber.put_nowait(event)
+                except Full: # The client is not reading, drop it rather
+                    # than buffer without limit
+                    self.subscribers.discard(subscriber)
+                    try:
+                        subscriber.get_nowait() # Make room for the 
+                        subscriber.put_nowait(None) # end of stream mark
+                    except (Empty, Full):
+                        pass
+
+state_events = StateEvents() # Pushes state changes to the dashboards
+metrics.gauge('blockbox_state_version', 'Version of the system state.',
+function=lambda: state_store.snapshot().version)
 
 def update_system_state(key, value):
     # function that helps update the system state in a thread-safe way
-    with state_lock: # the with keyword ensures that lock is engaged 
-        # before entering the section where state is updated
-        system_state[key] = value
+    update_system_states({key: value})
+
+def update_system_states(changes):
+    # Set several keys of the system state as one atomic update
+    snapshot, delta = state_store.update(changes)
+    for key, value in delta.items():
         logger.debug(f"System state updated: {key} = {value}")
-        
-hardware = HardwareController() # Initialisation of Hardware Controller
+
+# Error Log Class
+class ErrorLog:
+    # Fixed-capacity ring buffer of structured error entries. Every entry
+    # gets a sequence number so clients page through it with 
+    # /errors?after=<seq>, when the buffer is full the oldest entries 
+    # are dropped so a flapping sensor cannot grow memory without limit.
+    def __init__(self, capacity=ERROR_LOG_SIZE):
+        self.entries = deque(maxlen=capacity)
+        self.lock = Lock() # Guards entries and seq
+        self.seq = 0 # Sequence number of the newest entry
+
+    def add(self, message, source, severity='error'):
+        with self.lock:
+            self.seq += 1
+            entry = {'seq': self.seq, 'timestamp': time.time(), 
+            'source': source, 'severity': severity, 'message': message}
+            self.entries.append(entry)
+        return entry
+
+    def page(self, after=0, limit=ERROR_PAGE_SIZE):
+        # Oldest entries newer than the sequence number after, returns 
+        # (entries, missed) where missed counts entries that were 
+        # dropped from the buffer before they could be read
+        with self.lock:
+            entries = [entry for entry in self.entries if entry['seq'] > after]
+            oldest = self.entries[0]['seq'] if self.entries else self.seq + 1
+        missed = max(0, oldest - after - 1)
+        return entries[:limit], missed
+
+    def latest(self):
+        with self.lock:
+            return self.seq
+
+error_log = ErrorLog() # Recent hardware, Telegram and pickup errors
+
+def record_error(message, source, severity='error'):
+    # Add an entry to the error log shown on the dashboard. Only the 
+    # newest sequence number goes into the system state, so the state
+    # payload stays the same size however many errors there are.
+    # source - part of the system that failed, e.g. "weight"
+    # severity - "error" or "warning"
+    entry = error_log.add(message, source, severity)
+    update_system_state('error_seq', entry['seq'])
+
+journal = None # Durable transaction and state journal, opened at 
+# startup by open_journal() so importing the module creates no files
+transactions = TransactionStore() # Every transaction, keyed by ID
+
+def open_journal(path=JOURNAL_FILE):
+    # Open (or create) the journal and write every later transaction and
+    # state change through to it
+    global journal
+    journal = TransactionJournal(path)
+    state_store.journal = journal
+    transactions.journal = journal
+
+def recover_transactions():
+    # Reload the journal after a (re)boot and resume the transactions 
+    # that were in flight when the system went down.
+    saved_state = journal.load_state()
+    update_system_states({key: value for key, value in saved_state.items() 
+    if key in JOURNALED_STATE_KEYS}) # transaction_active is worked out
+    # again from the transactions below
+    # setup_gpio leaves every lock open, so each compartment that may
+    # still hold a parcel is locked again here.
+    records = journal.load_transactions()
+    for record in records:
+        transactions.restore(record)
+    for record in transactions.find_active() + transactions.find(status='uncollected'):
+        transaction_id = record['transaction_id']
+        if record['compartment'] not in compartments.ids():
+            logger.error(f"Transaction {transaction_id} is in unknown compartment {record['compartment']}.")
+            continue
+        if record['status'] == 'uncollected': # The item is waiting for
+            # its seller to reclaim it
+            compartments.get(record['compartment']).lock_door()
+            logger.info(f"Resumed transaction {transaction_id}, item waiting to be reclaimed.")
+        elif record['status'] == 'listing': # The seller never finished
+            # listing the item, so it has to be listed again. If the item
+            # was already placed it stays locked in for the seller to 
+            # reclaim.
+            hardware = compartments.get(record['compartment'])
+            weight_result = WeightVerifier(hardware).wait_until_settled(timeout=SETTLE_TIMEOUT)
+            if (weight_result['settled'] and weight_result['weight'] <= 0.1 
+            and not hardware.tare_required):
+                transactions.update(transaction_id, status='cancelled')
+            else: # An item is inside, or the scale cannot tell
+                hardware.lock_door()
+                transactions.update(transaction_id, status='uncollected')
+                record_error(f"Transaction {transaction_id} was not fully listed before a restart, "
+                f"its item is locked in compartment {record['compartment']} for the seller to reclaim.", 
+                "recovery", "warning")
+        elif record['status'] == 'awaiting_pickup': # Item is locked in
+            # and the buyer's OTP was issued, keep the item locked
+            compartments.get(record['compartment']).lock_door()
+            logger.info(f"Resumed transaction {transaction_id}, awaiting pickup.")
+        elif record['payment_job_id']: # Payment broadcast but not yet
+            # confirmed, hand it back to the payment tracker
+            payment_tracker.track(record['payment_job_id'], None, 
+            transaction_id=transaction_id)
+            logger.info(f"Resumed transaction {transaction_id}, awaiting payment confirmation.")
+        else: # The private key is never journaled so a payment that was
+            # not broadcast cannot be retried automatically
+            transactions.update(transaction_id, status='payment_failed')
+            logger.error(f"Transaction {transaction_id} was collected but its payment was never submitted.")
+    active = transactions.find_active()
+    update_system_state('transaction_active', bool(active))
+    logger.info(f"Recovered {len(records)} transaction(s) from the journal, {len(active)} still active.")
+
+def update_compartment_state(compartment_id, key, value):
+    # Update the status of one compartment in a thread-safe way. The
+    # compartment shown at the top level of system_state is mirrored.
+    def build_changes(values):
+        compartment_state = dict(values['compartments'].get(compartment_id, {}))
+        compartment_state[key] = value
+        changes = {'compartments': {**values['compartments'], 
+        compartment_id: compartment_state}}
+        if compartment_id == values['compartment']:
+            changes[key] = value
+        return changes
+    state_store.update_with(build_changes)
+    logger.debug(f"Compartment {compartment_id} state updated: {key} = {value}")
+
+compartments = CompartmentRegistry() # Hardware controller of every 
+# compartment, set up in main()
+hardware = None # Compartment used by the GUI
+sensor_scheduler = None # Concurrent sampling of every compartment's 
+# load cell, created in main() once the compartments exist
+metrics.gauge('blockbox_sensor_overruns', 
+'Sensor scheduler ticks that took longer than the sample interval.',
+function=lambda: sensor_scheduler.overruns if sensor_scheduler else 0)
 
 # Environment Variables loading and validation
 def load_env_variables():
@@ -605,23 +3155,9 @@ def load_env_variables():
 
     return TELEGRAM_TOKEN, CHAT_ID, SELLER_TELEGRAM_TOKEN, SELLER_CHAT_ID, OTP_SECRET
 
-try:
-    TELEGRAM_TOKEN, CHAT_ID, SELLER_TELEGRAM_TOKEN, SELLER_CHAT_ID, OTP_SECRET = load_env_variables()
-except EnvironmentError as e:
-    logger.critical(f"Environment variable error: {e}")
-    exit(1)
-
-# Initialisation of Telegram Bot Handlers
-buyer_bot_handler = TelegramHandler(TELEGRAM_TOKEN, CHAT_ID, "buyer")
-seller_bot_handler = TelegramHandler(SELLER_TELEGRAM_TOKEN, SELLER_CHAT_ID, "seller")
-
-# Initialisation of OTP Manager with OTP_SECRET for user/system 
-# validation
-otp_manager = OTPManager(OTP_SECRET)
-
-# Initialisation of Flask Server
-flask_server = FlaskServer(app)
-flask_server.start() # Start server in separate thread
+def on_door_event(event):
+    # Door transitions are written to the system state as they happen
+    update_compartment_state(event['compartment'], 'door_status', 'Closed' if event['closed'] else 'Open')
 
 # System Monitor Function
 def monitor_system(stop_event): #stop_event is an instance of Python's 
@@ -630,30 +3166,142 @@ def monitor_system(stop_event): #stop_event is an instance of Python's
     # on any hardware changes.
     while not stop_event.is_set(): #Loop runs as long as stop_event is 
         # FALSE
-        # Update door status
-        door_closed = hardware.is_door_closed()
-        update_system_state('door_status', 'Closed' if door_closed else 'Open')
-
-        # Update item status based on weight
-        weight = hardware.read_weight()
-        if weight > 0.1: # Only items greater than 100g are detected
-            update_system_state('item_status', 'Item placed')
-            update_system_state('item_in_box', True)
-        else:
-            update_system_state('item_status', 'No item placed')
-            update_system_state('item_in_box', False)
+        # Door status is pushed by door events and weights are sampled by
+        # the sensor scheduler, so this only reads their latest values
+        for controller in compartments.controllers():
+            compartment_id = controller.compartment_id
+            # Update item status based on weight
+            weight = controller.read_weight()
+            published = state_store.get('compartments').get(compartment_id, {})
+            if (published.get('weight') is None or 
+            published.get('item_in_box') != (weight > 0.1) or 
+            abs(weight - published['weight']) >= WEIGHT_PUBLISH_DEADBAND):
+                update_compartment_state(compartment_id, 'weight', round(weight, 3))
+            if weight > 0.1: # Only items greater than 100g are detected
+                update_compartment_state(compartment_id, 'item_status', 'Item placed')
+                update_compartment_state(compartment_id, 'item_in_box', True)
+            else:
+                update_compartment_state(compartment_id, 'item_status', 'No item placed')
+                update_compartment_state(compartment_id, 'item_in_box', False)
 
         time.sleep(1)  # 1 sec pause before checking the system again
 
 # Event to stop the monitor thread
 monitor_stop_event = Event()
-# Function to run in monitor_system which takes the new event as argument
-monitor_thread = Thread(target=monitor_system, args=(monitor_stop_event,))
-monitor_thread.daemon = True # When system stops, event stops, monitor
-# then also stops
-monitor_thread.start() # Starting the monitoring in a different thread
+
+# Created in main()
+buyer_bot_handler = None
+seller_bot_handler = None
+otp_manager = None
+keypad = None
 
 # Initialisation of GUI using Tkinter 
+# Transaction flow helpers shared by the GUI and the headless kiosk
+def compartment_transactions(compartment_id):
+    # Transactions that still hold the compartment: the active ones and
+    # uncollected items waiting for their seller
+    return (transactions.find_active(compartment=compartment_id) + 
+    transactions.find(status='uncollected', compartment=compartment_id))
+
+def find_free_compartment():
+    # First compartment with no transaction holding it and no item in 
+    # it. A compartment whose scale needs taring is skipped, its weight
+    # readings cannot be trusted.
+    for compartment_id in compartments.ids():
+        if compartment_transactions(compartment_id):
+            continue
+        if compartments.get(compartment_id).tare_required:
+            continue
+        if compartments.get(compartment_id).read_weight() > 0.1:
+            continue
+        return compartment_id
+    return None
+
+def generate_transaction_id():
+    # Generation of a short, readable transaction ID that is not used
+    # by an earlier transaction
+    while True:
+        transaction_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+        if transaction_id not in transactions:
+            return transaction_id
+
+def buyer_otp_message(record, otp):
+    # OTP and item info sent to the buyer via Telegram
+    return (
+        f"Transaction ID: {record['transaction_id']}\n"
+        f"Item: {record['item_name']}\n"
+        f"Description: {record['description']}\n"
+        f"Price: {record['item_price']} Rands\n"
+        f"Compartment: {record['compartment']}\n"
+        f"Your OTP to retrieve the item is: {otp}\n"
+        f"This OTP will expire in 10 minutes."
+    )
+
+def seller_summary_message(record):
+    # Summary and transaction ID sent to the seller via Telegram
+    return (
+        f"Transaction ID: {record['transaction_id']}\n"
+        f"Item: {record['item_name']}\n"
+        f"Description: {record['description']}\n"
+        f"Price: {record['item_price']} Rands\n"
+        f"Compartment: {record['compartment']}\n"
+        f"The item is ready for collection."
+    )
+
+def show_transaction(record):
+    # Make a transaction the one shown at the top level of system_state
+    # and on the dashboard
+    state_store.update_with(lambda values: {
+        'compartment': record['compartment'],
+        'transaction_id': record['transaction_id'],
+        'item_price': record['item_price'],
+        'transaction_active': True,
+        # Top-level door/item status now mirrors this compartment
+        **values['compartments'].get(record['compartment'], {})})
+
+def call_api(transaction_id, path, payload):
+    # POST to the Block Box Flask API within the transaction's trace
+    with tracer.span(transaction_id, f"call {path}") as span:
+        response = requests.post(
+            f"{FLASK_API_URL}{path}",
+            headers={'x-api-key': os.getenv('API_KEY'), **span.header()},
+            json=payload
+        )
+        span.set(status=response.status_code)
+    return response
+
+def read_keypad_digits(length=OTP_LENGTH, timeout=None):
+    # Read length digits typed on the keypad, None if timeout seconds 
+    # pass first
+    deadline = None if timeout is None else time.monotonic() + timeout
+    otp_entered = ""
+    while len(otp_entered) < length:
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        keys_pressed = keypad.pressed_keys
+        if keys_pressed:
+            for key in keys_pressed:
+                if key.isdigit():
+                    otp_entered += key
+                    logger.debug(f"Keypad digit entered ({len(otp_entered)} of {length}).")
+                    # The digits themselves are not logged, they are the
+                    # buyer's OTP
+                    # Debounce
+                    while keypad.pressed_keys:
+                        time.sleep(KEYPAD_POLL_INTERVAL)
+                    time.sleep(KEYPAD_POLL_INTERVAL)
+        time.sleep(KEYPAD_POLL_INTERVAL)
+    return otp_entered
+
+def shutdown_system():
+    # Stop the background threads and release the hardware
+    monitor_stop_event.set()
+    if sensor_scheduler is not None:
+        sensor_scheduler.stop()
+    compartments.cleanup()
+    notification_outbox.stop()
+    telegram_loop.stop()
+
 class BlockBoxGUI:
     def __init__(self, root, hardware, buyer_bot, seller_bot, otp_manager):
         self.root = root # Main GUI window
@@ -663,8 +3311,12 @@ class BlockBoxGUI:
         self.otp_manager = otp_manager # Instance of the OTPManager class
         self.transaction_active = False # Start with no ongoing transaction
         self.item_in_box = False # Start with nothing in box
+        self.transaction_id = None # Transaction shown in the GUI, its
+        # data is kept in the transaction store
         self.buyer_private_key = None  # Store buyer's private key 
         # temporarily during transaction ONLY as sensitive infomation
+        self.weight_verifier = WeightVerifier(hardware) # Stable weight
+        # detection for placement and buyer verification
 
         self.setup_gui() # Calling method below to set GUI framework up
 
@@ -742,13 +3394,14 @@ class BlockBoxGUI:
         # Introductory Text
         tk.Label(intro_popup, text="Are you a SELLER or a BUYER?",font=("Helvetica", 16, "bold"), bg="#f0f0f0").grid(row=1,column=0, columnspan=2, pady=20)
 
-        # Determination of button states based on system state
-        transaction_active = system_state.get('transaction_active', False)
-        item_in_box = system_state.get('item_in_box', False)
+        # Determination of button states based on the transaction store
+        awaiting_pickup = transactions.find(status='awaiting_pickup')
+        item_in_box = self.find_free_compartment() is None # Every 
+        # compartment is in use
         
-        # The buyer button is only enabled if there is an ongoing 
-        # transaction and an item is in the box
-        buyer_button_state = "normal" if transaction_active and item_in_box else "disabled"
+        # The buyer button is only enabled if there is a transaction 
+        # whose item is waiting in a compartment
+        buyer_button_state = "normal" if awaiting_pickup else "disabled"
 
         # Seller Button definition, on the left on buyer button under
         # intro text, lambda defines after click 
@@ -766,26 +3419,43 @@ class BlockBoxGUI:
             else:
                 tk.Label(intro_popup, text="Buyer option unavailable until seller lists an item.",fg="red", bg="#f0f0f0").grid(row=3, column=0, columnspan=2, pady=5)
 
+    def find_free_compartment(self):
+        # First compartment with no active transaction and no item in it
+        return find_free_compartment()
+
+    def select_transaction(self, transaction_id):
+        # Make a transaction the one shown in the GUI and on the dashboard
+        record = transactions.get(transaction_id)
+        self.transaction_id = transaction_id
+        self.hardware = compartments.get(record['compartment'])
+        self.weight_verifier = WeightVerifier(self.hardware)
+        show_transaction(record)
+        return record
+
+    def transaction(self):
+        # Copy of the record of the transaction shown in the GUI
+        return transactions.get(self.transaction_id)
+
+    @traced('open_seller')
     def open_seller(self):
         # Open the seller interface
-        if system_state.get('item_in_box', False): # Checking if there
-            # is an item in the box, looking for TRUE. The false in 
-            # arg is just a default value incase of no set state.
-            messagebox.showerror("Error", "An item is still in the box. Please take it out before starting a new transaction.")
+        compartment_id = self.find_free_compartment()
+        if compartment_id is None: # Every compartment holds an item,
+            # has an active transaction or needs taring
+            messagebox.showerror("Error", "No compartment is free. Please take out any item left inside, and tare any scale that needs it, before starting a new transaction.")
             return
             
-        #Proceeds here if no item in box
+        #Proceeds here if a compartment is free
         self.intro_frame.pack_forget() # Hide intro page
         self.seller_frame.pack(fill="both", expand=1) 
 
-        # Generate a new transaction ID
+        # Generate a new transaction ID and its record
         transaction_id = self.generate_transaction_id()
+        transactions.create(transaction_id, compartment_id)
         # Update states with new ID
-        update_system_state('transaction_id', transaction_id)
-        update_system_state('transaction_active', True)
+        self.select_transaction(transaction_id)
         self.transaction_active = True
         
-        self.save_seller_data()
 
         # Ensure door is closed before moving to seller form screen
         if not self.hardware.is_door_closed():
@@ -852,7 +3522,7 @@ class BlockBoxGUI:
         # Option to upload image of item stored in memory
         file_path = filedialog.askopenfilename(title="Select Image", filetypes=[("Image files", "*.jpg *.jpeg *.png")])
         if file_path:
-            system_state["image_path"] = file_path
+            transactions.update(self.transaction_id, image_path=file_path)
             img = Image.open(file_path)
             img.thumbnail((200, 200))
             img = ImageTk.PhotoImage(img)
@@ -860,6 +3530,7 @@ class BlockBoxGUI:
             self.img_label.image = img
             logger.info(f"Image uploaded: {file_path}")
 
+    @traced('submit_seller_data')
     def submit_seller_data(self):
         #Submit seller data and proceed with the transaction
         item_name = self.item_name_entry.get()
@@ -879,13 +3550,11 @@ class BlockBoxGUI:
             messagebox.showerror("Error", "Item weight and price must be greater than 0.")
             return
 
-        if item_name and description and "image_path" in system_state and buyer_address:
-            system_state["item_name"] = item_name
-            system_state["description"] = description
-            system_state["advertised_weight"] = advertised_weight
-            system_state["item_price"] = item_price
-            system_state["buyer_address"] = buyer_address  # Set buyer address in system_state
-            self.save_seller_data()
+        if item_name and description and self.transaction()['image_path'] and buyer_address:
+            transactions.update(self.transaction_id, item_name=item_name,
+            description=description, advertised_weight=advertised_weight,
+            item_price=item_price, buyer_address=buyer_address)
+            update_system_state('item_price', item_price)
 
             # Unlock the door to allow the seller to place the item
             self.hardware.unlock_door()
@@ -900,20 +3569,18 @@ class BlockBoxGUI:
             update_system_state('item_status', 'Item placed')
 
             # Generate OTP and send messages
-            otp = self.otp_manager.generate_otp()
+            with tracer.span(self.transaction_id, 'generate_otp'):
+                otp, otp_fields = self.otp_manager.generate_otp(self.transaction_id)
+            record = transactions.update(self.transaction_id, **otp_fields)
             try:
                 # Send buyer the transaction ID and item info via Flask API
-                item_price_zar = system_state.get('item_price')
+                item_price_zar = record['item_price']
 
                 # Call the Flask API to set the transaction on the blockchain
-                response = requests.post(
-                    f"{FLASK_API_URL}/set_transaction",
-                    headers={'x-api-key': os.getenv('API_KEY')},
-                    json={
-                        'buyer_address': buyer_address,
-                        'item_price_zar': item_price_zar
-                    }
-                )
+                response = call_api(self.transaction_id, '/set_transaction', {
+                    'buyer_address': buyer_address,
+                    'item_price_zar': item_price_zar
+                })
 
                 if response.status_code == 200:
                     logger.info("Transaction set successfully.")
@@ -922,20 +3589,16 @@ class BlockBoxGUI:
                     messagebox.showerror("Error", f"Failed to set transaction: {response.json().get('message')}")
                     return
 
+                # The item is locked in and the buyer can collect it
+                transactions.update(self.transaction_id, status='awaiting_pickup')
+
                 # Send OTP via Telegram
                 self.send_otp_via_telegram(otp)
                 # Send seller a summary and transaction ID
-                seller_summary = (
-                    f"Transaction ID: {system_state['transaction_id']}\n"
-                    f"Item: {system_state['item_name']}\n"
-                    f"Description: {system_state['description']}\n"
-                    f"Price: {system_state['item_price']} Rands\n"
-                    f"The item is ready for collection."
-                )
-                self.seller_bot.send_message(seller_summary)
+                self.seller_bot.notify(seller_summary_message(record))
                 messagebox.showinfo("Success", "Item data saved, transaction set, OTP sent to buyer, and notification sent to seller!")
                 # Automatically transition to buyer interface
-                self.open_buyer()
+                self.open_buyer(self.transaction_id)
             except Exception as e:
                 logger.error(f"Failed to send messages or interact with blockchain: {e}")
                 messagebox.showerror("Error", f"Failed to send messages or interact with blockchain address: {e}")
@@ -944,59 +3607,49 @@ class BlockBoxGUI:
 
     def send_otp_via_telegram(self, otp):
         # Send OTP and item info to the buyer via Telegram
-        message = (
-            f"Transaction ID: {system_state['transaction_id']}\n"
-            f"Item: {system_state['item_name']}\n"
-            f"Description: {system_state['description']}\n"
-            f"Price: {system_state['item_price']} Rands\n"
-            f"Your OTP to retrieve the item is: {otp}\n"
-            f"This OTP will expire in 10 minutes."
-        )
-        self.buyer_bot.send_message(message)
+        self.buyer_bot.notify(buyer_otp_message(self.transaction(), otp))
 
     def generate_transaction_id(self):
-        # Generation of a short, readable transaction ID
-        return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-
-    def save_seller_data(self):
-        # Save seller data to a JSON file
-        with open("seller_data.json", "w") as file:
-            json.dump(system_state, file)
-        logger.info("Seller data saved to seller_data.json.")
+        return generate_transaction_id()
 
+    @traced('wait_for_door_close')
     def wait_for_door_close(self):
-        # Wait until the door is closed
-        while not self.hardware.is_door_closed():
-            time.sleep(0.1)
+        # Wait until the door is closed, sleeping until a door event
+        self.hardware.wait_for_door(closed=True)
         update_system_state('door_status', 'Closed')
         logger.info("Door closed.")
 
+    @traced('wait_for_door_open')
     def wait_for_door_open(self):
-        # Wait until the door is opened
-        while self.hardware.is_door_closed():
-            time.sleep(0.1)
+        # Wait until the door is opened, sleeping until a door event
+        self.hardware.wait_for_door(closed=False)
         update_system_state('door_status', 'Open')
         logger.info("Door opened.")
 
+    @traced('wait_for_item_placement')
     def wait_for_item_placement(self):
-        # Wait until the item is placed on the scale
-        while True:
-            weight = self.hardware.read_weight()
-            if weight > 0.1:
-                update_system_state('item_status', 'Item placed')
-                break
-            time.sleep(0.5)
-        logger.info("Item placed on the scale.")
-
-    def open_buyer(self):
-        # Open the buyer interface.
-        transaction_active = system_state.get('transaction_active', False)
-        item_in_box = system_state.get('item_in_box', False)
-
-        if not (transaction_active and item_in_box):
+        # Wait until an item has been placed and the scale has settled
+        result = self.weight_verifier.wait_until_settled(condition=lambda weight: weight > 0.1)
+        update_system_state('item_status', 'Item placed')
+        logger.info(f"Item placed on the scale. {result['message']}")
+
+    def open_buyer(self, transaction_id=None):
+        # Open the buyer interface for a transaction awaiting pickup. If
+        # several are waiting the buyer is asked for the transaction ID.
+        awaiting_pickup = transactions.find(status='awaiting_pickup')
+        if transaction_id is None and len(awaiting_pickup) == 1:
+            transaction_id = awaiting_pickup[0]['transaction_id']
+        elif transaction_id is None and awaiting_pickup:
+            transaction_id = simpledialog.askstring("Transaction", 
+            "Enter the transaction ID from your Telegram message:", parent=self.root)
+            transaction_id = transaction_id.strip().upper() if transaction_id else None
+
+        record = transactions.get(transaction_id) if transaction_id else None
+        if record is None or record['status'] != 'awaiting_pickup':
             messagebox.showerror("Error", "No active transaction or item is not available. Please wait for the seller to list an item.")
             self.create_intro()
             return
+        self.select_transaction(transaction_id)
 
         self.intro_frame.pack_forget()
         self.seller_frame.pack_forget()
@@ -1013,9 +3666,11 @@ class BlockBoxGUI:
         self.buyer_frame.grid_rowconfigure(7, weight=1)
         self.buyer_frame.grid_columnconfigure(1, weight=1)
 
+        record = self.transaction()
+
         # Image Display
-        if "image_path" in system_state and os.path.exists(system_state["image_path"]):
-            img = Image.open(system_state["image_path"])
+        if record['image_path'] and os.path.exists(record['image_path']):
+            img = Image.open(record['image_path'])
             img.thumbnail((200, 200))
             img = ImageTk.PhotoImage(img)
             self.buyer_img_label = tk.Label(self.buyer_frame, image=img, bg="#f0f0f0")
@@ -1026,15 +3681,15 @@ class BlockBoxGUI:
             self.buyer_img_label.grid(row=0, column=1, rowspan=5, padx=20, pady=10, sticky='e')
 
         # Item Details
-        tk.Label(self.buyer_frame, text=f"Item Name: {system_state.get('item_name', 'N/A')}",
+        tk.Label(self.buyer_frame, text=f"Item Name: {record.get('item_name') or 'N/A'}",
                  font=("Helvetica", 16), bg="#f0f0f0").grid(row=0, column=0, padx=20, pady=10, sticky='w')
-        tk.Label(self.buyer_frame, text=f"Description: {system_state.get('description', 'N/A')}",
+        tk.Label(self.buyer_frame, text=f"Description: {record.get('description') or 'N/A'}",
                  font=("Helvetica", 14), bg="#f0f0f0").grid(row=1, column=0, padx=20, pady=10, sticky='w')
-        tk.Label(self.buyer_frame, text=f"Advertised Weight: {system_state.get('advertised_weight', 'N/A')} kg",
+        tk.Label(self.buyer_frame, text=f"Advertised Weight: {record.get('advertised_weight') or 'N/A'} kg",
                  font=("Helvetica", 14), bg="#f0f0f0").grid(row=2, column=0, padx=20, pady=10, sticky='w')
-        tk.Label(self.buyer_frame, text=f"Price: {system_state.get('item_price', 'N/A')} Rands",
+        tk.Label(self.buyer_frame, text=f"Price: {record.get('item_price') or 'N/A'} Rands",
                  font=("Helvetica", 14), bg="#f0f0f0").grid(row=3, column=0, padx=20, pady=10, sticky='w')
-        tk.Label(self.buyer_frame, text=f"Transaction ID: {system_state.get('transaction_id', 'N/A')}",
+        tk.Label(self.buyer_frame, text=f"Transaction ID: {record.get('transaction_id') or 'N/A'}",
                  font=("Helvetica", 14), bg="#f0f0f0").grid(row=4, column=0, padx=20, pady=10, sticky='w')
 
         # OTP Entry Instructions
@@ -1053,25 +3708,33 @@ class BlockBoxGUI:
         self.result_label = tk.Label(self.buyer_frame, text="", font=("Helvetica", 14), bg="#f0f0f0")
         self.result_label.grid(row=8, column=0, columnspan=2, padx=20, pady=10, sticky='w')
 
+    @traced('verify_weight')
     def verify_weight(self):
         # Verify the weight of the item and the OTP entered by the buyer
-        if not system_state.get('item_in_box', False):
+        record = self.transaction()
+        if self.hardware.read_weight() <= 0.1: # Nothing in compartment
             self.result_label.config(text="No item available for collection.", fg="red")
             return
 
-        if self.otp_manager.is_otp_expired():
+        if self.otp_manager.is_otp_expired(record['otp_created_at']):
             self.result_label.config(text="OTP has expired. Please contact the seller.", fg="red")
             self.notify_buyer_otp_expired()
             return
 
-        # Read weight
-        actual_weight = self.hardware.read_weight()
-        advertised_weight = system_state.get("advertised_weight", 0)
+        # Read weight once the scale has settled
+        with tracer.span(self.transaction_id, 'wait_until_settled') as span:
+            weight_result = self.weight_verifier.wait_until_settled(timeout=SETTLE_TIMEOUT)
+            span.set(settled=weight_result['settled'])
+        if not weight_result['settled']:
+            self.result_label.config(text=f"{weight_result['message']} Please try again.", fg="orange")
+            return
+        actual_weight = weight_result['weight']
+        advertised_weight = record['advertised_weight'] or 0
 
         print("Enter the 6-digit OTP using the keypad:")
         entered_otp = self.read_keypad_input()
 
-        if self.otp_manager.verify_otp(entered_otp):
+        if self.otp_manager.verify_otp(entered_otp, record):
             if (advertised_weight - WEIGHT_TOLERANCE) <= actual_weight <= (advertised_weight + WEIGHT_TOLERANCE):
                 self.result_label.config(text=f"Verification successful! Unlocking door for item collection.", fg="green")
                 self.hardware.unlock_door()
@@ -1087,7 +3750,7 @@ class BlockBoxGUI:
 
                 # Notify buyer to collect the item
                 try:
-                    self.buyer_bot.send_message("Please collect your item now. Once done, close the door.")
+                    self.buyer_bot.notify("Please collect your item now. Once done, close the door.")
                 except Exception as e:
                     logger.error(f"Error sending message to buyer: {e}")
 
@@ -1096,42 +3759,33 @@ class BlockBoxGUI:
                 monitor_thread.start()
             else:
                 self.result_label.config(text=f"Weight does not match. Actual: {actual_weight:.2f} kg", fg="orange")
-                with state_lock:
-                    system_state['error_logs'].append(f"Weight mismatch: Actual {actual_weight:.2f} kg")
+                record_error(f"Weight mismatch: Actual {actual_weight:.2f} kg", "pickup", "warning")
                 self.hardware.lock_door()
         else:
             self.result_label.config(text="Invalid OTP!", fg="red")
-            with state_lock:
-                system_state['error_logs'].append("Invalid OTP")
+            record_error("Invalid OTP", "pickup", "warning")
             self.hardware.lock_door()
 
+    @traced('keypad_entry')
     def read_keypad_input(self):
         # Read the OTP entered by the buyer using the keypad.
-        otp_entered = ""
-        while len(otp_entered) < 6:
-            keys_pressed = keypad.pressed_keys
-            if keys_pressed:
-                for key in keys_pressed:
-                    if key.isdigit():
-                        otp_entered += key
-                        print(f"OTP Entered So Far: {otp_entered}")
-                        # Debounce
-                        while keypad.pressed_keys:
-                            time.sleep(0.1)
-                        time.sleep(0.1)
-            time.sleep(0.1)
-        return otp_entered
+        with keypad_entry_seconds.time():
+            return self.read_keypad_digits()
 
+    def read_keypad_digits(self):
+        return read_keypad_digits()
+
+    @traced('monitor_item_collection')
     def monitor_item_collection(self):
         # Monitor the item removal and door closure after buyer verification.
+        record = self.transaction()
         # Wait for buyer to open the door (already unlocked)
-        while self.hardware.is_door_closed():
-            time.sleep(0.1)
+        self.hardware.wait_for_door(closed=False)
         logger.info("Buyer opened the door for collection.")
 
         # Start time for timeout
         start_time = time.time()
-        timeout = 300  # 5 minutes to remove the item
+        timeout = COLLECTION_TIMEOUT  # 5 minutes to remove the item
 
         # Monitor item removal with timeout
         item_removed = False
@@ -1149,106 +3803,111 @@ class BlockBoxGUI:
         #logger.info("Buyer closed the door after collection.")
 
         if item_removed:
-            # Successful collection
-            self.send_seller_message(f"The buyer has successfully collected the item.\nTransaction ID: {system_state['transaction_id']}")
+            # Successful collection. The scale is re-zeroed once the door
+            # is shut and the empty box has settled.
+            try:
+                self.hardware.tare_if_empty()
+            except Exception as e:
+                logger.error(f"Error re-taring scale after collection: {e}")
+            transactions.update(record['transaction_id'], status='awaiting_payment')
+            self.send_seller_message(f"The buyer has successfully collected the item.\nTransaction ID: {record['transaction_id']}")
             update_system_state('item_collected', True)
             try:
-                self.buyer_bot.send_message("Thank you for your purchase!")
+                self.buyer_bot.notify("Thank you for your purchase!")
             except Exception as e:
                 logger.error(f"Error sending thank you message to buyer: {e}")
 
             # Trigger payment via Flask API
             try:
-                item_price_zar = system_state.get('item_price')
-                response = requests.post(
-                    f"{FLASK_API_URL}/trigger_payment",
-                    headers={'x-api-key': os.getenv('API_KEY')},
-                    json={
-                        'buyer_private_key': self.buyer_private_key,
-                        'item_price_zar': item_price_zar
-                    }
-                )
-
-                if response.status_code == 200:
+                item_price_zar = record['item_price']
+                response = call_api(record['transaction_id'], '/trigger_payment', {
+                    'buyer_private_key': self.buyer_private_key,
+                    'item_price_zar': item_price_zar,
+                    'transaction_id': record['transaction_id']
+                })
+
+                if response.status_code in (200, 202): # 202 means the
+                    # payment was broadcast and is being confirmed by the
+                    # payment tracker, so the locker does not wait on it
                     payment_data = response.json()
-                    logger.info(f"Payment successful. TX Hash: {payment_data['tx_hash']}")
+                    logger.info(f"Payment submitted. TX Hash: {payment_data['tx_hash']}")
                     eth_amount = payment_data['eth_amount']
                     self.result_label.config(
-                        text=f"Payment successful! {eth_amount:.6f} ETH sent.\nTX Hash: {payment_data['tx_hash'][:10]}...",
+                        text=f"Payment submitted! {eth_amount:.6f} ETH pending confirmation.\nTX Hash: {payment_data['tx_hash'][:10]}...",
                         fg="green"
                     )
                 else:
                     error_message = response.json().get('message', 'Unknown error')
                     logger.error(f"Failed to trigger payment: {error_message}")
                     self.result_label.config(text=f"Payment failed: {error_message}", fg="red")
+                    transactions.update(record['transaction_id'], status='payment_failed')
             except Exception as e:
                 logger.error(f"Error triggering payment: {e}")
                 self.result_label.config(text=f"Error triggering payment: {e}", fg="red")
+                transactions.update(record['transaction_id'], status='payment_failed')
+            self.buyer_private_key = None # Not kept after the payment
 
             # Reset system state
-            system_state['item_in_box'] = False
             self.reset_system()
         else:
             # Buyer closed the door without removing the item
-            self.send_seller_message(f"The buyer closed the door without collecting the item.\nTransaction ID: {system_state['transaction_id']}")
+            transactions.update(record['transaction_id'], status='uncollected')
+            self.send_seller_message(f"The buyer closed the door without collecting the item.\nTransaction ID: {record['transaction_id']}")
             try:
-                self.buyer_bot.send_message("You did not collect your item. Please contact the seller.")
+                self.buyer_bot.notify("You did not collect your item. Please contact the seller.")
             except Exception as e:
                 logger.error(f"Error sending notification to buyer: {e}")
             # Notify seller that an item is still in the box
             try:
-                self.seller_bot.send_message("An item was not collected by the buyer. Please reclaim it.")
+                self.seller_bot.notify("An item was not collected by the buyer. Please reclaim it.")
             except Exception as e:
                 logger.error(f"Error notifying seller about uncollected item: {e}")
-            # Reset door status but keep 'item_in_box' as True
+            # Reset the GUI, the item stays in its compartment until the
+            # seller reclaims it
             self.reset_system()
 
     def send_seller_message(self, msg):
         # Send a message to the seller via Telegram
-        self.seller_bot.send_message(msg)
+        self.seller_bot.notify(msg)
 
     def notify_buyer_otp_expired(self):
         # Notify the buyer that the OTP has expired.
         message = "Your OTP has expired. Please contact the seller to request a new OTP."
         try:
-            self.buyer_bot.send_message(message)
+            self.buyer_bot.notify(message)
             logger.info("Buyer notified of OTP expiration.")
         except Exception as e:
             logger.error(f"Error notifying buyer of OTP expiration: {e}")
 
     def reclaim_item(self):
         # Allow the seller to reclaim the uncollected item
-        if system_state.get('item_in_box', False):
+        record = self.transaction()
+        if record is not None and record['status'] in ('uncollected', 'awaiting_pickup'):
             # Reset the system state, assuming the seller has taken back the item
-            self.send_seller_message(f"The seller has reclaimed the uncollected item.\nTransaction ID: {system_state['transaction_id']}")
+            transactions.update(record['transaction_id'], status='cancelled')
+            self.send_seller_message(f"The seller has reclaimed the uncollected item.\nTransaction ID: {record['transaction_id']}")
             try:
-                self.buyer_bot.send_message("The Seller has reclaimed the uncollected item.")
+                self.buyer_bot.notify("The Seller has reclaimed the uncollected item.")
             except Exception as e:
                 logger.error(f"Error sending reclamation message to buyer: {e}")
             # Reset system state
-            system_state['item_in_box'] = False
             self.reset_system()
         else:
             messagebox.showinfo("Info", "No item to reclaim.")
 
     def reset_system(self):
-        # Reset the system after a transaction is completed
-        # Clear seller data
-        system_state.clear()
-        system_state['transaction_active'] = False
-        system_state['item_in_box'] = False
-        self.save_seller_data()
+        # Reset the GUI after a transaction is finished. The transaction
+        # records stay in the transaction store, only the transaction 
+        # shown in the GUI and on the dashboard is cleared.
+        self.transaction_id = None
+        self.transaction_active = False
 
         # Reset other system states
-        update_system_state('door_status', 'Unknown')
-        update_system_state('item_status', 'No item placed')
-        update_system_state('item_collected', False)
-        update_system_state('item_price', None)
-        update_system_state('transaction_id', None)
-        update_system_state('error_logs', [])
-
-        # Reset OTP creation time
-        self.otp_manager.otp_creation_time = None
+        update_system_states({
+            'transaction_active': bool(transactions.find_active()),
+            'item_collected': False,
+            'item_price': None,
+            'transaction_id': None})
 
         # Clear GUI
         self.clear_buyer_gui()
@@ -1269,7 +3928,8 @@ class BlockBoxGUI:
 
     def add_reclaim_button(self):
         # Add a reclaim button to the seller interface if an item is in the box
-        if system_state.get('item_in_box', False) and not hasattr(self.seller_frame, 'reclaim_button'):
+        record = self.transaction()
+        if record is not None and record['status'] == 'uncollected' and not hasattr(self.seller_frame, 'reclaim_button'):
             reclaim_button = tk.Button(self.seller_frame, text="Reclaim Item", command=self.reclaim_item, bg="#f44336", fg="white",
                                         font=("Helvetica", 12, "bold"))
             reclaim_button.grid(row=6, column=0, columnspan=2, padx=20, pady=20, sticky='ew')
@@ -1279,47 +3939,638 @@ class BlockBoxGUI:
     def on_closing(self):
         # Handle the GUI window close event.
         if messagebox.askokcancel("Quit", "Do you want to quit?"):
-            monitor_stop_event.set()
-            hardware.cleanup()
+            shutdown_system()
             self.root.quit()
             self.root.destroy()
 
-# Initialize Tkinter Root
-root = tk.Tk()
-
-# Initialize Keypad
-ROWS = [
-    digitalio.DigitalInOut(board.D17),  # GPIO 17 (Key_R1)
-    digitalio.DigitalInOut(board.D27),  # GPIO 27 (Key_R2)
-    digitalio.DigitalInOut(board.D22),  # GPIO 22 (Key_R3)
-    digitalio.DigitalInOut(board.D10)   # GPIO 10 (Key_R4)
-]
+# Headless Kiosk Class
+class HeadlessKiosk:
+    # State machine that runs the seller listing and buyer pickup flows
+    # of BlockBoxGUI without Tk, for unattended units (BLOCKBOX_MODE=
+    # headless). A flow is started through the Flask API from the 
+    # seller's or buyer's phone and runs in a worker thread while they 
+    # act on the locker itself: door, scale and keypad. As with the GUI
+    # one flow runs at a time. Nothing runs while the kiosk is idle.
+    #   idle -> placing -> listing -> idle         seller lists an item
+    #   idle -> verifying -> collecting -> paying -> idle   buyer pickup
+    #   idle -> reclaiming -> idle                 seller takes item back
+    # Any failure or timeout returns the kiosk to idle.
+    TRANSITIONS = {
+        'idle': ('placing', 'verifying', 'reclaiming'),
+        'placing': ('listing',),
+        'listing': (),
+        'verifying': ('collecting',),
+        'collecting': ('paying',),
+        'paying': (),
+        'reclaiming': (),
+    }
+
+    def __init__(self, buyer_bot, seller_bot, otp_manager):
+        self.buyer_bot = buyer_bot # Telegram buyer bot
+        self.seller_bot = seller_bot # Telegram seller bot
+        self.otp_manager = otp_manager # Instance of the OTPManager class
+        self.state = 'idle'
+        self.transaction_id = None # Transaction of the running flow
+        self.message = "Ready." # Instruction or outcome for the user
+        self.lock = Lock() # Guards the three fields above
+        self.thread = None # Worker thread of the running flow
+        update_system_state('kiosk_state', self.state)
+
+    def status(self):
+        with self.lock:
+            return {'state': self.state, 'transaction_id': self.transaction_id,
+            'message': self.message}
+
+    def transition(self, state, message, transaction_id=None):
+        # Move to state, which must follow the current one
+        with self.lock:
+            if state not in self.TRANSITIONS[self.state]:
+                if self.state != 'idle': # Another flow is running
+                    raise RuntimeError(f"The kiosk is busy ({self.state}).")
+                raise RuntimeError(f"The kiosk cannot go from {self.state} to {state}.")
+            if self.state == 'idle':
+                self.transaction_id = transaction_id
+            self.state = state
+            self.message = message
+        update_system_state('kiosk_state', state)
+        logger.info(f"Kiosk {state}: {message}")
+
+    def finish(self, message):
+        # End the running flow, from any state
+        with self.lock:
+            self.state = 'idle'
+            self.transaction_id = None
+            self.message = message
+        update_system_states({'kiosk_state': 'idle', 
+        'transaction_active': bool(transactions.find_active()),
+        'item_collected': False, 'item_price': None, 'transaction_id': None})
+        logger.info(f"Kiosk idle: {message}")
+
+    def run_flow(self, name, flow, *args):
+        # Worker thread body, the kiosk always ends up idle again
+        try:
+            message = flow(*args)
+        except Exception as e:
+            logger.exception(f"Kiosk {name} failed: {e}")
+            record_error(f"Kiosk {name} failed: {e}", "kiosk")
+            message = f"Error: {e}"
+        self.finish(message)
+
+    def begin(self, state, message, transaction_id, name, flow, *args):
+        # Leave idle and run flow in a worker thread
+        self.transition(state, message, transaction_id)
+        self.thread = Thread(target=self.run_flow, args=(name, flow, *args), daemon=True)
+        self.thread.start()
+
+    # Seller listing
+    def start_listing(self, item_name, description, advertised_weight, 
+    item_price, buyer_address):
+        # Reserve a compartment and unlock it for the seller. The values
+        # are validated by the endpoint.
+        compartment_id = find_free_compartment()
+        if compartment_id is None: # Every compartment holds an item,
+            # has an active transaction or needs taring
+            raise RuntimeError("No compartment is free (each holds an item or needs taring).")
+        transaction_id = generate_transaction_id()
+        self.transition('placing', "Please open the door and place the item inside.",
+        transaction_id) # Fails if another flow is running
+        try:
+            record = transactions.create(transaction_id, compartment_id, 
+            item_name=item_name, description=description, 
+            advertised_weight=advertised_weight, item_price=item_price, 
+            buyer_address=buyer_address)
+            show_transaction(record)
+        except Exception:
+            self.finish("Listing failed.")
+            raise
+        self.thread = Thread(target=self.run_flow, args=('listing', 
+        self.run_listing, transaction_id), daemon=True)
+        self.thread.start()
+        return record
+
+    def run_listing(self, transaction_id):
+        record = transactions.get(transaction_id)
+        hardware = compartments.get(record['compartment'])
+        verifier = WeightVerifier(hardware)
+
+        # Unlock the door to allow the seller to place the item
+        hardware.unlock_door()
+        with tracer.span(transaction_id, 'wait_for_item_placement'):
+            opened = hardware.wait_for_door(closed=False, timeout=KIOSK_PLACEMENT_TIMEOUT)
+            placed = opened and verifier.wait_until_settled(
+            timeout=KIOSK_PLACEMENT_TIMEOUT, condition=lambda weight: weight > 0.1)
+        if not placed or not placed['settled'] or placed['weight'] <= 0.1:
+            if opened: # Nothing was put in, lock up once it is shut
+                hardware.wait_for_door(closed=True, timeout=KIOSK_PLACEMENT_TIMEOUT)
+            hardware.lock_door()
+            transactions.update(transaction_id, status='cancelled')
+            return "No item was placed, the listing was cancelled."
+        update_system_state('item_status', 'Item placed')
+
+        # Wait for seller to close the door
+        with self.lock:
+            self.message = "Item detected. Please close the door."
+        with tracer.span(transaction_id, 'wait_for_door_close'):
+            hardware.wait_for_door(closed=True)
+        hardware.lock_door()
+        self.transition('listing', "Setting the transaction on the blockchain.")
+
+        # Generate OTP, set the transaction and send messages
+        with tracer.span(transaction_id, 'generate_otp'):
+            otp, otp_fields = self.otp_manager.generate_otp(transaction_id)
+        record = transactions.update(transaction_id, **otp_fields)
+        response = call_api(transaction_id, '/set_transaction', {
+            'buyer_address': record['buyer_address'],
+            'item_price_zar': record['item_price']
+        })
+        if response.status_code != 200:
+            message = response.json().get('message')
+            logger.error(f"Failed to set transaction: {message}")
+            record_error(f"Failed to set transaction {transaction_id}: {message}", "kiosk")
+            # The item is locked in, the seller can take it back with
+            # /kiosk/reclaim
+            self.mark_uncollected(transaction_id, f"The transaction could not be set: {message}")
+            return f"Failed to set transaction: {message}"
+
+        # The item is locked in and the buyer can collect it
+        transactions.update(transaction_id, status='awaiting_pickup')
+        self.buyer_bot.notify(buyer_otp_message(record, otp))
+        self.seller_bot.notify(seller_summary_message(record))
+        return "Item listed, OTP sent to the buyer."
+
+    # Buyer pickup
+    def start_pickup(self, transaction_id, buyer_private_key):
+        # Select the buyer's transaction and wait for the OTP on the 
+        # keypad. Without transaction_id the only transaction awaiting
+        # pickup is used.
+        if transaction_id is None:
+            awaiting_pickup = transactions.find(status='awaiting_pickup')
+            if len(awaiting_pickup) != 1:
+                raise ValueError("Please give the transaction ID from your Telegram message."
+                if awaiting_pickup else "No item is awaiting pickup.")
+            transaction_id = awaiting_pickup[0]['transaction_id']
+        record = transactions.get(transaction_id)
+        if record is None or record['status'] != 'awaiting_pickup':
+            raise LookupError("No item is awaiting pickup for this transaction.")
+        if compartments.get(record['compartment']).read_weight() <= 0.1:
+            raise RuntimeError("No item available for collection.")
+        if self.otp_manager.is_otp_expired(record['otp_created_at']):
+            try:
+                self.buyer_bot.notify("Your OTP has expired. Please contact the seller to request a new OTP.")
+            except Exception as e:
+                logger.error(f"Error notifying buyer of OTP expiration: {e}")
+            raise RuntimeError("OTP has expired. Please contact the seller.")
+        self.begin('verifying', "Enter the OTP using the keypad.", transaction_id,
+        'pickup', self.run_pickup, transaction_id, buyer_private_key)
+        return record
+
+    def run_pickup(self, transaction_id, buyer_private_key):
+        record = transactions.get(transaction_id)
+        show_transaction(record)
+        hardware = compartments.get(record['compartment'])
+
+        # Read weight once the scale has settled
+        with tracer.span(transaction_id, 'wait_until_settled') as span:
+            weight_result = WeightVerifier(hardware).wait_until_settled(timeout=SETTLE_TIMEOUT)
+            span.set(settled=weight_result['settled'])
+        if not weight_result['settled']:
+            return f"{weight_result['message']} Please try again."
+        actual_weight = weight_result['weight']
+        advertised_weight = record['advertised_weight'] or 0
+
+        with tracer.span(transaction_id, 'keypad_entry'), keypad_entry_seconds.time():
+            entered_otp = read_keypad_digits(timeout=KIOSK_OTP_TIMEOUT)
+        if entered_otp is None:
+            return "No OTP was entered. Please try again."
+        if not self.otp_manager.verify_otp(entered_otp, record):
+            record_error("Invalid OTP", "pickup", "warning")
+            hardware.lock_door()
+            return "Invalid OTP!"
+        if not (advertised_weight - WEIGHT_TOLERANCE) <= actual_weight <= (advertised_weight + WEIGHT_TOLERANCE):
+            record_error(f"Weight mismatch: Actual {actual_weight:.2f} kg", "pickup", "warning")
+            hardware.lock_door()
+            return f"Weight does not match. Actual: {actual_weight:.2f} kg"
+
+        hardware.unlock_door()
+        self.transition('collecting', "Verification successful! Please collect your item and close the door.")
+        try:
+            self.buyer_bot.notify("Please collect your item now. Once done, close the door.")
+        except Exception as e:
+            logger.error(f"Error sending message to buyer: {e}")
 
-COLS = [
-    digitalio.DigitalInOut(board.D9),   # GPIO 9 (Key_C1)
-    digitalio.DigitalInOut(board.D11),  # GPIO 11 (Key_C2)
-    digitalio.DigitalInOut(board.D13),  # GPIO 13 (Key_C3)
-    digitalio.DigitalInOut(board.D19)   # GPIO 19 (Key_C4)
-]
+        with tracer.span(transaction_id, 'monitor_item_collection'):
+            removed = self.wait_for_removal(hardware)
+        if not removed: # Buyer did not take the item out
+            self.mark_uncollected(transaction_id, "The buyer closed the door without collecting the item.")
+            try:
+                self.buyer_bot.notify("You did not collect your item. Please contact the seller.")
+            except Exception as e:
+                logger.error(f"Error notifying about uncollected item: {e}")
+            return "The item was not collected."
 
-KEYS = [
-    ["1", "2", "3", "A"],
-    ["4", "5", "6", "B"],
-    ["7", "8", "9", "C"],
-    ["*", "0", "#", "D"]
-]
+        # Successful collection. The door is shut, so the scale is 
+        # re-zeroed once the empty box has settled.
+        try:
+            hardware.tare_if_empty()
+        except Exception as e:
+            logger.error(f"Error re-taring scale after collection: {e}")
+        transactions.update(transaction_id, status='awaiting_payment')
+        update_system_state('item_collected', True)
+        self.seller_bot.notify(f"The buyer has successfully collected the item.\nTransaction ID: {transaction_id}")
+        try:
+            self.buyer_bot.notify("Thank you for your purchase!")
+        except Exception as e:
+            logger.error(f"Error sending thank you message to buyer: {e}")
 
-keypad = Matrix_Keypad(COLS, ROWS, KEYS)
+        # Trigger payment via Flask API
+        self.transition('paying', "Submitting the payment.")
+        try:
+            response = call_api(transaction_id, '/trigger_payment', {
+                'buyer_private_key': buyer_private_key,
+                'item_price_zar': record['item_price'],
+                'transaction_id': transaction_id
+            })
+        except Exception as e:
+            logger.error(f"Error triggering payment: {e}")
+            transactions.update(transaction_id, status='payment_failed')
+            return f"Error triggering payment: {e}"
+        if response.status_code not in (200, 202):
+            error_message = response.json().get('message', 'Unknown error')
+            logger.error(f"Failed to trigger payment: {error_message}")
+            transactions.update(transaction_id, status='payment_failed')
+            return f"Payment failed: {error_message}"
+        payment_data = response.json()
+        logger.info(f"Payment submitted. TX Hash: {payment_data['tx_hash']}")
+        return f"Payment submitted! {payment_data['eth_amount']:.6f} ETH pending confirmation."
+
+    def wait_for_removal(self, hardware):
+        # Wait for the door to open, the item to be taken out and the 
+        # door to be shut again, then lock it. Returns True if the item
+        # was removed.
+        removed = False
+        if hardware.wait_for_door(closed=False, timeout=COLLECTION_TIMEOUT):
+            deadline = time.monotonic() + COLLECTION_TIMEOUT
+            while time.monotonic() < deadline:
+                if hardware.read_weight() <= WEIGHT_TOLERANCE:
+                    removed = True
+                    logger.info("Item has been removed from the scale.")
+                    break
+                time.sleep(WEIGHT_SAMPLE_INTERVAL)
+            if not hardware.wait_for_door(closed=True, timeout=COLLECTION_TIMEOUT):
+                record_error(f"Compartment {hardware.compartment_id}: the door was left open.", "door", "warning")
+        hardware.lock_door()
+        return removed
+
+    # Seller reclaim
+    def mark_uncollected(self, transaction_id, reason):
+        # The item stays locked in for its seller, who is sent a reclaim
+        # code over Telegram. Transaction IDs are not secret, so the code
+        # is what shows /kiosk/reclaim that the seller is asking.
+        code, reclaim_fields = self.otp_manager.generate_reclaim_code(transaction_id)
+        transactions.update(transaction_id, status='uncollected', **reclaim_fields)
+        self.seller_bot.notify(f"{reason}\nTransaction ID: {transaction_id}\n"
+        f"Reclaim code: {code}\nGive it to /kiosk/reclaim to take your item back.")
+
+    def issue_missing_reclaim_codes(self):
+        # Uncollected items that have no reclaim code yet, e.g. ones left
+        # by the GUI or locked in by recovery after a restart
+        for record in transactions.find(status='uncollected'):
+            if not record['reclaim_hash']:
+                self.mark_uncollected(record['transaction_id'], 
+                "An uncollected item is waiting in the locker.")
+
+    def start_reclaim(self, transaction_id, reclaim_code):
+        # Unlock the compartment of an uncollected item for its seller
+        record = transactions.get(transaction_id)
+        if record is None or record['status'] != 'uncollected':
+            raise LookupError("No item to reclaim.")
+        if not self.otp_manager.verify_reclaim_code(reclaim_code, record):
+            record_error(f"Invalid reclaim code for transaction {transaction_id}", "reclaim", "warning")
+            raise PermissionError("Invalid reclaim code.")
+        self.begin('reclaiming', "Please open the door and take the item out.", 
+        transaction_id, 'reclaim', self.run_reclaim, transaction_id)
+        return record
+
+    def run_reclaim(self, transaction_id):
+        record = transactions.get(transaction_id)
+        hardware = compartments.get(record['compartment'])
+        hardware.unlock_door()
+        if not self.wait_for_removal(hardware):
+            return "The item was not taken out."
+        try:
+            hardware.tare_if_empty()
+        except Exception as e:
+            logger.error(f"Error re-taring scale after reclaim: {e}")
+        transactions.update(transaction_id, status='cancelled')
+        self.seller_bot.notify(f"The seller has reclaimed the uncollected item.\nTransaction ID: {transaction_id}")
+        try:
+            self.buyer_bot.notify("The Seller has reclaimed the uncollected item.")
+        except Exception as e:
+            logger.error(f"Error sending reclamation message to buyer: {e}")
+        return "Item reclaimed."
 
-# Initialize GUI
-blockbox_gui = BlockBoxGUI(root, hardware, buyer_bot_handler, seller_bot_handler, otp_manager)
+kiosk = None # Created in main() in headless mode
 
-# Set the on_closing method for the GUI
-root.protocol("WM_DELETE_WINDOW", blockbox_gui.on_closing)
+# Kiosk endpoints, they only exist with BLOCKBOX_MODE=headless
+def kiosk_response(start, *args):
+    # Run one of the kiosk's start methods and map its errors to HTTP
+    # status codes
+    if kiosk is None:
+        return jsonify({'success': False, 'message': 'The headless kiosk is not running'}), 404
+    try:
+        record = start(*args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except PermissionError as e: # The caller could not show that the
+        # item is theirs
+        return jsonify({'success': False, 'message': str(e)}), 403
+    except LookupError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except RuntimeError as e: # Another flow is running or the locker
+        # cannot do this now
+        return jsonify({'success': False, 'message': str(e), 'kiosk': kiosk.status()}), 409
+    return jsonify({'success': True, 'compartment': record['compartment'], 
+    **kiosk.status(), 'transaction_id': record['transaction_id']}), 202 
+    # 202 status code means accepted, the flow runs in the background
+
+@app.route('/kiosk', methods=['GET']) # State of the kiosk
+def get_kiosk_state():
+    if kiosk is None:
+        return jsonify({'message': 'The headless kiosk is not running'}), 404
+    return jsonify(kiosk.status()), 200
+
+@app.route('/kiosk/listing', methods=['POST']) # Seller lists an item
+def kiosk_listing():
+    # Expects JSON with 'item_name', 'description', 'advertised_weight',
+    # 'item_price' (Rands) and 'buyer_address', like the seller form
+    data = request.get_json(silent=True) or {}
+    item_name = str(data.get('item_name') or '').strip()
+    description = str(data.get('description') or '').strip()
+    buyer_address = str(data.get('buyer_address') or '').strip()
+    try: # Ensure that weight and price are numbers only
+        advertised_weight = float(data.get('advertised_weight'))
+        item_price = float(data.get('item_price'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': "Please enter valid NUMBERS for weight and price."}), 400
+    if advertised_weight <= 0 or item_price <= 0: #non-negative numbers
+        return jsonify({'success': False, 'message': "Item weight and price must be greater than 0."}), 400
+    if not (item_name and description and buyer_address):
+        return jsonify({'success': False, 'message': "Please fill in all fields and provide the buyer's Ethereum address."}), 400
+    return kiosk_response(kiosk.start_listing if kiosk else None, item_name,
+    description, advertised_weight, item_price, buyer_address)
+
+@app.route('/kiosk/pickup', methods=['POST']) # Buyer collects an item
+def kiosk_pickup():
+    # Expects JSON with 'buyer_private_key' and, if several items are 
+    # waiting, 'transaction_id'. The buyer then types the OTP on the 
+    # keypad.
+    data = request.get_json(silent=True) or {}
+    buyer_private_key = str(data.get('buyer_private_key') or '').strip()
+    if not buyer_private_key:
+        return jsonify({'success': False, 'message': "Please enter your Ethereum private key."}), 400
+    transaction_id = data.get('transaction_id')
+    transaction_id = str(transaction_id).strip().upper() if transaction_id else None
+    return kiosk_response(kiosk.start_pickup if kiosk else None, 
+    transaction_id, buyer_private_key)
+
+@app.route('/kiosk/reclaim', methods=['POST']) # Seller takes back an
+# uncollected item, {"transaction_id", "reclaim_code"}
+def kiosk_reclaim():
+    # The reclaim code is the one sent to the seller's Telegram when the
+    # item was not collected
+    data = request.get_json(silent=True) or {}
+    transaction_id = str(data.get('transaction_id') or '').strip().upper()
+    reclaim_code = str(data.get('reclaim_code') or '').strip().upper()
+    if not reclaim_code:
+        return jsonify({'success': False, 'message': "Please enter the reclaim code from your Telegram message."}), 400
+    return kiosk_response(kiosk.start_reclaim if kiosk else None, 
+    transaction_id, reclaim_code)
+
+# Startup Profile Class
+class StartupProfile:
+    # Timing of every phase of main(). Phases that do not depend on each
+    # other run at the same time, so each one records when it started
+    # (in seconds since the module began importing) as well as how long
+    # it took. The report is logged once the system is ready and served
+    # by /startup.
+    def __init__(self, boot_clock=BOOT_CLOCK):
+        self.boot_clock = boot_clock # perf_counter() at import
+        self.boot_time = time.time() - (time.perf_counter() - boot_clock)
+        self.phases = [] # Timing dictionary of every finished phase
+        self.lock = Lock() # Guards phases
+        self.ready_after = None # Seconds from boot until ready
+
+    def add(self, name, start, duration, error=None):
+        phase = {'name': name, 'start': round(start - self.boot_clock, 4),
+        'duration': round(duration, 4), 'thread': current_thread().name,
+        'error': error}
+        with self.lock:
+            self.phases.append(phase)
+        startup_seconds.set(duration, phase=name)
+        logger.info(f"Startup phase {name} took {duration:.3f} s" + 
+        (f" and failed: {error}" if error else "."))
+
+    def run(self, name, function, *args):
+        # Call function as the phase called name and return its result
+        start = time.perf_counter()
+        try:
+            result = function(*args)
+        except Exception as e:
+            self.add(name, start, time.perf_counter() - start, str(e))
+            raise
+        self.add(name, start, time.perf_counter() - start)
+        return result
 
-# Start Tkinter main loop
-try:
-    root.mainloop()
-except Exception as e:
-    logger.critical(f"Unhandled exception in Tkinter main loop: {e}")
-    hardware.cleanup()
+    def ready(self):
+        # Everything is up, log the report
+        self.ready_after = time.perf_counter() - self.boot_clock
+        report = self.report()
+        logger.info(f"Startup complete after {self.ready_after:.3f} s.")
+        for phase in report['phases']:
+            logger.info(f"  {phase['name']:<12} {phase['start']:8.3f} s "
+            f"+{phase['duration']:.3f} s ({phase['thread']})")
+
+    def report(self):
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase['start'])
+        return {'boot_time': self.boot_time, 'ready': self.ready_after is not None,
+        'ready_after': self.ready_after, 'phases': phases}
+
+startup_seconds = metrics.gauge('blockbox_startup_phase_seconds',
+'Duration of each startup phase.', ('phase',))
+startup_profile = StartupProfile() # Filled in by main()
+
+@app.route('/startup') # Per-phase startup timing report
+def get_startup_profile():
+    return jsonify(startup_profile.report()), 200
+
+# Startup phases
+def start_hardware():
+    # GPIO, door sensors and load cells of every compartment (a load 
+    # cell without a stored calibration is tared here), then the sensor
+    # scheduler that samples them
+    global hardware_backend, hardware, sensor_scheduler
+
+    # Real Pi hardware or the simulator, from BLOCKBOX_HARDWARE
+    hardware_backend = create_hardware_backend()
+
+    compartments.setup() # Initialisation of the hardware controller of
+    # every compartment
+    hardware = compartments.get(DEFAULT_COMPARTMENT)
+
+    # Concurrent sampling of every compartment's load cell
+    sensor_scheduler = SensorScheduler(compartments)
+    sensor_scheduler.start()
+
+    for controller in compartments.controllers():
+        update_compartment_state(controller.compartment_id, 'door_status', 
+        'Closed' if controller.is_door_closed() else 'Open')
+        controller.subscribe_door(on_door_event)
+
+def start_telegram(buyer_token, buyer_chat_id, seller_token, seller_chat_id):
+    # Telegram Bot Handlers, which run on one event loop, and the outbox
+    # that delivers their notifications in the background
+    global buyer_bot_handler, seller_bot_handler
+    telegram_loop.start()
+    buyer_bot_handler = TelegramHandler(buyer_token, buyer_chat_id, "buyer")
+    seller_bot_handler = TelegramHandler(seller_token, seller_chat_id, "seller")
+    notification_outbox.start()
+
+def connect_blockchain():
+    # Connection to the Ethereum network is made once and shared by all
+    # API requests. This runs in the background as importing web3 and 
+    # connecting to Infura is the slowest part of startup. A failure is
+    # not fatal as get_blockchain() retries on the first request that 
+    # needs it.
+    try:
+        startup_profile.run('blockchain', get_blockchain)
+    except Exception as e:
+        logger.error(f"Blockchain client not available at startup: {e}")
+
+def start_services():
+    # Background work that needs the hardware and the Flask server
+    flask_server.start() # Start serving in a separate thread
+
+    # Background refresh of the cached ETH/USD and USD/ZAR quotes
+    price_oracle.start()
+
+    # Background confirmation of submitted payments
+    payment_tracker.start()
+
+    # Function to run in monitor_system which takes the stop event as 
+    # argument
+    monitor_thread = Thread(target=monitor_system, args=(monitor_stop_event,))
+    monitor_thread.daemon = True # When system stops, event stops, 
+    # monitor then also stops
+    monitor_thread.start() # Starting the monitoring in a different thread
+
+def load_gui_libraries():
+    # Tkinter and PIL are imported here, in GUI mode only
+    global tk, filedialog, messagebox, simpledialog, Image, ImageTk
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, simpledialog
+    from PIL import Image, ImageTk
+
+def start_gui():
+    # Tkinter root, keypad and the GUI, on the main thread
+    global keypad
+    load_gui_libraries()
+    root = tk.Tk() # Initialize Tkinter Root
+    keypad = hardware_backend.create_keypad() # Initialize Keypad
+    blockbox_gui = BlockBoxGUI(root, hardware, buyer_bot_handler, seller_bot_handler, otp_manager)
+    # Set the on_closing method for the GUI
+    root.protocol("WM_DELETE_WINDOW", blockbox_gui.on_closing)
+    return root
+
+def start_kiosk():
+    # Keypad and the headless kiosk state machine
+    global keypad, kiosk
+    keypad = hardware_backend.create_keypad() # Initialize Keypad
+    kiosk = HeadlessKiosk(buyer_bot_handler, seller_bot_handler, otp_manager)
+    kiosk.issue_missing_reclaim_codes()
+    return kiosk
+
+flask_server = None # Bound in main()
+
+def start_system():
+    # Start the Block Box system in phases: configuration, then the 
+    # hardware, Telegram bots and web server socket at the same time as
+    # none of them depend on each other, with transaction recovery 
+    # following the hardware as it re-locks compartments, then the 
+    # background services. The blockchain client connects in the 
+    # background.
+    global flask_server, otp_manager
+    startup_profile.add('import', BOOT_CLOCK, time.perf_counter() - BOOT_CLOCK)
+
+    # Configuration is checked first so a bad .env fails straight away
+    try:
+        if RUN_MODE not in ('gui', 'headless'):
+            raise EnvironmentError(f"Unknown BLOCKBOX_MODE: {RUN_MODE}")
+        TELEGRAM_TOKEN, CHAT_ID, SELLER_TELEGRAM_TOKEN, SELLER_CHAT_ID, OTP_SECRET = startup_profile.run('config', load_env_variables)
+    except EnvironmentError as e:
+        logger.critical(f"Environment variable error: {e}")
+        exit(1)
+
+    # Initialisation of OTP Manager with OTP_SECRET for user/system 
+    # validation
+    otp_manager = OTPManager(OTP_SECRET)
+
+    startup_profile.run('journal', open_journal) # Needed by recovery
+
+    Thread(target=connect_blockchain, name='startup-blockchain', daemon=True).start()
+
+    def start_hardware_and_recover():
+        startup_profile.run('hardware', start_hardware)
+        # Resume transactions that were in flight before a reboot, once
+        # every compartment is registered and can be re-locked
+        startup_profile.run('recovery', recover_transactions)
+
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix='startup') as pool:
+        web_server = pool.submit(startup_profile.run, 'web_server', FlaskServer, app)
+        phases = [
+            pool.submit(start_hardware_and_recover),
+            pool.submit(startup_profile.run, 'telegram', start_telegram, 
+            TELEGRAM_TOKEN, CHAT_ID, SELLER_TELEGRAM_TOKEN, SELLER_CHAT_ID),
+            web_server,
+        ]
+    for phase in phases: # Re-raise the first failure like a serial boot
+        phase.result()
+    flask_server = web_server.result()
+
+    startup_profile.run('services', start_services)
+
+def run_gui():
+    # The GUI runs until the window is closed
+    root = startup_profile.run('gui', start_gui)
+    startup_profile.ready()
+
+    # Start Tkinter main loop
+    try:
+        root.mainloop()
+    except Exception as e:
+        logger.critical(f"Unhandled exception in Tkinter main loop: {e}")
+        sensor_scheduler.stop()
+        compartments.cleanup()
+
+def run_headless():
+    # The kiosk is driven by the API and keypad from other threads, the
+    # main thread only waits for SIGTERM (systemd) or SIGINT (Ctrl+C)
+    startup_profile.run('kiosk', start_kiosk)
+    startup_profile.ready()
+    stop_event = Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda signum, frame: stop_event.set())
+    stop_event.wait()
+    logger.info("Stopping the headless kiosk.")
+    flask_server.shutdown()
+    shutdown_system()
+
+def main():
+    start_system()
+    if RUN_MODE == 'headless':
+        run_headless()
+    else:
+        run_gui()
+
+if __name__ == "__main__":
+    main()
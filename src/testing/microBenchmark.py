@@ -0,0 +1,333 @@
+# Micro-benchmarks of the Block Box hot paths, the code that runs every
+# sample interval or on every request:
+#   - Matrix_Keypad.pressed_keys against fake digitalio pins
+#   - HardwareController.read_weight and is_door_closed on the simulator
+#   - update_system_state with 1 to 8 writer threads
+#   - /system_state serialisation for 1 to 16 compartments
+#   - calculate_eth_amount with a stubbed JSON-RPC node and rate API
+# Results can be written to JSON and compared with an earlier run, e.g.
+#   python src/testing/microBenchmark.py --json before.json
+#   (change the code)
+#   python src/testing/microBenchmark.py --json after.json --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import types
+from threading import Thread, Barrier
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(TESTING_DIR)
+ETH_USD = 3000.0
+USD_PER_ZAR = 0.055
+FEED_DECIMALS = 8 # Chainlink ETH/USD feed
+LATEST_ROUND_DATA = '0xfeaf968c' # Function selectors of the feed
+DECIMALS = '0x313ce567'
+
+def load_blockbox():
+    # blockbox.py reads its configuration from the environment at import
+    os.environ.update({'BLOCKBOX_HARDWARE': 'sim', 'BLOCKBOX_SIM_NOISE': '0.003',
+    'SELLER_ADDRESS': '0x' + '11' * 20, 'API_KEY': 'benchmark'})
+    # Log and calibration files go to a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix='blockbox-microbenchmark-'))
+    sys.path.insert(0, SRC_DIR)
+    import blockbox
+    return blockbox
+
+def measure(function, repeat, min_time):
+    # Seconds per call of function: timeit picks a loop count that runs
+    # for at least min_time and the loop is timed repeat times
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    runs = [total / number for total in timer.repeat(repeat=repeat, number=number)]
+    return {'unit': 'ns/call', 'loops': number, 'min': min(runs) * 1e9,
+    'median': statistics.median(runs) * 1e9, 'max': max(runs) * 1e9}
+
+# Fake CircuitPython digitalio for the keypad driver
+class Direction:
+    INPUT = 'input'
+    OUTPUT = 'output'
+
+class Pull:
+    UP = 'up'
+    DOWN = 'down'
+
+class FakePin:
+    # A pin of the keypad matrix. A column reads LOW while a pressed key
+    # connects it to the row that is driven LOW.
+    def __init__(self, matrix, row=None, col=None):
+        self.matrix = matrix
+        self.row = row
+        self.col = col
+        self.direction = Direction.INPUT
+        self.pull = Pull.UP
+        self.level = True
+
+    @property
+    def value(self):
+        if self.col is None:
+            return self.level
+        for row, row_pin in enumerate(self.matrix.row_pins):
+            if (row, self.col) in self.matrix.pressed and \
+            row_pin.direction == Direction.OUTPUT and not row_pin.level:
+                return False
+        return True
+
+    @value.setter
+    def value(self, level):
+        self.level = level
+
+class FakeMatrix:
+    def __init__(self, rows, cols):
+        self.pressed = set() # (row, col) of the keys held down
+        self.row_pins = [FakePin(self, row=row) for row in range(rows)]
+        self.col_pins = [FakePin(self, col=col) for col in range(cols)]
+
+def load_matrix_keypad():
+    # adafruit_matrixkeypad only needs Direction and Pull from digitalio
+    sys.modules.setdefault('digitalio', types.SimpleNamespace(Direction=Direction,
+    Pull=Pull, DigitalInOut=FakePin))
+    sys.path.insert(0, TESTING_DIR)
+    from adafruit_matrixkeypad import Matrix_Keypad
+    return Matrix_Keypad
+
+def bench_keypad(blockbox, args):
+    Matrix_Keypad = load_matrix_keypad()
+    keys = blockbox.KEYPAD_KEYS
+    matrix = FakeMatrix(len(keys), len(keys[0]))
+    driver = Matrix_Keypad(matrix.row_pins, matrix.col_pins, keys)
+    results = {}
+    results['keypad.pressed_keys[idle]'] = measure(lambda: driver.pressed_keys,
+    args.repeat, args.min_time)
+    matrix.pressed = {(1, 1)} # Key 5 held down
+    assert driver.pressed_keys == ['5']
+    results['keypad.pressed_keys[one key]'] = measure(lambda: driver.pressed_keys,
+    args.repeat, args.min_time)
+    return results
+
+def bench_hardware(blockbox, args):
+    # The controller reads the filtered weight and debounced door state
+    # kept by the sampling thread and door events, so no scheduler runs
+    blockbox.hardware_backend = blockbox.create_hardware_backend('sim')
+    controller = blockbox.HardwareController(blockbox.DEFAULT_COMPARTMENT)
+    for _ in range(blockbox.WEIGHT_BUFFER_SIZE):
+        controller.sample_weight()
+    results = {}
+    results['hardware.read_weight'] = measure(controller.read_weight,
+    args.repeat, args.min_time)
+    results['hardware.is_door_closed'] = measure(controller.is_door_closed,
+    args.repeat, args.min_time)
+    results['hardware.sample_weight'] = measure(controller.sample_weight,
+    args.repeat, args.min_time) # What the scheduler does every tick
+    controller.cleanup()
+    return results
+
+def bench_state_updates(blockbox, args):
+    # Every thread writes its own changing value so each update produces
+    # a new snapshot, as the door, weight and GUI threads do
+    results = {}
+    for threads in (1, 2, 4, 8):
+        updates = args.updates
+        barrier = Barrier(threads + 1)
+        latencies = [[] for _ in range(threads)]
+
+        def writer(index):
+            samples = latencies[index]
+            barrier.wait()
+            for n in range(updates):
+                start = time.perf_counter_ns()
+                blockbox.update_system_state('item_status', f"{index}:{n}")
+                samples.append(time.perf_counter_ns() - start)
+
+        workers = [Thread(target=writer, args=(index,)) for index in range(threads)]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        samples = sorted(sample for thread_samples in latencies for sample in thread_samples)
+        results[f"update_system_state[{threads} threads]"] = {'unit': 'ns/call',
+        'loops': len(samples), 'min': samples[0],
+        'median': samples[len(samples) // 2],
+        'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        'max': samples[-1], 'updates_per_second': len(samples) / elapsed}
+    return results
+
+def realistic_state(blockbox, compartment_count):
+    # System state of a box with compartment_count compartments, one of
+    # them mid-transaction
+    values = blockbox.state_store.snapshot().to_dict()
+    values.update({'door_status': 'Locked', 'item_status': 'Item placed',
+    'item_price': 249.99, 'transaction_id': 'Q7K2ZP', 'item_in_box': True,
+    'transaction_active': True, 'error_seq': 42, 'compartment': '1'})
+    values['compartments'] = {str(number): {'door_status': 'Locked',
+    'item_status': 'Item placed' if number == 1 else 'No item placed',
+    'item_in_box': number == 1} for number in range(1, compartment_count + 1)}
+    return values
+
+def bench_state_serialisation(blockbox, args):
+    results = {}
+    client = blockbox.app.test_client()
+    for compartment_count in (1, 4, 16):
+        values = realistic_state(blockbox, compartment_count)
+        label = f"{compartment_count} compartment(s)"
+
+        def serialise_new_snapshot():
+            # A snapshot is serialised once per state version
+            return blockbox.StateSnapshot(1, values).to_json()
+
+        def jsonify_state():
+            return blockbox.jsonify(values).get_data()
+
+        size = len(serialise_new_snapshot())
+        results[f"state.to_json[{label}]"] = {**measure(serialise_new_snapshot,
+        args.repeat, args.min_time), 'bytes': size}
+        with blockbox.app.app_context():
+            results[f"state.jsonify[{label}]"] = {**measure(jsonify_state,
+            args.repeat, args.min_time), 'bytes': size}
+
+        blockbox.state_store.update(values)
+        results[f"GET /system_state[{label}]"] = {**measure(
+        lambda: client.get('/system_state').get_data(), args.repeat,
+        args.min_time), 'bytes': size}
+    return results
+
+class StubRPCProvider:
+    # Answers the JSON-RPC calls of BlockchainIntegration in-process. The
+    # request and response still go through JSON encoding so only the
+    # network round trip is left out.
+    def __init__(self, base):
+        self.base = base
+
+    def create(self):
+        from eth_abi import encode
+        latest_round = '0x' + encode(['uint80', 'int256', 'uint256', 'uint256', 'uint80'],
+        [1, int(ETH_USD * 10 ** FEED_DECIMALS), 0, int(time.time()), 1]).hex()
+        decimals = '0x' + encode(['uint8'], [FEED_DECIMALS]).hex()
+
+        class Provider(self.base):
+            def make_request(self, method, params):
+                request = json.loads(self.encode_rpc_request(method, params))
+                if method == 'eth_call':
+                    data = params[0].get('data') or params[0].get('input')
+                    result = latest_round if data.startswith(LATEST_ROUND_DATA) else decimals
+                elif method == 'eth_chainId':
+                    result = hex(11155111)
+                elif method == 'eth_getBalance':
+                    result = hex(10 ** 18)
+                else:
+                    result = 'stub'
+                response = json.dumps({'jsonrpc': '2.0', 'id': request['id'], 'result': result})
+                return self.decode_rpc_response(response.encode())
+
+        return Provider()
+
+class StubResponse:
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'base': 'ZAR', 'rates': {'USD': USD_PER_ZAR}}
+
+class StubSession:
+    # Stands in for the requests session used for the exchange rate API
+    def get(self, url, timeout=None):
+        return StubResponse()
+
+def bench_eth_amount(blockbox, args):
+    from web3.providers import JSONBaseProvider
+    provider = StubRPCProvider(JSONBaseProvider).create()
+    chain = blockbox.BlockchainIntegration(session=StubSession(), provider=provider)
+    oracle = blockbox.price_oracle
+    results = {}
+
+    def cold():
+        # Both quotes expired: Chainlink call and exchange rate request
+        with oracle.lock:
+            oracle.quotes.clear()
+        return chain.calculate_eth_amount(100.0)
+
+    expected = 100.0 * USD_PER_ZAR / ETH_USD
+    assert abs(cold() - expected) < 1e-12
+    results['calculate_eth_amount[cold quotes]'] = measure(cold, args.repeat, args.min_time)
+    results['calculate_eth_amount[cached quotes]'] = measure(
+    lambda: chain.calculate_eth_amount(100.0), args.repeat, args.min_time)
+    results['get_price_and_balance[cached quote]'] = measure(
+    lambda: chain.get_price_and_balance(chain.seller_address), args.repeat, args.min_time)
+    return results
+
+BENCHMARKS = {
+    'keypad': bench_keypad,
+    'hardware': bench_hardware,
+    'state_updates': bench_state_updates,
+    'state_serialisation': bench_state_serialisation,
+    'eth_amount': bench_eth_amount,
+}
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+        cwd=SRC_DIR, capture_output=True, text=True).stdout.strip() or None
+    except Exception:
+        return None
+
+def print_results(results, baseline=None):
+    print(f"{'benchmark':<48}{'median':>12}{'min':>12}  change")
+    for name, result in results.items():
+        change = ''
+        if baseline and name in baseline:
+            before = baseline[name]['median']
+            change = f"{(result['median'] - before) / before * 100:+.1f}%"
+        print(f"{name:<48}{format_ns(result['median']):>12}{format_ns(result['min']):>12}  {change}")
+
+def format_ns(value):
+    if value >= 1e6:
+        return f"{value / 1e6:.2f} ms"
+    if value >= 1e3:
+        return f"{value / 1e3:.2f} us"
+    return f"{value:.0f} ns"
+
+def main():
+    parser = argparse.ArgumentParser(description="Block Box hot path micro-benchmarks")
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help="benchmark groups to run")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument('--min-time', type=float, default=0.2, help="minimum seconds per timed run")
+    parser.add_argument('--updates', type=int, default=5000, help="state updates per writer thread")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(os.path.abspath(args.compare)) as file:
+            baseline = json.load(file)['results']
+    output = os.path.abspath(args.json) if args.json else None
+
+    blockbox = load_blockbox()
+    results = {}
+    for name in args.only or BENCHMARKS:
+        print(f"Running {name}...")
+        results.update(BENCHMARKS[name](blockbox, args))
+    print()
+    print_results(results, baseline)
+
+    if output:
+        report = {'revision': git_revision(), 'timestamp': time.time(),
+        'python': platform.python_version(), 'platform': platform.platform(),
+        'config': vars(args), 'results': results}
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"\nResults written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Checks that the notification outbox keeps the order of a chat's
+# messages when a send fails while a newer message is queued: the failed
+# message has to be retried and delivered before the newer one.
+#   python src/testing/outboxTest.py
+
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+from threading import Event, Lock, Thread
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(TESTING_DIR)
+
+def load_blockbox():
+    # blockbox.py reads its configuration from the environment at import
+    os.environ.update({'BLOCKBOX_HARDWARE': 'sim'})
+    # The log file goes to a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix='blockbox-outboxtest-'))
+    sys.path.insert(0, SRC_DIR)
+    import blockbox
+    return blockbox
+
+# Stand-in for TelegramHandler, the first send fails once the newer
+# message is queued
+class FlakyHandler:
+    def __init__(self):
+        self.role = 'buyer'
+        self.chat_id = '1'
+        self.delivered = [] # Texts accepted by "Telegram"
+        self.attempts = 0
+        self.lock = Lock()
+        self.first_send = Event() # Set when the first send started
+        self.fail_first = Event() # Set to let the first send fail
+
+    def send_async(self, message):
+        future = Future()
+        with self.lock:
+            self.attempts += 1
+            attempt = self.attempts
+        if attempt == 1:
+            self.first_send.set()
+            def fail():
+                self.fail_first.wait(5)
+                future.set_exception(ConnectionError("network is down"))
+            Thread(target=fail, daemon=True).start()
+        else:
+            with self.lock:
+                self.delivered.append(message)
+            future.set_result(None)
+        return future
+
+def check_failed_send_keeps_order(blockbox):
+    # No coalescing or per-chat spacing so the newer message is due at
+    # once, and a short backoff so the retry follows quickly
+    blockbox.OUTBOX_COALESCE_WINDOW = 0
+    blockbox.TELEGRAM_CHAT_INTERVAL = 0
+    blockbox.OUTBOX_BACKOFF_BASE = 0.05
+    outbox = blockbox.NotificationOutbox()
+    handler = FlakyHandler()
+
+    # The warning logged on a failed send is where the outbox used to
+    # free the chat before the batch was back in the queue. It is made
+    # slow so the worker would have time to send the newer message.
+    warning = blockbox.logger.warning
+    def slow_warning(message, *args, **kwargs):
+        warning(message, *args, **kwargs)
+        time.sleep(0.3)
+    blockbox.logger.warning = slow_warning
+    try:
+        outbox.start()
+        outbox.enqueue(handler, "first")
+        assert handler.first_send.wait(5), "The first message was never sent"
+        outbox.enqueue(handler, "second") # Queued while first is in flight
+        handler.fail_first.set()
+
+        deadline = time.time() + 5
+        while not all(text in "\n\n".join(handler.delivered) for text in ("first", "second")):
+            assert time.time() < deadline, f"Not delivered: {handler.delivered}"
+            time.sleep(0.01)
+    finally:
+        outbox.stop()
+        blockbox.logger.warning = warning
+
+    delivered = "\n\n".join(handler.delivered)
+    assert delivered.index("first") < delivered.index("second"), \
+    f"Messages delivered out of order: {handler.delivered}"
+    print(f"Delivered in order after a failed send: {handler.delivered}")
+
+if __name__ == "__main__":
+    check_failed_send_keeps_order(load_blockbox())
+    print("OK")
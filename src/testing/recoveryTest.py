@@ -0,0 +1,112 @@
+# Checks that transactions left behind by a reboot are resumed with the
+# compartments that may hold a parcel locked, when the system starts its
+# phases in parallel. setup_gpio leaves every lock open, so recovery has
+# to run after the hardware phase has registered the compartments and
+# has to lock every compartment a parcel may be in:
+#   1 - awaiting pickup, stays awaiting pickup and locked
+#   2 - uncollected, the item waits for its seller and stays locked
+#   3 - listing with the item already placed, locked in for the seller
+#       to reclaim (uncollected)
+#   4 - listing with nothing placed, cancelled
+# The hardware phase is slowed down so recovery would otherwise win the
+# race.
+#   python src/testing/recoveryTest.py
+
+import os
+import socket
+import sys
+import tempfile
+import time
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(TESTING_DIR)
+PARCEL_WEIGHT = 1.0 # kg
+# Compartment -> (transaction ID, status journaled before the reboot,
+# parcel inside, expected status after recovery, expected locked)
+CASES = {
+    '1': ('ABC123', 'awaiting_pickup', True, 'awaiting_pickup', True),
+    '2': ('DEF456', 'uncollected', True, 'uncollected', True),
+    '3': ('GHI789', 'listing', True, 'uncollected', True),
+    '4': ('JKL012', 'listing', False, 'cancelled', None),
+}
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def load_blockbox():
+    # blockbox.py reads its configuration from the environment at import
+    os.environ.update({
+        'BLOCKBOX_MODE': 'headless',
+        'BLOCKBOX_HARDWARE': 'sim',
+        'BLOCKBOX_PORT': str(free_port()),
+        'TELEGRAM_BASE_URL': 'http://127.0.0.1:9/bot', # Nothing is sent
+        'BUYER_TELEGRAM_TOKEN': '1:buyer', 'BUYER_CHAT_ID': '1',
+        'SELLER_TELEGRAM_TOKEN': '2:seller', 'SELLER_CHAT_ID': '2',
+        'OTP_SECRET': 'JBSWY3DPEHPK3PXP', 'API_KEY': 'test',
+        'SELLER_ADDRESS': '0x' + '11' * 20,
+    })
+    # Log, journal and calibration files go to a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix='blockbox-recoverytest-'))
+    sys.path.insert(0, SRC_DIR)
+    import blockbox
+    return blockbox
+
+def add_compartments(blockbox):
+    # One simulated compartment per case, each on its own pins
+    for compartment_id in CASES:
+        offset = 100 + 10 * int(compartment_id)
+        blockbox.COMPARTMENTS.setdefault(compartment_id, {'lock_pin': offset,
+        'door_pin': offset + 1, 'data_pin': offset + 2, 'sck_pin': offset + 3})
+
+def journal_transactions(blockbox):
+    # The journal as a reboot would leave it
+    journal = blockbox.TransactionJournal(blockbox.JOURNAL_FILE)
+    store = blockbox.TransactionStore(journal)
+    for compartment_id, (transaction_id, status, _, _, _) in CASES.items():
+        store.create(transaction_id, compartment_id, item_name='Book',
+        advertised_weight=PARCEL_WEIGHT, item_price=100, buyer_address='0x' + '22' * 20)
+        if status != 'listing':
+            store.update(transaction_id, status=status, otp_created_at=time.time())
+    journal.close()
+
+def check_recovery_relocks_compartments(blockbox):
+    add_compartments(blockbox)
+    journal_transactions(blockbox)
+
+    start_hardware = blockbox.start_hardware
+    def slow_start_hardware():
+        time.sleep(0.5) # Slower than the other startup phases
+        start_hardware()
+        # The parcels were in the compartments all along, they are put
+        # in once the simulated scales exist and given time to settle
+        world = blockbox.hardware_backend.world
+        for compartment_id, (_, _, parcel, _, _) in CASES.items():
+            if parcel:
+                world.open_door(compartment_id)
+                world.set_parcel(compartment_id, PARCEL_WEIGHT)
+                world.close_door(compartment_id)
+        time.sleep(3)
+    blockbox.start_hardware = slow_start_hardware
+
+    blockbox.start_system()
+    try:
+        world = blockbox.hardware_backend.world
+        for compartment_id, (transaction_id, _, _, status, locked) in CASES.items():
+            record = blockbox.transactions.get(transaction_id)
+            assert record['status'] == status, \
+            f"Transaction {transaction_id} is {record['status']}, expected {status}"
+            if locked:
+                assert world.is_locked(compartment_id), \
+                f"Compartment {compartment_id} was left unlocked after recovery"
+            print(f"Compartment {compartment_id}: transaction {transaction_id} is {status}"
+            f"{', locked' if world.is_locked(compartment_id) else ''}.")
+        assert blockbox.state_store.get('transaction_active'), "No active transaction"
+    finally:
+        blockbox.flask_server.shutdown()
+        blockbox.shutdown_system()
+
+if __name__ == "__main__":
+    check_recovery_relocks_compartments(load_blockbox())
+    print("OK")
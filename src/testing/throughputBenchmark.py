@@ -0,0 +1,357 @@
+# End-to-end throughput benchmark of the Block Box parcel cycle.
+# Runs the headless kiosk (BLOCKBOX_MODE=headless) against the hardware
+# simulator, an in-process eth-tester chain in place of Infura and a 
+# stub Telegram Bot API server. Every cycle lists an item through 
+# /kiosk/listing, places it, reads the OTP from the buyer's Telegram 
+# message, types it on the simulated keypad after /kiosk/pickup, takes
+# the item out and waits for the payment to be confirmed. The p50/p95/
+# p99 latency of every stage and the number of cycles per minute are
+# reported.
+#
+# Usage:
+#   python src/testing/throughputBenchmark.py --cycles 20 --json out.json
+# Needs eth-tester on top of blockbox.py's requirements:
+#   pip install "eth-tester[py-evm]"
+
+import argparse
+import json
+import math
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Condition
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ['list', 'place', 'otp', 'verify', 'collect', 'pay', 'notify']
+ETH_USD = 3000.0 # Fixed quotes so the chain needs no Chainlink feed
+USD_PER_ZAR = 0.055
+PARCEL_WEIGHT = 2.5 # kg, advertised and placed
+ITEM_PRICE_ZAR = 150.0
+POLL_INTERVAL = 0.02 # Seconds between checks of the kiosk state
+
+# Stub Telegram Bot API
+class TelegramStub(BaseHTTPRequestHandler):
+    # Answers sendMessage (and anything else) like the Bot API does after
+    # an optional delay and keeps the text of every message, so the 
+    # benchmark can read the buyer's OTP like the buyer would.
+    latency = 0.0
+    condition = Condition() # Guards texts, notified on every message
+    texts = []
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode() if length else ''
+        params = parse_body(body, self.headers.get('Content-Type', ''))
+        if self.latency:
+            time.sleep(self.latency)
+        with TelegramStub.condition:
+            TelegramStub.texts.append(params.get('text', ''))
+            message_id = len(TelegramStub.texts)
+            TelegramStub.condition.notify_all()
+        result = {'message_id': message_id, 'date': int(time.time()),
+        'chat': {'id': int(params.get('chat_id', 1)), 'type': 'private'},
+        'text': params.get('text', '')}
+        payload = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass # Keep the benchmark output readable
+
+    @classmethod
+    def wait_for_otp(cls, transaction_id, timeout):
+        # OTP from the buyer's message for transaction_id
+        pattern = re.compile(rf"Transaction ID: {transaction_id}\n.*OTP to retrieve the item is: (\d+)", re.S)
+        def find():
+            for text in cls.texts:
+                match = pattern.search(text)
+                if match:
+                    return match.group(1)
+        with cls.condition:
+            return cls.condition.wait_for(find, timeout)
+
+def parse_body(body, content_type):
+    if 'json' in content_type:
+        return json.loads(body or '{}')
+    from urllib.parse import parse_qs
+    return {key: values[0] for key, values in parse_qs(body).items()}
+
+def start_telegram_stub(latency):
+    TelegramStub.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TelegramStub)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/bot"
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def load_blockbox(args, telegram_url):
+    # blockbox.py reads its configuration from the environment at import
+    port = free_port()
+    os.environ.update({
+        'BLOCKBOX_MODE': 'headless',
+        'BLOCKBOX_HARDWARE': 'sim',
+        'BLOCKBOX_SIM_NOISE': str(args.noise),
+        'BLOCKBOX_SIM_SETTLE_TIME': str(args.settle_time),
+        'BLOCKBOX_SIM_SAMPLE_TIME': str(args.sample_time),
+        'BLOCKBOX_PORT': str(port),
+        'FLASK_API_URL': f"http://127.0.0.1:{port}",
+        'TELEGRAM_BASE_URL': telegram_url,
+        'BUYER_TELEGRAM_TOKEN': '1:buyer', 'BUYER_CHAT_ID': '1',
+        'SELLER_TELEGRAM_TOKEN': '2:seller', 'SELLER_CHAT_ID': '2',
+        'OTP_SECRET': 'JBSWY3DPEHPK3PXP', 'API_KEY': 'benchmark',
+    })
+    # Log, journal and calibration files go to a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix='blockbox-benchmark-'))
+    sys.path.insert(0, SRC_DIR)
+    import blockbox
+    return blockbox
+
+def setup_local_chain(blockbox):
+    from web3 import Web3, EthereumTesterProvider
+    provider = EthereumTesterProvider() # Mines every transaction at once
+    w3 = Web3(provider)
+    buyer_address = w3.eth.accounts[0]
+    buyer_key = provider.ethereum_tester.backend.account_keys[0].to_hex()
+    os.environ['SELLER_ADDRESS'] = w3.eth.accounts[1]
+
+    class LocalChainIntegration(blockbox.BlockchainIntegration):
+        # The quotes would come from Chainlink and an exchange rate API
+        def get_eth_price_usd(self):
+            return ETH_USD
+
+        def get_usd_zar_rate(self):
+            return USD_PER_ZAR
+
+    blockchain = LocalChainIntegration(provider=provider, chain_id=w3.eth.chain_id)
+    blockbox.price_oracle.put('ETH/USD', ETH_USD, blockchain.get_eth_price_usd)
+    blockbox.price_oracle.put('USD/ZAR', USD_PER_ZAR, blockchain.get_usd_zar_rate)
+    blockbox.blockchain = blockchain # Returned by get_blockchain()
+    return buyer_address, buyer_key
+
+def start_system(blockbox, args):
+    # blockbox.main() in headless mode, without its wait for a signal
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.WARNING) # No line per request
+    blockbox.payment_tracker.poll_interval = args.payment_poll
+    blockbox.start_system()
+    blockbox.startup_profile.run('kiosk', blockbox.start_kiosk)
+    blockbox.startup_profile.ready()
+    blockbox.keypad.press_time = args.key_time
+    blockbox.keypad.gap = args.key_time
+    return blockbox.hardware_backend.world, os.environ['FLASK_API_URL']
+
+class Stopwatch:
+    def __init__(self):
+        self.timings = {}
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        # Time since the previous lap is the duration of stage name
+        now = time.perf_counter()
+        self.timings[name] = now - self.last
+        self.last = now
+
+def wait_for(check, timeout, message):
+    # Poll check() until it returns something truthy
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.monotonic() >= deadline:
+            raise RuntimeError(message)
+        time.sleep(POLL_INTERVAL)
+
+def expect(condition, message):
+    if not condition:
+        raise RuntimeError(message)
+
+def run_cycle(blockbox, world, api_url, session, buyer_address, buyer_key, args):
+    # One parcel from listing to confirmed payment. The seller and buyer
+    # use the kiosk API from their phones and act on the simulated 
+    # locker. Returns the seconds spent in every stage.
+    timeout = args.timeout
+    hardware_of = blockbox.compartments.get
+    sent_before = len(TelegramStub.texts)
+
+    def kiosk():
+        return session.get(f"{api_url}/kiosk").json()
+
+    def kiosk_idle():
+        return kiosk()['state'] == 'idle'
+
+    watch = Stopwatch()
+    response = session.post(f"{api_url}/kiosk/listing", json={
+        'item_name': 'Benchmark parcel', 'description': 'Throughput benchmark',
+        'advertised_weight': PARCEL_WEIGHT, 'item_price': ITEM_PRICE_ZAR,
+        'buyer_address': buyer_address})
+    expect(response.status_code == 202, f"listing: {response.text}")
+    transaction_id = response.json()['transaction_id']
+    compartment_id = response.json()['compartment']
+    wait_for(lambda: not world.is_locked(compartment_id), timeout, "door not unlocked for the seller")
+    watch.lap('list')
+
+    # Seller puts the parcel in and shuts the door
+    expect(world.open_door(compartment_id), "door did not open")
+    world.set_parcel(compartment_id, PARCEL_WEIGHT)
+    wait_for(lambda: 'close the door' in kiosk()['message'], timeout, "parcel not detected")
+    world.close_door(compartment_id)
+    wait_for(lambda: kiosk()['state'] != 'placing', timeout, "door close not detected")
+    watch.lap('place')
+
+    # /set_transaction and the OTP message to the buyer
+    otp = TelegramStub.wait_for_otp(transaction_id, timeout)
+    expect(otp, "no OTP message")
+    wait_for(kiosk_idle, timeout, "listing did not finish")
+    expect(blockbox.transactions.get(transaction_id)['status'] == 'awaiting_pickup',
+    f"listing failed: {kiosk()['message']}")
+    watch.lap('otp')
+
+    # Buyer starts the pickup on the phone and types the OTP
+    response = session.post(f"{api_url}/kiosk/pickup", json={
+        'transaction_id': transaction_id, 'buyer_private_key': buyer_key})
+    expect(response.status_code == 202, f"pickup: {response.text}")
+    response = session.post(f"{api_url}/sim/keypad", json={'keys': otp})
+    expect(response.status_code == 202, f"keypad: {response.text}")
+    wait_for(lambda: kiosk()['state'] != 'verifying', timeout, "OTP not verified")
+    expect(not world.is_locked(compartment_id), f"verification failed: {kiosk()['message']}")
+    watch.lap('verify')
+
+    # Buyer takes the parcel out and shuts the door
+    expect(world.open_door(compartment_id), "door did not open")
+    expect(hardware_of(compartment_id).wait_for_door(closed=False, timeout=timeout),
+    "door open not detected") # An instant open and close is debounced away
+    world.set_parcel(compartment_id, 0)
+    world.close_door(compartment_id)
+    wait_for(lambda: kiosk()['state'] != 'collecting', timeout, "collection not detected")
+    watch.lap('collect')
+
+    # /trigger_payment until the receipt is in
+    wait_for(kiosk_idle, timeout, "payment not submitted")
+    job_id = blockbox.transactions.get(transaction_id)['payment_job_id']
+    expect(job_id, f"payment failed: {kiosk()['message']}")
+    job = wait_for(lambda: (lambda job: job if job['status'] != 'pending' else None)(
+    session.get(f"{api_url}/payment_status/{job_id}").json()), timeout, "payment not confirmed")
+    expect(job['status'] == 'confirmed', f"payment {job['status']}")
+    watch.lap('pay')
+
+    # Outbox drained to the Telegram stub
+    wait_for(lambda: not blockbox.notification_outbox.pending() and 
+    len(TelegramStub.texts) > sent_before, timeout, "notifications not delivered")
+    watch.lap('notify')
+    expect(hardware_of(compartment_id).read_weight() <= blockbox.WEIGHT_TOLERANCE, "scale not empty")
+    return watch.timings
+
+def percentile(values, percent):
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def summarise(values):
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95),
+    'p99': percentile(values, 99), 'mean': sum(values) / len(values),
+    'max': max(values)}
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+        cwd=SRC_DIR, capture_output=True, text=True).stdout.strip() or None
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end Block Box throughput benchmark")
+    parser.add_argument('--cycles', type=int, default=10, help="measured cycles")
+    parser.add_argument('--warmup', type=int, default=1, help="cycles run before measuring")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--noise', type=float, default=0.003, help="load cell noise in kg")
+    parser.add_argument('--settle-time', type=float, default=0.4, help="platform settling time constant in s")
+    parser.add_argument('--sample-time', type=float, default=0.0, help="seconds per HX711 conversion")
+    parser.add_argument('--key-time', type=float, default=0.15, help="seconds a key is held and between keys")
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help="stub Telegram response delay in s")
+    parser.add_argument('--payment-poll', type=float, default=0.2, help="payment tracker poll interval in s")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds a stage may take before the cycle fails")
+    args = parser.parse_args()
+    output = os.path.abspath(args.json) if args.json else None # The
+    # benchmark runs in a scratch directory
+
+    import requests
+    telegram_server, telegram_url = start_telegram_stub(args.telegram_latency)
+    blockbox = load_blockbox(args, telegram_url)
+    buyer_address, buyer_key = setup_local_chain(blockbox)
+    world, api_url = start_system(blockbox, args)
+    session = requests.Session()
+    session.headers['x-api-key'] = os.environ['API_KEY']
+    time.sleep(1) # Let the sensor scheduler fill the sample window
+
+    print(f"Warming up ({args.warmup} cycle(s))...")
+    for _ in range(args.warmup):
+        run_cycle(blockbox, world, api_url, session, buyer_address, buyer_key, args)
+
+    print(f"Running {args.cycles} cycle(s)...")
+    results = {stage: [] for stage in STAGES}
+    cycle_times = []
+    failures = []
+    started = time.perf_counter()
+    for cycle in range(args.cycles):
+        cycle_start = time.perf_counter()
+        try:
+            timings = run_cycle(blockbox, world, api_url, session, buyer_address, buyer_key, args)
+        except Exception as e:
+            failures.append(f"cycle {cycle}: {e}")
+            print(f"  cycle {cycle} failed: {e}")
+            continue
+        for stage in STAGES:
+            results[stage].append(timings[stage])
+        cycle_times.append(time.perf_counter() - cycle_start)
+    elapsed = time.perf_counter() - started
+
+    if not cycle_times:
+        print("Every cycle failed.")
+        sys.exit(1)
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'config': vars(args),
+        'cycles': len(cycle_times),
+        'failures': failures,
+        'elapsed': elapsed,
+        'cycles_per_minute': len(cycle_times) / elapsed * 60,
+        'cycle': summarise(cycle_times),
+        'stages': {stage: summarise(values) for stage, values in results.items()},
+        'telegram_messages': len(TelegramStub.texts),
+        'startup': blockbox.startup_profile.report(),
+    }
+
+    print(f"\n{'stage':<10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for stage in STAGES + ['cycle']:
+        stats = report['cycle'] if stage == 'cycle' else report['stages'][stage]
+        print(f"{stage:<10}" + ''.join(f"{stats[key] * 1000:>10.1f}" for key in ('p50', 'p95', 'p99', 'mean')))
+    print(f"\n{report['cycles']} cycle(s) in {elapsed:.1f} s: "
+    f"{report['cycles_per_minute']:.2f} cycles/min ({report['cycles_per_minute'] * 60:.0f}/hour), "
+    f"{len(failures)} failure(s)")
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {output}")
+
+    session.close()
+    blockbox.flask_server.shutdown()
+    blockbox.shutdown_system()
+    telegram_server.shutdown()
+
+if __name__ == "__main__":
+    main()